@@ -1,9 +1,26 @@
 import streamlit as st
 from auth import login_page, logout
+import perf_monitor
+import schema_migrations
 
 # 页面配置必须在所有代码之前
 st.set_page_config(page_title="RhythmCoach", page_icon="🎮", layout="wide")
 
+@st.cache_resource(show_spinner="正在检查数据库结构…")
+def ensure_schema():
+    """
+    每个进程启动时执行一次迁移（幂等；已是最新版本时只查一次版本号），
+    标注、打歌记录依赖的汇总表都由迁移创建
+    """
+    return schema_migrations.migrate()
+
+try:
+    ensure_schema()
+except Exception as e:
+    # 失败不会被缓存，修好后刷新页面即可重试
+    st.error(f"数据库结构迁移失败: {e}")
+    st.stop()
+
 # 初始化 Session State
 if "logged_in" not in st.session_state:
     st.session_state.logged_in = False
@@ -23,13 +40,17 @@ pages = {}
 common_pages = [
     st.Page("views/public_marking.py", title="谱面标注 (公共)", icon="📍"),
     st.Page("views/user_recorder.py", title="我的打歌记录", icon="📝"),
+    st.Page("views/user_importer.py", title="导入历史记录", icon="📥"),
     st.Page("views/user_report.py", title="能力诊断报告", icon="📊"),
+    st.Page("views/tag_search.py", title="按技术找谱面", icon="🔎"),
+    st.Page("views/data_export.py", title="导出数据", icon="📦"),
     st.Page("views/user_feedback.py", title="反馈与报错", icon="💬"),
 ]
 
 # 只有管理员能看到的页面
 admin_pages = [
     st.Page("views/admin_manager.py", title="谱面库管理 (Admin)", icon="⚙️"),
+    st.Page("views/admin_performance.py", title="性能监控 (Admin)", icon="⏱️"),
 ]
 
 # --- 3. 根据角色构建导航 ---
@@ -51,5 +72,6 @@ with st.sidebar:
     if st.button("退出登录"):
         logout()
 
-# --- 5. 运行选中的页面 ---
-pg.run()
\ No newline at end of file
+# --- 5. 运行选中的页面（记录每次 rerun 的耗时） ---
+with perf_monitor.page_timer(pg.title, user=st.session_state.username):
+    pg.run()
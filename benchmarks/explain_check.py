@@ -0,0 +1,171 @@
+"""
+查询计划检查：执行一遍 db_manager 的所有函数，抓下它们实际发出的每条 SQL，
+逐条 EXPLAIN，出现整表扫描就以退出码 1 结束。
+
+    python -m benchmarks.explain_check --scale 0.01
+
+默认跑在合成的 SQLite 上（表结构来自 schema_migrations）；MySQL 上的判定规则是
+EXPLAIN 的 type = ALL，SQLite 上是 EXPLAIN QUERY PLAN 里的 "SCAN <表名>"。
+SQLite 上 EXPLAIN 时使用固定的表统计，结论不随 --scale 变化。
+"""
+import argparse
+import os
+import re
+import sys
+import threading
+from contextlib import contextmanager, nullcontext
+from sqlalchemy import event, inspect
+from benchmarks import synthetic_data
+from benchmarks.run import db_cases, prepare_database
+
+# 有意整表读取的用例（结果放进进程内缓存，不随请求重复执行）
+ALLOWED_FULL_SCANS = {
+    "get_all_charts.cold": "谱面目录整表进缓存",
+    "get_all_charts.warm": "谱面目录整表进缓存",
+    "get_annotations.all": "不带 chart_id 时按定义返回全部标注",
+    "recommend.heavy_user.cold": "推荐引擎首次构建：谱面目录 + 特征矩阵整表读入，之后常驻进程增量更新",
+}
+# 只在 SQLite 上允许：没有 ngram 全文索引，歌名子串检索只能 LIKE '%x%'（MySQL 上走 FULLTEXT）
+ALLOWED_FULL_SCANS_SQLITE = {
+    "search_charts.name.cold": "SQLite 无全文索引",
+    "search_charts.warm": "SQLite 无全文索引",
+    # 按主键顺序 LIMIT 取第一块：SQLite 显示为 SCAN，MySQL 上是 type=index
+    "iter_annotations.all": "主键顺序分块导出",
+}
+
+def allowed(case, dialect):
+    return case in ALLOWED_FULL_SCANS or (dialect == "sqlite" and case in ALLOWED_FULL_SCANS_SQLITE)
+
+# 只有读数据的语句才需要看计划（纯 INSERT ... VALUES 不涉及扫描）
+_NEEDS_PLAN = re.compile(r"^\s*(SELECT|UPDATE|DELETE|INSERT\s+INTO\s+\w+\s*\([^)]*\)\s*SELECT)", re.I | re.S)
+_SQLITE_SCAN = re.compile(r"^SCAN (\w+)(.*)$")
+
+def capture_statements(engine):
+    """
+    监听 engine 上执行的语句，返回 (记录列表, 设置当前用例名的函数)
+    """
+    captured = []
+    state = threading.local()
+
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        case = getattr(state, "case", None)
+        if case and not executemany and _NEEDS_PLAN.match(statement):
+            captured.append((case, statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", before_execute)
+
+    def set_case(name):
+        state.case = name
+    return captured, set_case
+
+# SQLite 的计划依赖 ANALYZE 统计：小规模合成库里的表只有几行，优化器会直接整表扫描，
+# 结论随 --scale 变化。EXPLAIN 前临时换成固定的「大表 + 索引有选择性」统计，查完恢复原样
+FIXED_STAT_ROWS = 1_000_000
+FIXED_STAT_ROWS_PER_KEY = 100
+
+def _fixed_stat_rows(conn):
+    rows = []
+    for table in inspect(conn).get_table_names():
+        indexes = conn.exec_driver_sql(f"PRAGMA index_list('{table}')").all()
+        for _, name, unique, *_ in indexes:
+            columns = conn.exec_driver_sql(f"PRAGMA index_info('{name}')").all()
+            # 每多一列前缀，平均每个键对应的行数降一个数量级；唯一索引的完整键只对应一行
+            per_key = [max(1, FIXED_STAT_ROWS_PER_KEY // 10 ** i) for i in range(len(columns))]
+            if unique:
+                per_key[-1] = 1
+            rows.append((table, name, " ".join(map(str, [FIXED_STAT_ROWS, *per_key]))))
+        if not indexes:
+            rows.append((table, None, str(FIXED_STAT_ROWS)))
+    return rows
+
+@contextmanager
+def fixed_sqlite_stats(conn):
+    exists = conn.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'"
+    ).first() is not None
+    saved = [tuple(r) for r in conn.exec_driver_sql("SELECT tbl, idx, stat FROM sqlite_stat1")] if exists else []
+    if not exists:
+        conn.exec_driver_sql("CREATE TABLE sqlite_stat1(tbl, idx, stat)")
+    fixed = _fixed_stat_rows(conn)
+
+    def load(rows):
+        conn.exec_driver_sql("DELETE FROM sqlite_stat1")
+        if rows:
+            conn.exec_driver_sql("INSERT INTO sqlite_stat1 (tbl, idx, stat) VALUES (?, ?, ?)", rows)
+        conn.commit()
+        # 让当前连接重新读入统计
+        conn.exec_driver_sql("ANALYZE sqlite_schema")
+
+    load(fixed)
+    try:
+        yield
+    finally:
+        conn.rollback()
+        load(saved)
+        if not exists:
+            conn.exec_driver_sql("DROP TABLE sqlite_stat1")
+            conn.commit()
+
+def full_scans(conn, statement, parameters):
+    """
+    :return: 被整表扫描的表名列表（只算真实的表；扫描已经过滤好的派生表 / 子查询结果不算）
+    """
+    if conn.dialect.name == "mysql":
+        rows = conn.exec_driver_sql("EXPLAIN " + statement, parameters).mappings().all()
+        return [r["table"] for r in rows if r["type"] == "ALL" and not str(r["table"]).startswith("<")]
+
+    real_tables = set(inspect(conn).get_table_names())
+    tables = []
+    for row in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters).all():
+        match = _SQLITE_SCAN.match(row[-1])
+        # "SCAN t USING (COVERING) INDEX ix" 只扫索引，不算整表
+        if match and "INDEX" not in match.group(2) and match.group(1) in real_tables:
+            tables.append(match.group(1))
+    return tables
+
+def main():
+    parser = argparse.ArgumentParser(description="检查 db_manager 的查询是否有整表扫描")
+    parser.add_argument("--scale", type=float, default=0.01)
+    parser.add_argument("--db", default=None, help="SQLite 文件路径（默认 bench_<scale>.db）")
+    parser.add_argument("--reuse", action="store_true", help="数据库已存在时不重新生成")
+    parser.add_argument("--url", default=None,
+                        help="改为检查这个 SQLAlchemy URL（如 MySQL 预发库的副本，会写入测试数据）")
+    args = parser.parse_args()
+
+    if args.url:
+        os.environ["RHYTHMCOACH_DB_URL"] = args.url
+        import db_manager as db
+    else:
+        db, _ = prepare_database(args.scale, args.db, args.reuse)
+    engine = db.get_connection().engine
+    captured, set_case = capture_statements(engine)
+
+    for name, fn, setup, teardown in db_cases(db, synthetic_data.heavy_user()):
+        set_case(name)
+        fn(*((setup() if setup else None) or ()))
+        # 清理语句不属于被检查的用例
+        set_case(None)
+        if teardown:
+            teardown()
+
+    failures, seen = [], set()
+    with engine.connect() as conn, (fixed_sqlite_stats(conn) if conn.dialect.name == "sqlite" else nullcontext()):
+        for case, statement, parameters in captured:
+            key = (case, statement)
+            if key in seen:
+                continue
+            seen.add(key)
+            tables = full_scans(conn, statement, parameters)
+            if not tables:
+                continue
+            ok = allowed(case, conn.dialect.name)
+            print(f"[{'允许' if ok else '失败'}] {case}: 整表扫描 {', '.join(tables)}\n    {' '.join(statement.split())}")
+            if not ok:
+                failures.append(case)
+
+    print(f"共检查 {len(seen)} 条语句，{len(failures)} 条整表扫描未在白名单中")
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+"""
+离线基准测试：合成数据 + SQLite，不需要 MySQL / Cloudinary
+
+    python -m benchmarks.run --scale 0.01 --out bench.json
+    python -m benchmarks.run --scale 0.01 --out new.json --baseline bench.json
+
+逐个计时 db_manager 的读写函数（区分冷 / 热缓存），再用 Streamlit AppTest
+整页重跑 views/ 下的页面；结果写成 JSON，给了 --baseline 时中位数变慢超过
+阈值的用例会被列出并以退出码 1 结束。
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+import pandas as pd
+from sqlalchemy import text
+from benchmarks import synthetic_data
+from tech_tags import TECH_TAGS
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _rows(result):
+    if isinstance(result, pd.DataFrame):
+        return len(result)
+    if isinstance(result, tuple) and result and isinstance(result[0], pd.DataFrame):
+        return len(result[0])
+    if isinstance(result, dict):
+        return sum(len(v) for v in result.values() if isinstance(v, pd.DataFrame))
+    if isinstance(result, int):
+        return result
+    return None
+
+def _summary(samples, rows=None, error=None):
+    ordered = sorted(samples)
+    result = {
+        "runs": len(samples),
+        "min_ms": round(ordered[0], 3) if ordered else None,
+        "median_ms": round(statistics.median(ordered), 3) if ordered else None,
+        "p95_ms": round(ordered[max(0, int(len(ordered) * 0.95) - 1)], 3) if ordered else None,
+        "max_ms": round(ordered[-1], 3) if ordered else None,
+        "rows": rows,
+    }
+    if error:
+        result["error"] = error
+    return result
+
+def time_case(fn, setup=None, repeat=5, teardown=None):
+    """
+    setup() 在每次计时前执行（不计入耗时），返回值作为 fn 的位置参数；
+    teardown() 在每次计时后执行（不计入耗时，fn 出错也会执行），用来清掉写入的数据
+    """
+    samples, rows = [], None
+    try:
+        for _ in range(repeat):
+            args = setup() if setup else ()
+            try:
+                start = time.perf_counter()
+                result = fn(*(args or ()))
+                samples.append((time.perf_counter() - start) * 1000)
+            finally:
+                if teardown:
+                    teardown()
+            rows = _rows(result)
+    except Exception as e:
+        return _summary(samples, rows, error=f"{type(e).__name__}: {e}")
+    return _summary(samples, rows)
+
+def db_cases(db, heavy_user):
+    """
+    (用例名, 函数, setup, teardown)；写操作的用例由 teardown 删掉本次写入的行，
+    --reuse 反复跑同一个库时数据量不会越跑越大
+    """
+    import db_async
+    import recommender
+    chart = db.get_all_charts().iloc[0]
+    record = {
+        "username": heavy_user, "chart_id": int(chart["song_id"]), "song_name": chart["song_name"],
+        "difficulty": chart["difficulty"], "level": int(chart["level"]), "practice_count": 3,
+        "miss_section": 5, "cause": "其他", "comment": "bench",
+    }
+    annotation = {
+        "chart_id": int(chart["song_id"]), "chart_name": chart["song_name"], "difficulty": chart["difficulty"],
+        "start_section": 2, "end_section": 6, "tags": "纵连 (Jack)", "desc": "bench",
+        "expert_rating": 3, "annotator": heavy_user,
+    }
+
+    def scalar(sql, params=None):
+        # 直接用 engine，连接用完即还回连接池
+        with db.get_connection().engine.connect() as c:
+            return c.execute(text(sql), params or {}).scalar()
+
+    def last_id(table, column):
+        return int(scalar(f"SELECT COALESCE(MAX({column}), 0) FROM {table}"))
+
+    def ids_after(table, column, since):
+        with db.get_connection().engine.connect() as c:
+            return c.execute(text(f"SELECT {column} FROM {table} WHERE {column} > :id"), {"id": since}).scalars().all()
+
+    def cleanup_after(table, column, delete):
+        """
+        setup 记下当前最大 ID，teardown 用 delete(id) 删掉之后新增的行（走正常删除接口，汇总表同步扣减）
+        """
+        mark = {}
+
+        def setup():
+            mark["id"] = last_id(table, column)
+
+        def teardown():
+            for new_id in ids_after(table, column, mark["id"]):
+                delete(new_id)
+        return setup, teardown
+
+    def delete_feedback(feedback_id):
+        with db.get_connection().engine.begin() as c:
+            c.execute(text("DELETE FROM user_feedback WHERE feedback_id = :id"), {"id": feedback_id})
+
+    def delete_user(user_id):
+        with db.get_connection().engine.begin() as c:
+            c.execute(text("DELETE FROM users WHERE user_id = :id"), {"id": user_id})
+
+    new_users = cleanup_after("users", "user_id", delete_user)
+    new_charts = cleanup_after("charts", "song_id", db.delete_chart)
+    new_records = cleanup_after("play_records", "record_id", db.delete_play_record)
+    new_annotations = cleanup_after("annotations", "annotation_id", db.delete_annotation)
+    new_feedback = cleanup_after("user_feedback", "feedback_id", delete_feedback)
+
+    def add_then_id():
+        db.add_play_record(record)
+        return (last_id("play_records", "record_id"),)
+
+    def add_ann_then_id():
+        return (db.add_annotation(annotation),)
+
+    def add_chart_then_id():
+        db.add_chart("Bench Song", "Master", 30, "bench.png")
+        return (last_id("charts", "song_id"),)
+
+    user_seq = iter(range(1, 10 ** 9))
+    new_chart = {"song_name": "Bench Song", "difficulty": "Master", "level": 30, "filename": "bench.png"}
+    old_record = {
+        "u": heavy_user, "cn": f"{chart['song_name']} ({chart['difficulty']})", "ms": 5, "mc": 2,
+        "cause": "其他", "tags": "纵连 (Jack)", "notes": "bench",
+    }
+    feedback = {"username": heavy_user, "feedback_type": "📝 其他", "content": "bench"}
+
+    # 报告页开头互不依赖的三个查询：顺序执行 vs 并发执行
+    report_calls = [
+        lambda: db.get_user_report_stats(heavy_user),
+        db.get_chart_facets,
+        lambda: recommender.default_level_range(heavy_user),
+    ]
+
+    cold_catalog = db.invalidate_chart_catalog
+    cases = [
+        ("get_user", lambda: db.get_user(heavy_user), None),
+        ("get_all_charts.cold", db.get_all_charts, cold_catalog),
+        ("get_all_charts.warm", db.get_all_charts, None),
+        ("get_chart_facets.cold", db.get_chart_facets, cold_catalog),
+        ("search_charts.name.cold", lambda: db.search_charts(name="Song 00"), cold_catalog),
+        ("search_charts.level_sorted.cold",
+         lambda: db.search_charts(difficulties=["Master", "Expert"], sort="level_desc"), cold_catalog),
+        ("search_charts.warm", lambda: db.search_charts(name="Song 00"), None),
+        ("search_charts_by_tags.all",
+         lambda: db.search_charts_by_tags(TECH_TAGS[:2], min_rating=3, match_all=True), None),
+        ("search_charts_by_tags.any",
+         lambda: db.search_charts_by_tags(TECH_TAGS[2:5], match_all=False, level_range=(20, 38)), None),
+        ("recommend.heavy_user.cold", lambda: recommender.recommend(heavy_user), recommender.invalidate),
+        ("recommend.heavy_user.warm", lambda: recommender.recommend(heavy_user, level_range=(10, 30)), None),
+        ("get_chart_assets.cold", lambda: db.get_chart_assets(chart["song_id"]), cold_catalog),
+        ("get_annotations.chart.cold", lambda: db.get_annotations(chart_id=chart["song_id"]),
+         db.clear_annotation_cache),
+        ("get_annotations.chart.incremental", lambda: db.get_annotations(chart_id=chart["song_id"]), None),
+        ("get_annotations.all", db.get_annotations, None),
+        ("get_chart_section_stats", lambda: db.get_chart_section_stats(chart["song_id"]), None),
+        ("get_play_records.heavy_user", lambda: db.get_play_records(heavy_user), None),
+        ("get_play_records_page.heavy_user", lambda: db.get_play_records_page(heavy_user), None),
+        ("get_play_records_page.heavy_user.page2",
+         lambda cursor: db.get_play_records_page(heavy_user, cursor=cursor),
+         lambda: (db.get_play_records_page(heavy_user)[1],)),
+        ("count_play_records.heavy_user", lambda: db.count_play_records(heavy_user), None),
+        ("get_user_report_stats.heavy_user", lambda: db.get_user_report_stats(heavy_user), None),
+        ("report_queries.sequential", lambda: [call() for call in report_calls], None),
+        ("report_queries.gather", lambda: db_async.gather(*report_calls), None),
+        ("rebuild_user_report_stats.heavy_user", lambda: db.rebuild_user_report_stats(heavy_user), None),
+        ("iter_play_records.heavy_user",
+         lambda: sum(len(c) for c in db.iter_play_records(heavy_user, chunk_rows=1000)), None),
+        ("iter_annotations.chart", lambda: sum(len(c) for c in db.iter_annotations(chart["song_id"])), None),
+        ("iter_annotations.all", lambda: sum(len(c) for c in db.iter_annotations(chunk_rows=1000)), None),
+        ("add_play_record", lambda: db.add_play_record(record), *new_records),
+        ("delete_play_record", db.delete_play_record, add_then_id),
+        ("add_play_records_bulk.1000", lambda: db.add_play_records_bulk([record] * 1000), *new_records),
+        ("add_annotation", lambda: db.add_annotation(annotation), *new_annotations),
+        ("delete_annotation", db.delete_annotation, add_ann_then_id),
+        ("add_annotations_bulk.1000", lambda: db.add_annotations_bulk([annotation] * 1000), *new_annotations),
+        ("add_feedback", lambda: db.add_feedback(heavy_user, "📝 其他", "bench"), *new_feedback),
+        ("add_feedbacks_bulk.1000", lambda: db.add_feedbacks_bulk([feedback] * 1000), *new_feedback),
+        ("get_old_play_records.heavy_user", lambda: db.get_old_play_records(heavy_user), None),
+        ("add_old_play_record", lambda: db.add_old_play_record(old_record), *new_records),
+        ("create_user", lambda: db.create_user(f"bench_new_{next(user_seq)}", "x"), *new_users),
+        # 谱面写入会让目录缓存失效，放在最后，不影响前面的热缓存用例
+        ("add_chart", lambda: db.add_chart(**new_chart), *new_charts),
+        ("add_charts_bulk.100", lambda: db.add_charts_bulk([new_chart] * 100), *new_charts),
+        ("delete_chart", db.delete_chart, add_chart_then_id),
+    ]
+    # 只读用例没有 teardown
+    return [case + (None,) * (4 - len(case)) for case in cases]
+
+# 页面 -> 额外的 session_state
+PAGES = {
+    "public_marking": {},
+    "user_recorder": {},
+    "user_importer": {},
+    "user_report": {},
+    "tag_search": {},
+    "user_feedback": {},
+    "admin_manager": {"role": "admin"},
+}
+
+def page_cases(heavy_user, repeat):
+    from streamlit.testing.v1 import AppTest
+
+    results = {}
+    for page, extra in PAGES.items():
+        def rerun(page=page, extra=extra):
+            at = AppTest.from_file(os.path.join(ROOT, "views", f"{page}.py"), default_timeout=300)
+            at.session_state["logged_in"] = True
+            at.session_state["username"] = heavy_user
+            at.session_state["role"] = extra.get("role", "user")
+            at.run()
+            if at.exception:
+                raise RuntimeError(at.exception[0].message)
+            return None
+        results[f"page.{page}"] = time_case(rerun, repeat=repeat)
+    return results
+
+def compare(current, baseline, threshold):
+    """
+    中位数变慢超过 threshold 倍（且多出 1ms 以上）的用例
+    """
+    regressions = []
+    for name, new in current["results"].items():
+        old = baseline.get("results", {}).get(name)
+        if not old or old.get("median_ms") is None or new.get("median_ms") is None:
+            continue
+        if new["median_ms"] > old["median_ms"] * threshold and new["median_ms"] - old["median_ms"] > 1:
+            regressions.append((name, old["median_ms"], new["median_ms"]))
+    return regressions
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def prepare_database(scale, path=None, reuse=False):
+    """
+    生成（或复用）合成数据库，并让 db_manager 连到它
+    :return: (db_manager 模块, 各表行数)
+    """
+    path = os.path.abspath(path or f"bench_{scale:g}.db")
+    if not (reuse and os.path.exists(path)):
+        print(f"生成合成数据 scale={scale:g} -> {path}")
+        counts = synthetic_data.generate(path, scale)
+    else:
+        counts = synthetic_data.scaled_counts(scale)
+
+    # 必须在第一次 get_connection 之前设置，让 db_manager 连到 SQLite
+    os.environ["RHYTHMCOACH_DB_URL"] = f"sqlite:///{path}"
+    sys.path.insert(0, ROOT)
+    import db_manager as db
+    return db, counts
+
+def main():
+    parser = argparse.ArgumentParser(description="RhythmCoach 离线基准测试")
+    parser.add_argument("--scale", type=float, default=0.01, help="数据规模，1 = 50k 谱面 / 500k 标注 / 5M 记录")
+    parser.add_argument("--db", default=None, help="SQLite 文件路径（默认 bench_<scale>.db）")
+    parser.add_argument("--reuse", action="store_true", help="数据库已存在时不重新生成")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--skip-pages", action="store_true", help="只测 db_manager，不跑 AppTest 页面")
+    parser.add_argument("--out", default="bench.json")
+    parser.add_argument("--baseline", default=None, help="对比用的历史结果 JSON")
+    parser.add_argument("--threshold", type=float, default=1.25)
+    args = parser.parse_args()
+
+    db, counts = prepare_database(args.scale, args.db, args.reuse)
+    heavy_user = synthetic_data.heavy_user()
+    results = {}
+    for name, fn, setup, teardown in db_cases(db, heavy_user):
+        results[f"db.{name}"] = time_case(fn, setup, args.repeat, teardown)
+        print(f"{name:45s} {results[f'db.{name}']}")
+    if not args.skip_pages:
+        for name, summary in page_cases(heavy_user, args.repeat).items():
+            results[name] = summary
+            print(f"{name:45s} {summary}")
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "git_revision": _git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "scale": args.scale,
+            "counts": counts,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入 {args.out}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        for name, old, new in regressions:
+            print(f"⚠️ 变慢: {name} {old:.2f}ms -> {new:.2f}ms")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""
+合成数据生成器（写入离线基准测试用的 SQLite 数据库）
+
+    python -m benchmarks.synthetic_data bench.db --scale 0.01
+
+scale=1 对应 50k 谱面 / 500k 标注 / 5M 打歌记录 / 2k 用户；
+打歌记录按 Zipf 分布落在用户身上，排名第一的用户就是「重度玩家」。
+"""
+import argparse
+import os
+import sqlite3
+import time
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+import schema_migrations
+import weakness_engine
+from tech_tags import MAX_ANNOTATION_SPAN, TECH_TAGS, masks_to_strings
+
+FULL_SCALE = {"charts": 50_000, "annotations": 500_000, "play_records": 5_000_000, "users": 2_000}
+DIFFICULTIES = ["Easy", "Normal", "Hard", "Expert", "Master", "Append"]
+CAUSES = ["读谱没看清", "手速跟不上", "节奏难以把控", "手滑/断触", "耐力耗尽", "初见杀", "不熟悉这类配置", "其他"]
+BATCH = 200_000
+
+def heavy_user():
+    """
+    记录最多的用户（Zipf 排名第一）
+    """
+    return "user_0"
+
+def scaled_counts(scale):
+    return {k: max(1, int(v * scale)) for k, v in FULL_SCALE.items()}
+
+def _timestamps(rng, n, days=365):
+    base = np.datetime64("2025-01-01T00:00:00")
+    seconds = rng.integers(0, days * 86400, n)
+    stamps = np.datetime_as_string(base + seconds.astype("timedelta64[s]"), unit="s")
+    return np.char.replace(stamps, "T", " ")
+
+def _popular(rng, n_items, size, offset=20):
+    """
+    按长尾分布抽取 1..n_items（排名 r 的权重 ∝ 1 / (r + offset)）
+    """
+    weights = 1.0 / (np.arange(n_items) + offset)
+    return rng.choice(n_items, size, p=weights / weights.sum()) + 1
+
+def generate(path, scale=0.01, seed=42):
+    """
+    生成（覆盖）基准数据库，返回各表行数
+    """
+    counts = scaled_counts(scale)
+    rng = np.random.default_rng(seed)
+    if os.path.exists(path):
+        os.remove(path)
+
+    # 表结构与线上一致：直接跑一遍迁移
+    engine = create_engine(f"sqlite:///{path}")
+    schema_migrations.migrate(engine)
+    engine.dispose()
+
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode = OFF")
+    db.execute("PRAGMA synchronous = OFF")
+
+    # 1. 用户
+    users = np.array([f"user_{i}" for i in range(counts["users"])])
+    db.executemany(
+        "INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
+        [(u, "x" * 64, "admin" if i == 0 else "user") for i, u in enumerate(users)]
+    )
+
+    # 2. 谱面
+    n_charts = counts["charts"]
+    chart_diff = rng.choice(DIFFICULTIES, n_charts)
+    chart_level = rng.integers(1, 39, n_charts)
+    chart_names = np.array([f"Song {i:05d}" for i in range(n_charts)])
+    db.executemany(
+        "INSERT INTO charts (song_name, difficulty, level, chart_image_path) VALUES (?, ?, ?, ?)",
+        zip(chart_names.tolist(), chart_diff.tolist(), chart_level.tolist(),
+            (f"https://example.invalid/{i}.webp" for i in range(n_charts)))
+    )
+
+    # 3. 标注：热门谱面标注更多
+    n_ann = counts["annotations"]
+    ann_chart = _popular(rng, n_charts, n_ann)
+    ann_start = rng.integers(1, 80, n_ann)
+    ann_end = ann_start + rng.integers(0, 8, n_ann)
+    tag_a = rng.integers(0, len(TECH_TAGS), n_ann)
+    tag_b = rng.integers(0, len(TECH_TAGS), n_ann)
+    ann_masks = (1 << tag_a) | np.where(rng.random(n_ann) < 0.4, 1 << tag_b, 0)
+    ann_tags = masks_to_strings(ann_masks)
+    annotations = pd.DataFrame({
+        "chart_id": ann_chart, "start_section": ann_start, "end_section": ann_end, "tags": ann_tags,
+    })
+    ann_rating, ann_user = [], []
+    for lo in range(0, n_ann, BATCH):
+        hi = min(lo + BATCH, n_ann)
+        ann_rating.append(rng.integers(1, 6, hi - lo))
+        ann_user.append(rng.choice(users, hi - lo))
+        db.executemany(
+            """
+                INSERT INTO annotations (chart_id, chart_name, difficulty, start_section, end_section,
+                                         tags, desc_text, expert_rating, annotator)
+                VALUES (?, ?, ?, ?, ?, ?, '', ?, ?)
+            """,
+            zip(ann_chart[lo:hi].tolist(), chart_names[ann_chart[lo:hi] - 1].tolist(),
+                chart_diff[ann_chart[lo:hi] - 1].tolist(), ann_start[lo:hi].tolist(),
+                ann_end[lo:hi].tolist(), ann_tags[lo:hi].tolist(),
+                ann_rating[-1].tolist(), ann_user[-1].tolist())
+        )
+    # 标签规范化表：新库的 annotation_id 从 1 连续递增，每个标签位一行
+    ann_rating = np.concatenate(ann_rating)
+    ann_ids = np.arange(1, n_ann + 1)
+    for bit, tag in enumerate(TECH_TAGS):
+        hit = ((ann_masks >> bit) & 1) == 1
+        db.executemany(
+            "INSERT INTO annotation_tags (annotation_id, tag, chart_id, expert_rating) VALUES (?, ?, ?, ?)",
+            zip(ann_ids[hit].tolist(), [tag] * int(hit.sum()), ann_chart[hit].tolist(), ann_rating[hit].tolist())
+        )
+    # 段落汇总表：每条标注按覆盖的段落展开后分组计数
+    span = np.minimum(ann_end - ann_start + 1, MAX_ANNOTATION_SPAN)
+    owner = np.repeat(np.arange(n_ann), span)
+    sections = pd.DataFrame({
+        "chart_id": ann_chart[owner],
+        "section": ann_start[owner] + (np.arange(len(owner)) - np.repeat(np.cumsum(span) - span, span)),
+        "rating": ann_rating[owner],
+        "annotator": np.concatenate(ann_user)[owner],
+    })
+    section_masks = ann_masks[owner]
+    section_stats = sections.groupby(["chart_id", "section"], as_index=False).agg(
+        annotation_count=("rating", "size"), rating_sum=("rating", "sum"))
+    db.executemany(
+        """
+            INSERT INTO chart_section_stats (chart_id, section, annotation_count, rating_sum, rating_count)
+            VALUES (?, ?, ?, ?, ?)
+        """,
+        ((c, s, n, r, n) for c, s, n, r in section_stats.itertuples(index=False, name=None))
+    )
+    for bit, tag in enumerate(TECH_TAGS):
+        hits = sections[((section_masks >> bit) & 1) == 1].groupby(["chart_id", "section"]).size()
+        db.executemany(
+            "INSERT INTO chart_section_tags (chart_id, section, tag, hits) VALUES (?, ?, ?, ?)",
+            ((c, s, tag, n) for (c, s), n in hits.items())
+        )
+    by_annotator = sections.groupby(["chart_id", "section", "annotator"]).size()
+    db.executemany(
+        "INSERT INTO chart_section_annotators (chart_id, section, annotator, annotation_count) VALUES (?, ?, ?, ?)",
+        ((c, s, a, n) for (c, s, a), n in by_annotator.items())
+    )
+
+    # 4. 打歌记录 + 报告汇总表（detected_tags 用弱点引擎算）
+    index = weakness_engine.build_section_index(annotations)
+    n_rec = counts["play_records"]
+    tag_frames = []
+    for lo in range(0, n_rec, BATCH):
+        size = min(BATCH, n_rec - lo)
+        rec_user = users[_popular(rng, len(users), size, offset=1) - 1]
+        rec_chart = _popular(rng, n_charts, size)
+        rec_section = rng.integers(1, 90, size)
+        masks = weakness_engine.lookup_masks(index, rec_chart, rec_section)
+        db.executemany(
+            """
+                INSERT INTO play_records (username, chart_id, song_name, difficulty, level, practice_count,
+                                          miss_section, cause, comment, detected_tags, play_time)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, '', ?, ?)
+            """,
+            zip(rec_user.tolist(), rec_chart.tolist(), chart_names[rec_chart - 1].tolist(),
+                chart_diff[rec_chart - 1].tolist(), chart_level[rec_chart - 1].tolist(),
+                rng.integers(1, 30, size).tolist(), rec_section.tolist(),
+                rng.choice(CAUSES, size).tolist(), masks_to_strings(masks).tolist(),
+                _timestamps(rng, size).tolist())
+        )
+        frame = pd.DataFrame({"username": rec_user})
+        for bit, tag in enumerate(TECH_TAGS):
+            hit = frame[((masks >> bit) & 1) == 1].groupby("username").size()
+            tag_frames.append(pd.DataFrame({"username": hit.index, "tag": tag, "miss_total": hit.values}))
+
+    if tag_frames:
+        tag_stats = pd.concat(tag_frames).groupby(["username", "tag"], as_index=False)["miss_total"].sum()
+        db.executemany(
+            "INSERT INTO user_tag_stats (username, tag, miss_total) VALUES (?, ?, ?)",
+            tag_stats.itertuples(index=False, name=None)
+        )
+    db.execute("""
+        INSERT INTO user_cause_stats (username, cause, record_count)
+        SELECT username, cause, COUNT(*) FROM play_records GROUP BY username, cause
+    """)
+    db.execute("""
+        INSERT INTO user_daily_stats (username, play_date, miss_total, practice_total, record_count)
+        SELECT username, DATE(play_time), COUNT(*), SUM(practice_count), COUNT(*)
+        FROM play_records GROUP BY username, DATE(play_time)
+    """)
+    db.commit()
+    db.execute("ANALYZE")
+    db.close()
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="生成离线基准测试数据库")
+    parser.add_argument("path")
+    parser.add_argument("--scale", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    start = time.perf_counter()
+    counts = generate(args.path, args.scale, args.seed)
+    print(f"生成完成 {counts}，耗时 {time.perf_counter() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()
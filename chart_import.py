@@ -0,0 +1,263 @@
+import io
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import pandas as pd
+import db_manager as db
+import image_utils as img_host
+import upload_cache
+
+# =========================================================
+# 谱面包批量导入：zip（谱面长图）+ 清单 CSV
+# 流程：整体校验 -> 进程池生成派生图 -> 线程池上传 -> 一个事务批量写入 charts
+# =========================================================
+DIFFICULTIES = ["Easy", "Normal", "Hard", "Expert", "Master", "Append"]
+MANIFEST_COLUMNS = ["song_name", "difficulty", "level", "filename"]
+MANIFEST_NAME = "manifest.csv"   # 没有单独上传清单时，到 zip 根目录找这个文件
+IMAGE_EXTS = (".png", ".jpg", ".jpeg")
+MIN_LEVEL, MAX_LEVEL = 1, 38
+
+PROCESS_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))  # Pillow 编码是 CPU 密集，交给子进程
+UPLOAD_THREADS = 4                                           # 同时上传的谱面数（每张谱面内部还会并发传切片）
+MAX_IN_FLIGHT = PROCESS_WORKERS * 2                          # 同时在内存里的派生图份数上限
+
+# 每行的结果状态
+OK, PROCESS_FAILED, UPLOAD_FAILED, SAVE_FAILED, SKIPPED = "成功", "处理失败", "上传失败", "写入失败", "未执行"
+
+IMPORT_TTL = 3600        # 结束的导入保留多久（秒），之后从进程内登记表中清掉
+
+_imports_lock = threading.Lock()
+_imports = {}
+
+# ============================ 1. 读取与校验 ============================
+def read_manifest(data):
+    """
+    读取清单 CSV（全部按文本读入，列名不区分大小写）
+    """
+    manifest = pd.read_csv(io.BytesIO(data), dtype=str, keep_default_na=False, encoding="utf-8-sig")
+    manifest.columns = [str(c).strip().lower() for c in manifest.columns]
+    return manifest
+
+def manifest_from_zip(zip_path):
+    """
+    zip 根目录的 manifest.csv，没有时返回 None
+    """
+    with zipfile.ZipFile(zip_path) as zf:
+        for name in zf.namelist():
+            if name.rsplit("/", 1)[-1].lower() == MANIFEST_NAME:
+                return read_manifest(zf.read(name))
+    return None
+
+def _zip_images(zip_path):
+    """
+    zip 内的图片：文件名（不含目录）-> 压缩包内路径；同名文件出现多次时记为 None
+    """
+    images = {}
+    with zipfile.ZipFile(zip_path) as zf:
+        for info in zf.infolist():
+            if info.is_dir() or not info.filename.lower().endswith(IMAGE_EXTS):
+                continue
+            base = info.filename.rsplit("/", 1)[-1]
+            images[base] = None if base in images else info.filename
+    return images
+
+def validate(manifest, zip_path, catalog):
+    """
+    一次性（向量化）校验整份清单
+    :param catalog: 现有谱面库（song_name, difficulty），用于查重
+    :return: DataFrame(row_no, song_name, difficulty, level, filename, section_count, member, error)，
+             error 为空字符串表示通过
+    """
+    missing = [c for c in MANIFEST_COLUMNS if c not in manifest.columns]
+    if missing:
+        raise ValueError(f"清单缺少列: {', '.join(missing)}")
+
+    df = pd.DataFrame({c: manifest[c].astype(str).str.strip() for c in MANIFEST_COLUMNS})
+    df.insert(0, "row_no", range(2, len(df) + 2))   # 对应 CSV 的行号（第 1 行是表头）
+    sections = (manifest["section_count"].astype(str).str.strip() if "section_count" in manifest.columns
+                else pd.Series("", index=df.index))
+    df["section_count"] = pd.to_numeric(sections.replace("", "0"), errors="coerce")
+    df["error"] = ""
+
+    def flag(mask, message):
+        df["error"] = df["error"].mask((df["error"] == "") & mask, message)
+
+    flag(df["song_name"] == "", "缺少歌名")
+    flag(~df["difficulty"].isin(DIFFICULTIES), "难度无效")
+    level = pd.to_numeric(df["level"], errors="coerce")
+    flag(~level.between(MIN_LEVEL, MAX_LEVEL) | (level % 1 != 0), f"等级需为 {MIN_LEVEL}-{MAX_LEVEL} 的整数")
+    flag(~(df["section_count"] >= 0), "section_count 无效")
+
+    images = _zip_images(zip_path)
+    df["member"] = df["filename"].map(lambda f: images.get(f.rsplit("/", 1)[-1]))
+    flag(~df["filename"].str.lower().str.endswith(IMAGE_EXTS), "文件类型不支持")
+    flag(df["member"].isna(), "压缩包中找不到该图片（或有重名文件）")
+
+    flag(df.duplicated("filename", keep=False), "清单中文件名重复")
+    flag(df.duplicated(["song_name", "difficulty"], keep=False), "清单中同一谱面出现多次")
+    existing = set(zip(catalog["song_name"].astype(str), catalog["difficulty"].astype(str)))
+    flag(pd.Series([k in existing for k in zip(df["song_name"], df["difficulty"])], index=df.index),
+         "谱面库中已存在同名同难度谱面")
+
+    df["level"] = level.where(df["error"] == "").astype("Int64")
+    df["section_count"] = df["section_count"].fillna(0).astype(int)
+    return df
+
+# ============================ 2. 处理与上传 ============================
+def _derive_member(zip_path, member):
+    """
+    子进程里执行：从 zip 读出图片并生成派生图（只回传编码后的字节）
+    """
+    with zipfile.ZipFile(zip_path) as zf:
+        data = zf.read(member)
+    return img_host.build_chart_derivatives(data)
+
+def _with_sections(assets, row):
+    if row["section_count"]:
+        assets["section_count"] = int(row["section_count"])
+    return assets
+
+def _upload(digest, derived, row):
+    return _with_sections(img_host.store_derivatives(digest, derived), row)
+
+def _update(import_id, **fields):
+    with _imports_lock:
+        _imports[import_id].update(fields, updated=time.time())
+
+def _set_result(import_id, index, status, message=""):
+    with _imports_lock:
+        report = _imports[import_id]["report"]
+        report.at[index, "status"] = status
+        report.at[index, "message"] = message
+
+def _run_import(import_id, zip_path, rows):
+    """
+    后台线程：进程池生成派生图、线程池上传，全部结束后一个事务写入 charts
+    （按内容哈希查上传缓存，之前传过的图片直接复用，不再处理和上传）
+    """
+    total = len(rows)
+    assets_by_row = {}
+    done = 0
+    try:
+        ctx = multiprocessing.get_context("spawn")   # 不 fork 带着 Streamlit 线程的进程
+        with ProcessPoolExecutor(max_workers=PROCESS_WORKERS, mp_context=ctx) as processes, \
+                ThreadPoolExecutor(max_workers=UPLOAD_THREADS, thread_name_prefix="chart-import") as uploads, \
+                zipfile.ZipFile(zip_path) as zf:
+            queue = list(rows.iterrows())
+            in_flight = {}   # future -> (阶段, 行号, 行, 内容哈希)
+
+            while queue or in_flight:
+                # 控制同时在内存中的派生图数量
+                while queue and len(in_flight) < MAX_IN_FLIGHT:
+                    index, row = queue.pop(0)
+                    digest = upload_cache.content_hash(zf.read(row["member"]))
+                    cached = img_host.cached_chart_assets(digest)
+                    if cached:
+                        assets_by_row[index] = _with_sections(cached, row)
+                        done += 1
+                        continue
+                    in_flight[processes.submit(_derive_member, zip_path, row["member"])] = ("derive", index, row, digest)
+                if not in_flight:
+                    continue
+
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage, index, row, digest = in_flight.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        status = PROCESS_FAILED if stage == "derive" else UPLOAD_FAILED
+                        _set_result(import_id, index, status, str(e))
+                        done += 1
+                        continue
+                    if stage == "derive":
+                        in_flight[uploads.submit(_upload, digest, result, row)] = ("upload", index, row, digest)
+                    else:
+                        assets_by_row[index] = result
+                        done += 1
+                    _update(import_id, progress=0.95 * done / total, message=f"已处理 {done}/{total}")
+
+        # 全部上传结束后，一个事务写入所有成功的谱面
+        if assets_by_row:
+            _update(import_id, message="写入数据库…")
+            ok_rows = rows.loc[list(assets_by_row)]
+            try:
+                db.add_charts_bulk([
+                    {"song_name": r["song_name"], "difficulty": r["difficulty"], "level": int(r["level"]),
+                     "filename": assets_by_row[i]["full"], "assets": assets_by_row[i]}
+                    for i, r in ok_rows.iterrows()
+                ])
+                for index in assets_by_row:
+                    _set_result(import_id, index, OK, assets_by_row[index]["full"])
+            except Exception as e:
+                for index in assets_by_row:
+                    _set_result(import_id, index, SAVE_FAILED, f"图片已上传但写入失败: {e}")
+        _update(import_id, finished=True, progress=1.0, message="")
+    except Exception as e:
+        _update(import_id, finished=True, message=f"导入中断: {e}")
+    finally:
+        os.remove(zip_path)
+
+def start_import(zip_data, manifest=None, owner=""):
+    """
+    校验后在后台开始导入，立即返回 (导入 ID, 校验结果)；
+    有任何一行校验失败时不执行导入（返回的 ID 为 None），方便修好清单后整包重来
+    :param zip_data: zip 文件字节
+    :param manifest: 清单 DataFrame（read_manifest 的结果），None 表示从 zip 内读取 manifest.csv
+    """
+    fd, zip_path = tempfile.mkstemp(prefix="chart_pack_", suffix=".zip")
+    with os.fdopen(fd, "wb") as f:
+        f.write(zip_data)
+    try:
+        if manifest is None:
+            manifest = manifest_from_zip(zip_path)
+            if manifest is None:
+                raise ValueError(f"没有上传清单，压缩包内也没有 {MANIFEST_NAME}")
+        checked = validate(manifest, zip_path, db.get_all_charts()[["song_name", "difficulty"]])
+    except Exception:
+        os.remove(zip_path)
+        raise
+
+    if (checked["error"] != "").any():
+        os.remove(zip_path)
+        return None, checked
+
+    import_id = uuid.uuid4().hex[:12]
+    report = checked[["row_no", "song_name", "difficulty", "level", "filename"]].copy()
+    report["status"] = SKIPPED
+    report["message"] = ""
+    with _imports_lock:
+        _imports[import_id] = {
+            "id": import_id, "owner": owner, "total": len(checked), "progress": 0.0,
+            "message": "排队中", "finished": False, "report": report,
+            "created": time.time(), "updated": time.time(),
+        }
+        _prune()
+    threading.Thread(
+        target=_run_import, args=(import_id, zip_path, checked), name=f"chart-import-{import_id}", daemon=True
+    ).start()
+    return import_id, checked
+
+def _prune():
+    """
+    清掉结束超过 IMPORT_TTL 的导入（调用方持有 _imports_lock）
+    """
+    now = time.time()
+    for import_id in [i for i, state in _imports.items() if state["finished"] and now - state["updated"] > IMPORT_TTL]:
+        del _imports[import_id]
+
+def get_import(import_id):
+    """
+    导入进度快照（report 为副本）；已过期清理的导入返回 None
+    """
+    with _imports_lock:
+        _prune()
+        state = _imports.get(import_id)
+        if state is None:
+            return None
+        return {**state, "report": state["report"].copy()}
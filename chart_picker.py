@@ -0,0 +1,86 @@
+import streamlit as st
+import db_manager as db
+
+# 排序单选项 -> db.CHART_SORTS 的键
+SORT_LABELS = {
+    "默认": "default",
+    "从低到高 (升序)": "level_asc",
+    "从高到低 (降序)": "level_desc",
+}
+
+def chart_filters(show_sort=False):
+    """
+    渲染歌名 / 难度 / 等级（/ 排序）筛选控件，返回 search_charts 的参数
+    """
+    facets = db.get_chart_facets()
+
+    # ① 搜索歌名
+    search_text = st.text_input("搜索歌名", placeholder="输入关键字…")
+
+    # ② 难度筛选
+    all_difficulties = facets["difficulties"]
+    selected_difficulty = st.multiselect("筛选难度", all_difficulties, default=all_difficulties)
+
+    # ③ 等级筛选（单选）
+    selected_level = st.selectbox(
+        "筛选等级（Lv）",
+        ["全部"] + [str(lv) for lv in facets["levels"]]
+    )
+
+    # ④ 等级排序方式
+    sort_mode = "默认"
+    if show_sort:
+        sort_mode = st.radio("等级排序方式", list(SORT_LABELS))
+
+    return {
+        "name": search_text,
+        # 全选时不下推难度条件，让索引只处理等级
+        "difficulties": None if len(selected_difficulty) == len(all_difficulties) else selected_difficulty,
+        "level": None if selected_level == "全部" else int(selected_level),
+        "sort": SORT_LABELS[sort_mode],
+    }
+
+def chart_options(df):
+    return df.apply(
+        lambda x: f"ID:{x['song_id']} | {x['song_name']} ({x['difficulty']}, Lv{x['level']})",
+        axis=1
+    )
+
+def select_chart(filters, label, key, page_size=50):
+    """
+    按筛选条件分页选择谱面（键集分页，每次只取一页）
+    :return: 选中的谱面行 (Series)，没有结果时返回 None
+    """
+    state_key = f"{key}_pages"
+    signature = tuple(sorted((k, str(v)) for k, v in filters.items()))
+    pages = st.session_state.get(state_key)
+    if pages is None or pages["signature"] != signature:
+        # 筛选条件变化 -> 回到第一页
+        pages = {"signature": signature, "cursors": [None], "index": 0}
+        st.session_state[state_key] = pages
+
+    page_df, next_cursor = db.search_charts(
+        cursor=pages["cursors"][pages["index"]], limit=page_size, **filters
+    )
+    if page_df.empty:
+        return None
+
+    options = chart_options(page_df)
+    selected_label = st.selectbox(label, options, key=f"{key}_select")
+    selected_row = page_df[options == selected_label].iloc[0]
+
+    def go_prev():
+        pages["index"] -= 1
+
+    def go_next():
+        del pages["cursors"][pages["index"] + 1:]
+        pages["cursors"].append(next_cursor)
+        pages["index"] += 1
+
+    if pages["index"] > 0 or next_cursor is not None:
+        c1, c2, c3 = st.columns([1, 1, 1])
+        c1.button("⬅️ 上一页", key=f"{key}_prev", on_click=go_prev, disabled=pages["index"] == 0)
+        c2.caption(f"第 {pages['index'] + 1} 页")
+        c3.button("下一页 ➡️", key=f"{key}_next", on_click=go_next, disabled=next_cursor is None)
+
+    return selected_row
@@ -0,0 +1,96 @@
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from streamlit.runtime.scriptrunner_utils.script_run_context import SCRIPT_RUN_CONTEXT_ATTR_NAME
+
+# =========================================================
+# 并发查询：页面里互不依赖的查询一起发出、一起等待
+# 页面耗时从「各查询之和」降到「最慢的那一个」。
+#
+#     assets, stats = db_async.gather(
+#         lambda: db.get_chart_assets(chart_id),
+#         lambda: db.get_chart_section_stats(chart_id),
+#     )
+#
+# 第一个调用在当前脚本线程里执行，其余的交给进程内共享的线程池；
+# 线程池满时排队，最坏也就退回到原来的顺序执行。
+# db_manager 的函数本身是线程安全的（共享连接池 + 带锁的进程级缓存）；
+# 池内线程执行前会挂上调用方会话的脚本上下文，任务里可以读 st.session_state / st.secrets，
+# 但只做查询，不要调用 st.* 渲染组件。
+# =========================================================
+# 默认参数，可在 secrets.toml 的 [db_async] 中覆盖：
+#   max_workers（线程池大小，所有会话共享；应小于 [db_pool] 的 pool_size + max_overflow）
+DB_ASYNC_DEFAULTS = {
+    "max_workers": 4,
+}
+
+def settings():
+    conf = dict(DB_ASYNC_DEFAULTS)
+    try:
+        conf.update(st.secrets.get("db_async", {}))
+    except FileNotFoundError:
+        pass
+    return conf
+
+_executor_lock = threading.Lock()
+_executor = None
+_worker = threading.local()
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=int(settings()["max_workers"]), thread_name_prefix="db-async"
+                )
+                atexit.register(_executor.shutdown, wait=False)
+    return _executor
+
+def _run_in_worker(call, ctx):
+    # 池内线程会被不同会话复用：任务结束后恢复原来的上下文，不让本会话的 ctx 留在线程上
+    thread = threading.current_thread()
+    previous = get_script_run_ctx(suppress_warning=True)
+    if ctx is not None:
+        add_script_run_ctx(thread, ctx)
+    _worker.active = True
+    try:
+        return call()
+    finally:
+        _worker.active = False
+        # add_script_run_ctx(thread, None) 会取当前上下文，清空只能直接置属性
+        setattr(thread, SCRIPT_RUN_CONTEXT_ATTR_NAME, previous)
+
+def gather(*calls):
+    """
+    并发执行互不依赖的查询，全部完成后按传入顺序返回结果
+    :param calls: 无参可调用对象（带参数的用 lambda / functools.partial 包一层）
+    :return: 结果列表；有调用失败时等其余调用结束后抛出第一个（按传入顺序）异常
+    """
+    if not calls:
+        return []
+    # 在线程池里再嵌套 gather 时直接顺序执行，避免池内线程互相等待
+    if len(calls) == 1 or getattr(_worker, "active", False):
+        return [call() for call in calls]
+
+    executor = _get_executor()
+    ctx = get_script_run_ctx(suppress_warning=True)
+    futures = [executor.submit(_run_in_worker, call, ctx) for call in calls[1:]]
+    results, errors = [], []
+    try:
+        results.append(calls[0]())
+    except Exception as e:
+        results.append(None)
+        errors.append(e)
+    # 即使前面的失败了也要等其余任务结束，不留后台查询占着连接
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append(None)
+            errors.append(e)
+    if errors:
+        raise errors[0]
+    return results
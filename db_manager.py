@@ -1,24 +1,275 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone
+from itertools import islice
 import streamlit as st
 import pandas as pd
 from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError, TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+import perf_monitor
+import weakness_engine
+from tech_tags import MAX_ANNOTATION_SPAN, NO_TAG, annotation_tag_rows, masks_to_strings, split_tags
+
+logger = logging.getLogger(__name__)
 
 # =========================================================
 # 1. 获取数据库连接
 # =========================================================
+# 连接池默认参数，可在 secrets.toml 的 [db_pool] 中覆盖：
+#   pool_size / max_overflow / pool_recycle（秒，需小于 MySQL wait_timeout）
+#   pool_pre_ping（取连接前探活，避免空闲超时后的失效连接）/ pool_timeout（秒）
+POOL_DEFAULTS = {
+    "pool_size": 5,
+    "max_overflow": 10,
+    "pool_recycle": 1800,
+    "pool_pre_ping": True,
+    "pool_timeout": 30,
+}
+
+# 取连接等待时间统计（所有会话共享）
+_pool_stats_lock = threading.Lock()
+_pool_stats = {"waits": 0, "total_wait": 0.0, "max_wait": 0.0, "timeouts": 0, "recent": deque(maxlen=500)}
+
+def _record_pool_wait(seconds, timed_out=False):
+    with _pool_stats_lock:
+        _pool_stats["waits"] += 1
+        _pool_stats["total_wait"] += seconds
+        _pool_stats["max_wait"] = max(_pool_stats["max_wait"], seconds)
+        _pool_stats["recent"].append(seconds)
+        if timed_out:
+            _pool_stats["timeouts"] += 1
+
+class _TimedQueuePool(QueuePool):
+    """
+    QueuePool + 记录每次从池中取连接的等待时间
+    """
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except PoolTimeoutError:
+            _record_pool_wait(time.perf_counter() - start, timed_out=True)
+            raise
+        _record_pool_wait(time.perf_counter() - start)
+        return conn
+
+def pool_settings():
+    settings = dict(POOL_DEFAULTS)
+    try:
+        settings.update(st.secrets.get("db_pool", {}))
+    except FileNotFoundError:
+        pass
+    return settings
+
+# 设置该环境变量时改连指定的 SQLAlchemy URL（如离线基准测试用的 sqlite:///bench.db）
+DB_URL_ENV = "RHYTHMCOACH_DB_URL"
+
+_conn_lock = threading.Lock()
+_conn = None
+
 def get_connection():
-    return st.connection("mysql", type="sql")
+    """
+    进程内共享的连接（只创建一次，后台线程也可以直接使用）
+    """
+    global _conn
+    if _conn is None:
+        with _conn_lock:
+            if _conn is None:
+                url = os.environ.get(DB_URL_ENV)
+                if url:
+                    _conn = st.connection("rhythm_db", type="sql", url=url,
+                                          poolclass=_TimedQueuePool, **pool_settings())
+                else:
+                    _conn = st.connection("mysql", type="sql", poolclass=_TimedQueuePool, **pool_settings())
+    return _conn
+
+def _dialect():
+    return get_connection().engine.dialect.name
+
+# 数据库时钟相对 UTC 的偏移（秒）：SQLite 的 CURRENT_TIMESTAMP 固定是 UTC，MySQL 按会话时区
+CLOCK_RETRY_SECONDS = 60     # MySQL 上查询偏移失败后，这段时间内沿用本机时区的估计，不再查询
+_clock = {"offset": None, "retry_at": 0.0}
+
+def _clock_offset():
+    if _clock["offset"] is not None:
+        return _clock["offset"]
+    if _dialect() != "mysql":
+        _clock["offset"] = 0
+        return 0
+    guess = time.localtime().tm_gmtoff
+    if time.time() < _clock["retry_at"]:
+        return guess
+    try:
+        with get_connection().engine.connect() as c:
+            _clock["offset"] = int(c.execute(text("SELECT TIMESTAMPDIFF(SECOND, UTC_TIMESTAMP(), NOW())")).scalar())
+        return _clock["offset"]
+    except DBAPIError:
+        _clock["retry_at"] = time.time() + CLOCK_RETRY_SECONDS
+        return guess
+
+def db_now():
+    """
+    与数据库 CURRENT_TIMESTAMP 同一时区的当前时间（naive datetime，精确到秒）
+    时间在客户端生成、稍后才写库时（write_behind）用它，和同步写入取默认值的记录保持一致
+    """
+    now = datetime.now(timezone.utc) + timedelta(seconds=_clock_offset())
+    return now.replace(tzinfo=None, microsecond=0)
+
+def _upsert_add_sql(table, key_cols, add_cols, values=None, dialect=None):
+    """
+    「插入，主键冲突时累加」语句：MySQL 用 ON DUPLICATE KEY UPDATE，
+    SQLite（离线基准测试）用 ON CONFLICT ... DO UPDATE
+    :param values: 列 -> VALUES 中的表达式，默认 :列名
+    :param dialect: 方言名，默认取共享连接的（迁移脚本传入自己连接的方言）
+    """
+    cols = list(key_cols) + list(add_cols)
+    values = values or {}
+    sql = (f"INSERT INTO {table} ({', '.join(cols)}) "
+           f"VALUES ({', '.join(values.get(c, ':' + c) for c in cols)}) ")
+    if (dialect or _dialect()) == "mysql":
+        return sql + "ON DUPLICATE KEY UPDATE " + ", ".join(f"{c} = {c} + VALUES({c})" for c in add_cols)
+    return (sql + f"ON CONFLICT ({', '.join(key_cols)}) DO UPDATE SET "
+            + ", ".join(f"{c} = {c} + excluded.{c}" for c in add_cols))
+
+def get_pool_status():
+    """
+    连接池实时指标（给管理页面展示）
+    """
+    pool = get_connection().engine.pool
+    with _pool_stats_lock:
+        waits = _pool_stats["waits"]
+        recent = sorted(_pool_stats["recent"])
+        status = {
+            "waits": waits,
+            "avg_wait_ms": _pool_stats["total_wait"] / waits * 1000 if waits else 0.0,
+            "p95_wait_ms": recent[int(len(recent) * 0.95) - 1] * 1000 if recent else 0.0,
+            "max_wait_ms": _pool_stats["max_wait"] * 1000,
+            "timeouts": _pool_stats["timeouts"],
+        }
+    if isinstance(pool, QueuePool):
+        status.update({
+            "pool_size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "overflow": max(pool.overflow(), 0),
+        })
+    status["settings"] = pool_settings()
+    return status
+
+# 批量写入每块的行数（每块一次 executemany + 一次 commit）
+BULK_CHUNK_SIZE = 500
+
+def _iter_chunks(rows, size):
+    it = iter(rows)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+# =========================================================
+# 1.1 查询结果的列类型
+# conn.query 返回的文本列是逐行的 Python 字符串，同一个难度 / 原因 / 歌名在每一行各存一份。
+# 大结果集（谱面目录、标注、打歌记录）统一经 _apply_schema 转成显式类型：
+#   重复度高的文本 -> category（每个取值只存一份，行里只存整数编码）
+#   等级 / 段落 / 计数 -> 可空小整数，时间 -> datetime64
+# 没列出的列保持原样；设置环境变量 RHYTHMCOACH_ARROW_STRINGS=1 时其余文本列改用 Arrow 字符串。
+# =========================================================
+COLUMN_TYPES = {
+    "difficulty": "category", "cause": "category", "feedback_type": "category", "role": "category",
+    "tag": "category", "song_name": "category", "chart_name": "category", "tags": "category",
+    "detected_tags": "category", "annotator": "category", "username": "category",
+    "level": "Int8", "expert_rating": "Int8", "best_rating": "Int8",
+    "start_section": "Int16", "end_section": "Int16", "section": "Int16", "miss_section": "Int16", "miss_count": "Int16",
+    "practice_count": "Int32",
+    "play_time": "datetime", "upload_time": "datetime", "created_at": "datetime", "play_date": "datetime",
+}
+ARROW_STRINGS_ENV = "RHYTHMCOACH_ARROW_STRINGS"
+
+def _arrow_strings():
+    return os.environ.get(ARROW_STRINGS_ENV) == "1"
+
+def _apply_schema(df, arrow=None):
+    """
+    按 COLUMN_TYPES 原地转换列类型并返回 df（只用于刚查出来、尚未共享的结果）
+    某列转换失败（如数值超出小整数范围）时保持原类型
+    """
+    arrow = _arrow_strings() if arrow is None else arrow
+    for col in df.columns:
+        kind = COLUMN_TYPES.get(col)
+        try:
+            if kind == "category":
+                if not isinstance(df[col].dtype, pd.CategoricalDtype):
+                    df[col] = df[col].astype("category")
+            elif kind == "datetime":
+                if not pd.api.types.is_datetime64_any_dtype(df[col]):
+                    df[col] = pd.to_datetime(df[col], errors="coerce", format="ISO8601")
+            elif kind is not None:
+                if df[col].dtype != kind:
+                    df[col] = pd.to_numeric(df[col], errors="coerce").astype(kind)
+            elif arrow and (df[col].dtype == object or pd.api.types.is_string_dtype(df[col])):
+                df[col] = df[col].astype("string[pyarrow]")
+        except (TypeError, ValueError, OverflowError, ImportError):
+            pass
+    return df
+
+def _read_sql(sql, params=None):
+    """
+    不缓存的查询（替代 conn.query(..., ttl=0)）：连接用完立即归还连接池。
+    conn.query 里 read_sql 持有的连接要等垃圾回收才释放，连续查询时会把连接池占满。
+    """
+    with get_connection().engine.connect() as c:
+        return pd.read_sql(text(sql), c, params=params or {})
+
+def _typed_query(sql, params=None):
+    return _apply_schema(_read_sql(sql, params))
+
+def _py(value):
+    """
+    写库前把值转回普通 Python 标量（dict 逐字段转换）：pd.NA / NaN / NaT -> None，
+    numpy 标量 -> .item()，Timestamp -> datetime。
+    经 _apply_schema 的 DataFrame 里取出的 Int8 / category 值直接交给驱动会报错（如 sqlite3 不认识 NAType）
+    """
+    if isinstance(value, dict):
+        return {k: _py(v) for k, v in value.items()}
+    if value is None or (pd.api.types.is_scalar(value) and pd.isna(value)):
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.to_pydatetime()
+    return value.item() if hasattr(value, "item") else value
+
+def _bulk_insert(sql, rows, chunk_size, after_chunk=None):
+    """
+    rows 可以是任意可迭代对象（包括生成器），按块 executemany 并提交
+    after_chunk(session, chunk) 在每块提交前执行，与该块处于同一事务
+    """
+    conn = get_connection()
+    total = 0
+    with conn.session as s:
+        for chunk in _iter_chunks(rows, chunk_size):
+            s.execute(text(sql), chunk)
+            if after_chunk:
+                after_chunk(s, chunk)
+            s.commit()
+            total += len(chunk)
+    return total
 
 # =========================================================
 # 2. 用户管理
 # =========================================================
+@perf_monitor.timed_query
 def get_user(username):
-    conn = get_connection()
-    return conn.query(
+    return _read_sql(
         "SELECT * FROM users WHERE username = :u",
-        params={"u": username},
-        ttl=0
+        params={"u": username}
     )
 
+@perf_monitor.timed_query
 def create_user(username, password_hash):
     conn = get_connection()
     with conn.session as s:
@@ -31,44 +282,413 @@ def create_user(username, password_hash):
 # =========================================================
 # 3. 谱面库管理
 # =========================================================
+# 进程级谱面目录缓存：所有会话共享，按版本号失效。
+# 只有 add_chart / delete_chart 提升版本号后才会重新查询 MySQL，
+# 目录全量、筛选项、搜索分页结果都挂在同一个版本下。
+_CATALOG_CACHE_MAX = 256
+_catalog_lock = threading.Lock()
+_catalog = {"version": 0, "entries": OrderedDict()}
+
+def _bump_catalog_version():
+    with _catalog_lock:
+        _catalog["version"] += 1
+        _catalog["entries"].clear()
+
+def _catalog_cached(key, loader):
+    with _catalog_lock:
+        version = _catalog["version"]
+        hit = _catalog["entries"].get(key)
+        if hit is not None and hit[0] == version:
+            _catalog["entries"].move_to_end(key)
+            return hit[1]
+
+    value = loader()
+
+    with _catalog_lock:
+        # 查询期间如果又有写入，版本号已变化，不缓存这份旧结果
+        if version == _catalog["version"]:
+            entries = _catalog["entries"]
+            entries[key] = (version, value)
+            entries.move_to_end(key)
+            while len(entries) > _CATALOG_CACHE_MAX:
+                entries.popitem(last=False)
+    return value
+
+def invalidate_chart_catalog():
+    """
+    手动让谱面目录缓存失效（例如直接改了数据库之后）
+    """
+    _bump_catalog_version()
+
+@perf_monitor.timed_query
 def get_all_charts():
+    """
+    获取全部谱面（进程级缓存，返回的 DataFrame 为共享只读对象，请勿原地修改）
+    """
+    return _catalog_cached(
+        ("all_charts",),
+        lambda: _apply_schema(_read_sql("SELECT * FROM charts"))
+    )
+
+@perf_monitor.timed_query
+def get_chart_facets():
+    """
+    侧边栏筛选项：所有难度 + 所有等级（走 (difficulty, level) 索引，不拉全表）
+    """
+    def load():
+        diffs = _read_sql("SELECT DISTINCT difficulty FROM charts ORDER BY difficulty")
+        levels = _read_sql("SELECT DISTINCT level FROM charts WHERE level IS NOT NULL ORDER BY level")
+        return {
+            "difficulties": diffs["difficulty"].dropna().tolist(),
+            "levels": [int(lv) for lv in levels["level"].tolist()],
+        }
+    return _catalog_cached(("facets",), load)
+
+# 排序方式 -> 键集分页使用的 (列, 方向)，最后一列必须唯一
+CHART_SORTS = {
+    "default": (("song_id", "ASC"),),
+    "level_asc": (("level", "ASC"), ("song_id", "ASC")),
+    "level_desc": (("level", "DESC"), ("song_id", "DESC")),
+}
+# 允许为空的排序列：MySQL / SQLite 都把 NULL 当作最小值（升序在最前，降序在最后），
+# 键集条件按同样的规则处理，ORDER BY 仍然直接用列本身，(difficulty, level) 索引可以服务排序
+_NULLABLE_SORT_COLUMNS = {"level"}
+
+def _chart_cursor(row, order):
+    return tuple(None if pd.isna(row[c]) else int(row[c]) for c, _ in order)
+
+def _escape_like(value):
+    # 配合 LIKE ... ESCAPE '!' 使用（MySQL / SQLite 通用）
+    return value.replace("!", "!!").replace("%", "!%").replace("_", "!_")
+
+def _keyset_condition(order, cursor, params, nullable=()):
+    """
+    构造 (c1, c2) > (v1, v2) 形式的键集条件（展开写法，便于 MySQL 走索引）
+    :param nullable: 可能为 NULL 的列（NULL 视为最小值，游标里对应的值可以是 None）
+    """
+    ors = []
+    for i, (col, direction) in enumerate(order):
+        parts = []
+        for j, (c, _) in enumerate(order[:i]):
+            parts.append(f"{c} IS NULL" if cursor[j] is None else f"{c} = :k{j}")
+        if cursor[i] is None:
+            # NULL 之后：升序是所有非空值，降序没有更靠后的值
+            if direction == "DESC":
+                continue
+            parts.append(f"{col} IS NOT NULL")
+        elif col in nullable and direction == "DESC":
+            parts.append(f"({col} < :k{i} OR {col} IS NULL)")
+        else:
+            parts.append(f"{col} {'>' if direction == 'ASC' else '<'} :k{i}")
+        ors.append("(" + " AND ".join(parts) + ")")
+    for i, value in enumerate(cursor):
+        if value is not None:
+            params[f"k{i}"] = value
+    return "(" + " OR ".join(ors) + ")"
+
+@perf_monitor.timed_query
+def search_charts(name="", difficulties=None, level=None, sort="default", cursor=None, limit=50):
+    """
+    服务端谱面检索（键集分页）
+    :param name: 歌名关键字（>=2 个字符走 ngram 全文索引，单字按子串 LIKE 匹配）
+    :param difficulties: 难度列表，None 表示不过滤，空列表表示无结果
+    :param level: 等级，None 表示全部
+    :param sort: CHART_SORTS 中的排序方式
+    :param cursor: 上一页返回的游标，None 表示第一页
+    :return: (当前页 DataFrame, 下一页游标 或 None)
+    """
+    order = CHART_SORTS[sort]
+    if difficulties is not None and len(difficulties) == 0:
+        return pd.DataFrame(columns=["song_id", "song_name", "difficulty", "level", "chart_image_path"]), None
+
+    where, params = [], {}
+    name = (name or "").strip()
+    # ngram 全文索引只有 MySQL 有，其他数据库直接用 LIKE
+    fulltext = len(name) >= 2 and _dialect() == "mysql"
+    if fulltext:
+        where.append("MATCH(song_name) AGAINST (:ft IN BOOLEAN MODE)")
+        params["ft"] = '"' + name.replace('"', " ") + '"'
+    elif name:
+        # 单字（全文索引的 ngram 至少两个字）也按子串匹配，扫描由 LIMIT 截断
+        where.append("song_name LIKE :like ESCAPE '!'")
+        params["like"] = "%" + _escape_like(name) + "%"
+    if difficulties is not None:
+        keys = [f"d{i}" for i in range(len(difficulties))]
+        where.append("difficulty IN (" + ", ".join(":" + k for k in keys) + ")")
+        params.update(zip(keys, difficulties))
+    if level is not None:
+        where.append("level = :lv")
+        params["lv"] = int(level)
+    if cursor is not None:
+        where.append(_keyset_condition(order, cursor, params, nullable=_NULLABLE_SORT_COLUMNS))
+
+    sql = "SELECT song_id, song_name, difficulty, level, chart_image_path FROM charts"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY " + ", ".join(f"{c} {d}" for c, d in order)
+    sql += f" LIMIT {int(limit) + 1}"
+
+    def load():
+        try:
+            return _typed_query(sql, params)
+        except DBAPIError:
+            if not fulltext:
+                raise
+            # 全文索引尚未创建时退化为 LIKE 子串匹配
+            fallback_params = {k: v for k, v in params.items() if k != "ft"}
+            fallback_params["like"] = "%" + _escape_like(name) + "%"
+            fallback_sql = sql.replace("MATCH(song_name) AGAINST (:ft IN BOOLEAN MODE)", "song_name LIKE :like ESCAPE '!'")
+            return _typed_query(fallback_sql, fallback_params)
+
+    page = _catalog_cached(("search", sql, tuple(sorted(params.items()))), load)
+    next_cursor = None
+    if len(page) > limit:
+        page = page.iloc[:limit]
+        last = page.iloc[-1]
+        next_cursor = _chart_cursor(last, order)
+    return page, next_cursor
+
+@perf_monitor.timed_query
+def add_chart(song_name, difficulty, level, filename, assets=None):
+    """
+    新增谱面；assets 为 image_utils.upload_chart_assets 返回的派生资源清单
+    """
     conn = get_connection()
-    return conn.query("SELECT * FROM charts", ttl=0)
+    with conn.session as s:
+        if assets is None:
+            s.execute(
+                text("""
+                    INSERT INTO charts (song_name, difficulty, level, chart_image_path)
+                    VALUES (:n, :d, :l, :p)
+                """),
+                _py({"n": song_name, "d": difficulty, "l": level, "p": filename})
+            )
+        else:
+            s.execute(
+                text("""
+                    INSERT INTO charts (song_name, difficulty, level, chart_image_path, chart_assets)
+                    VALUES (:n, :d, :l, :p, :a)
+                """),
+                _py({"n": song_name, "d": difficulty, "l": level, "p": filename,
+                     "a": json.dumps(assets, ensure_ascii=False)})
+            )
+        s.commit()
+    _bump_catalog_version()
 
-def add_chart(song_name, difficulty, level, filename):
+@perf_monitor.timed_query
+def add_charts_bulk(charts):
+    """
+    批量新增谱面（一个事务：要么全部写入，要么全部回滚）
+    :param charts: [{"song_name", "difficulty", "level", "filename", "assets"}, ...]
+    :return: 写入行数
+    """
+    rows = [
+        _py({"n": c["song_name"], "d": c["difficulty"], "l": c["level"], "p": c["filename"],
+             "a": json.dumps(c["assets"], ensure_ascii=False) if c.get("assets") else None})
+        for c in charts
+    ]
+    if not rows:
+        return 0
     conn = get_connection()
     with conn.session as s:
         s.execute(
             text("""
-                INSERT INTO charts (song_name, difficulty, level, chart_image_path)
-                VALUES (:n, :d, :l, :p)
+                INSERT INTO charts (song_name, difficulty, level, chart_image_path, chart_assets)
+                VALUES (:n, :d, :l, :p, :a)
             """),
-            {"n": song_name, "d": difficulty, "l": level, "p": filename}
+            rows
         )
         s.commit()
+    _bump_catalog_version()
+    return len(rows)
 
+@perf_monitor.timed_query
+def get_chart_assets(chart_id):
+    """
+    获取谱面的派生资源清单（预览图 / 切片），旧谱面或未建字段时返回 None
+    """
+    def load():
+        try:
+            df = _read_sql(
+                "SELECT chart_assets FROM charts WHERE song_id = :id",
+                params={"id": int(chart_id)}
+            )
+        except DBAPIError:
+            return None
+        if df.empty or not df.iloc[0]["chart_assets"]:
+            return None
+        return json.loads(df.iloc[0]["chart_assets"])
+    return _catalog_cached(("assets", int(chart_id)), load)
+
+@perf_monitor.timed_query
 def delete_chart(song_id):
     conn = get_connection()
     with conn.session as s:
         s.execute(text("DELETE FROM charts WHERE song_id = :id"), {"id": song_id})
         s.commit()
+    _bump_catalog_version()
 
 # =========================================================
 # 4. 标注管理
 # =========================================================
+# 进程级按谱面缓存的标注：chart_id -> {"df", "last_id", "deleted"}
+# 刷新时只查询 annotation_id > last_id 的新行；本进程的增删直接修补缓存。
+_ANNOTATION_CACHE_MAX = 512
+_ann_lock = threading.Lock()
+_ann_cache = OrderedDict()
+
+def _merge_annotations(entry, fresh):
+    if not fresh.empty:
+        merged = pd.concat([entry["df"], fresh], ignore_index=True)
+        merged = merged.drop_duplicates("annotation_id", keep="last")
+        if entry["deleted"]:
+            merged = merged[~merged["annotation_id"].isin(entry["deleted"])]
+        # 各块的分类取值不同，拼接后会退回普通文本列，重新转换一次
+        entry["df"] = _apply_schema(merged.sort_values("annotation_id").reset_index(drop=True))
+        entry["last_id"] = max(entry["last_id"], int(fresh["annotation_id"].max()))
+
+@perf_monitor.timed_query
 def get_annotations(chart_id=None):
-    conn = get_connection()
-    sql = "SELECT * FROM annotations"
-    params = {}
-    if chart_id:
-        sql += " WHERE chart_id = :id"
-        params = {"id": chart_id}
-    return conn.query(sql, params=params, ttl=0)
+    """
+    获取标注；指定 chart_id 时走进程级增量缓存（返回共享只读 DataFrame）
+    """
+    if not chart_id:
+        return _typed_query("SELECT * FROM annotations")
 
+    chart_id = int(chart_id)
+    with _ann_lock:
+        entry = _ann_cache.get(chart_id)
+        last_id = entry["last_id"] if entry is not None else None
+
+    if last_id is None:
+        fresh = _typed_query(
+            "SELECT * FROM annotations WHERE chart_id = :id ORDER BY annotation_id",
+            {"id": chart_id}
+        )
+    else:
+        fresh = _typed_query(
+            """
+                SELECT * FROM annotations
+                WHERE chart_id = :id AND annotation_id > :last
+                ORDER BY annotation_id
+            """,
+            {"id": chart_id, "last": last_id}
+        )
+
+    with _ann_lock:
+        entry = _ann_cache.get(chart_id)
+        if entry is None:
+            entry = {"df": fresh.reset_index(drop=True), "last_id": 0, "deleted": set()}
+            if not fresh.empty:
+                entry["last_id"] = int(fresh["annotation_id"].max())
+            _ann_cache[chart_id] = entry
+        else:
+            _merge_annotations(entry, fresh)
+        _ann_cache.move_to_end(chart_id)
+        while len(_ann_cache) > _ANNOTATION_CACHE_MAX:
+            _ann_cache.popitem(last=False)
+        return entry["df"]
+
+def merge_annotation_row(df, row):
+    """
+    把一条标注（字典，列同 annotations 表）并入标注 DataFrame，返回新的 DataFrame（不修改原对象）
+    """
+    merged = pd.concat([df, pd.DataFrame([row])], ignore_index=True)
+    return _apply_schema(merged.drop_duplicates("annotation_id", keep="last").reset_index(drop=True))
+
+def _patch_annotation_cache(chart_id, row):
+    """
+    把本进程刚写入的标注直接并入缓存（last_id 不前移，下次增量刷新会用数据库行覆盖它）
+    """
+    with _ann_lock:
+        entry = _ann_cache.get(int(chart_id))
+        if entry is not None:
+            entry["df"] = merge_annotation_row(entry["df"], row)
+
+def _evict_annotation(ann_id):
+    ann_id = int(ann_id)
+    with _ann_lock:
+        for entry in _ann_cache.values():
+            df = entry["df"]
+            if not df.empty and (df["annotation_id"] == ann_id).any():
+                entry["df"] = df[df["annotation_id"] != ann_id].reset_index(drop=True)
+                entry["deleted"].add(ann_id)
+
+def clear_annotation_cache():
+    with _ann_lock:
+        _ann_cache.clear()
+
+# ---------------------------------------------------------
+# 标签规范化表 annotation_tags (annotation_id, tag, chart_id, expert_rating)
+# annotations.tags 仍保存原始逗号字符串；每个标签另存一行，按 (tag, expert_rating, chart_id)
+# 建索引，多标签检索不再需要对 tags 做 LIKE 全表扫描。与标注在同一事务内写入 / 删除。
+# ---------------------------------------------------------
+_INSERT_ANNOTATION_TAGS = """
+    INSERT INTO annotation_tags (annotation_id, tag, chart_id, expert_rating)
+    VALUES (:annotation_id, :tag, :chart_id, :expert_rating)
+"""
+
+# 标注删除监听：listener(tag_rows)，在删除提交后调用，tag_rows 是被删掉的 annotation_tags 行
+# （新增的标注不通知，依赖方按 annotation_id 增量拉取即可，如 recommender 的特征矩阵）
+_delete_listeners = []
+
+def on_annotations_deleted(listener):
+    if listener not in _delete_listeners:
+        _delete_listeners.append(listener)
+
+# 单条标注变更监听：listener(event)，在 add_annotation / delete_annotation 提交后调用
+#   {"op": "add", "chart_id": ..., "row": {annotations 表的一行}}
+#   {"op": "delete", "chart_id": ..., "annotation_id": ...}
+# （批量导入不逐条通知）
+_change_listeners = []
+
+def on_annotation_changed(listener):
+    if listener not in _change_listeners:
+        _change_listeners.append(listener)
+
+def _notify(listeners, payload):
+    for listener in list(listeners):
+        try:
+            listener(payload)
+        except Exception:
+            # 写入已经提交，监听方出错只记日志，不影响调用方
+            logger.exception("标注监听 %r 执行失败", listener)
+
+def _notify_annotation_changed(event):
+    _notify(_change_listeners, event)
+
+def sync_annotation_tags(executor, since=0, chunk_rows=2000):
+    """
+    为 annotation_id > since 且还没有标签行的标注补写 annotation_tags（按主键分块）
+    :param executor: Session 或 Connection（调用方负责提交）
+    :return: (写入的标签行数, 处理到的最大 annotation_id)
+    """
+    written = 0
+    while True:
+        chunk = executor.execute(
+            text(f"""
+                SELECT a.annotation_id, a.chart_id, a.tags, a.expert_rating FROM annotations a
+                WHERE a.annotation_id > :since
+                  AND NOT EXISTS (SELECT 1 FROM annotation_tags t WHERE t.annotation_id = a.annotation_id)
+                ORDER BY a.annotation_id
+                LIMIT {int(chunk_rows)}
+            """),
+            {"since": since}
+        ).mappings().all()
+        if not chunk:
+            return written, since
+        rows = annotation_tag_rows(chunk)
+        if rows:
+            executor.execute(text(_INSERT_ANNOTATION_TAGS), rows)
+            written += len(rows)
+        since = int(chunk[-1]["annotation_id"])
+
+@perf_monitor.timed_query
 def add_annotation(data_dict):
+    data_dict = _py(data_dict)
     conn = get_connection()
     with conn.session as s:
-        s.execute(
+        result = s.execute(
             text("""
                 INSERT INTO annotations 
                 (chart_id, chart_name, difficulty, start_section, end_section,
@@ -78,51 +698,590 @@ def add_annotation(data_dict):
             """),
             data_dict
         )
+        new_id = result.lastrowid
+        if new_id:
+            tag_rows = annotation_tag_rows([{**data_dict, "annotation_id": new_id}])
+            if tag_rows:
+                s.execute(text(_INSERT_ANNOTATION_TAGS), tag_rows)
+        _apply_section_deltas(s, [data_dict], +1)
         s.commit()
 
+    if new_id:
+        row = {
+            "annotation_id": int(new_id),
+            "chart_id": int(data_dict["chart_id"]),
+            "chart_name": data_dict["chart_name"],
+            "difficulty": data_dict["difficulty"],
+            "start_section": data_dict["start_section"],
+            "end_section": data_dict["end_section"],
+            "tags": data_dict["tags"],
+            "desc_text": data_dict["desc"],
+            "expert_rating": data_dict["expert_rating"],
+            "annotator": data_dict["annotator"],
+        }
+        _patch_annotation_cache(data_dict["chart_id"], row)
+        _notify_annotation_changed({"op": "add", "chart_id": row["chart_id"], "row": row})
+    return new_id
+
+@perf_monitor.timed_query
 def delete_annotation(ann_id):
     conn = get_connection()
     with conn.session as s:
+        lock = " FOR UPDATE" if _dialect() == "mysql" else ""
+        row = s.execute(
+            text("""
+                SELECT chart_id, start_section, end_section, tags, expert_rating, annotator
+                FROM annotations WHERE annotation_id = :id
+            """ + lock),
+            {"id": ann_id}
+        ).mappings().first()
+        tag_rows = s.execute(
+            text("SELECT annotation_id, tag, chart_id, expert_rating FROM annotation_tags WHERE annotation_id = :id"),
+            {"id": ann_id}
+        ).mappings().all()
+        s.execute(text("DELETE FROM annotation_tags WHERE annotation_id = :id"), {"id": ann_id})
         s.execute(text("DELETE FROM annotations WHERE annotation_id = :id"), {"id": ann_id})
+        if row is not None:
+            _apply_section_deltas(s, [dict(row)], -1)
         s.commit()
+    _evict_annotation(ann_id)
+    if tag_rows:
+        _notify(_delete_listeners, [dict(r) for r in tag_rows])
+    if row is not None:
+        _notify_annotation_changed({"op": "delete", "chart_id": int(row["chart_id"]), "annotation_id": int(ann_id)})
+
+@perf_monitor.timed_query
+def add_annotations_bulk(rows, chunk_size=None):
+    """
+    批量写入标注（executemany，按块提交），字段同 add_annotation
+    新行会在下次 get_annotations 增量刷新时自动进入缓存
+    executemany 拿不到各行的自增 ID，标签行在每块提交前按「本批开始后的新 ID」补写
+    :return: 写入行数
+    """
+    with get_connection().session as s:
+        since = {"id": s.execute(text("SELECT COALESCE(MAX(annotation_id), 0) FROM annotations")).scalar()}
+
+    def write_tags(s, chunk):
+        _, since["id"] = sync_annotation_tags(s, since["id"])
+        _apply_section_deltas(s, chunk, +1)
+
+    return _bulk_insert(
+        """
+            INSERT INTO annotations
+            (chart_id, chart_name, difficulty, start_section, end_section,
+             tags, desc_text, expert_rating, annotator)
+            VALUES (:chart_id, :chart_name, :difficulty, :start_section,
+                    :end_section, :tags, :desc, :expert_rating, :annotator)
+        """,
+        (_py(row) for row in rows),
+        chunk_size or BULK_CHUNK_SIZE,
+        after_chunk=write_tags
+    )
+
+@perf_monitor.timed_query
+def search_charts_by_tags(tags, min_rating=None, match_all=True, difficulties=None,
+                          level_range=None, limit=100):
+    """
+    按技术标签组合检索谱面（一条走 annotation_tags 索引的查询）
+    :param tags: 标签列表（至少一个）
+    :param min_rating: 只统计专家评分 >= 该值的标注，None 表示不限
+    :param match_all: True 要求谱面包含全部标签，False 命中任一即可
+    :param difficulties: 难度列表，None 表示不过滤
+    :param level_range: (最低等级, 最高等级)，None 表示不过滤
+    :return: DataFrame[song_id, song_name, difficulty, level, chart_image_path,
+             matched_tags, annotation_hits, best_rating]，命中标签多、标注多的在前
+    """
+    columns = ["song_id", "song_name", "difficulty", "level", "chart_image_path",
+               "matched_tags", "annotation_hits", "best_rating"]
+    tags = list(dict.fromkeys(tags or []))
+    if not tags or (difficulties is not None and len(difficulties) == 0):
+        return pd.DataFrame(columns=columns)
+
+    keys = [f"t{i}" for i in range(len(tags))]
+    params = dict(zip(keys, tags))
+    tag_where = ["tag IN (" + ", ".join(":" + k for k in keys) + ")"]
+    if min_rating is not None:
+        tag_where.append("expert_rating >= :rating")
+        params["rating"] = int(min_rating)
+    params["need"] = len(tags) if match_all else 1
+
+    chart_where = []
+    if difficulties is not None:
+        dkeys = [f"d{i}" for i in range(len(difficulties))]
+        chart_where.append("c.difficulty IN (" + ", ".join(":" + k for k in dkeys) + ")")
+        params.update(zip(dkeys, difficulties))
+    if level_range is not None:
+        chart_where.append("c.level BETWEEN :lv_min AND :lv_max")
+        params["lv_min"], params["lv_max"] = int(level_range[0]), int(level_range[1])
+
+    sql = f"""
+        SELECT c.song_id, c.song_name, c.difficulty, c.level, c.chart_image_path,
+               m.matched_tags, m.annotation_hits, m.best_rating
+        FROM (
+            SELECT chart_id, COUNT(DISTINCT tag) AS matched_tags,
+                   COUNT(DISTINCT annotation_id) AS annotation_hits, MAX(expert_rating) AS best_rating
+            FROM annotation_tags
+            WHERE {" AND ".join(tag_where)}
+            GROUP BY chart_id
+            HAVING COUNT(DISTINCT tag) >= :need
+        ) m
+        JOIN charts c ON c.song_id = m.chart_id
+        {"WHERE " + " AND ".join(chart_where) if chart_where else ""}
+        ORDER BY m.matched_tags DESC, m.annotation_hits DESC, c.song_id
+        LIMIT {int(limit)}
+    """
+    return _typed_query(sql, params)
+
+# =========================================================
+# 4.1 谱面段落汇总表（社区共识热力图）
+#   chart_section_stats      (chart_id, section, annotation_count, rating_sum, rating_count)
+#   chart_section_tags       (chart_id, section, tag, hits)
+#   chart_section_annotators (chart_id, section, annotator, annotation_count)
+# 一条标注覆盖的每个段落各计一次，与标注在同一事务内按 ±1 增量维护；
+# 标注页只按 chart_id 读这几张小表，不再逐条渲染标注。
+# =========================================================
+def _annotation_sections(a):
+    start, end = a.get("start_section"), a.get("end_section")
+    if start is None or end is None or pd.isna(start) or pd.isna(end):
+        return range(0)
+    start, end = int(start), int(end)
+    return range(start, min(end, start + MAX_ANNOTATION_SPAN - 1) + 1)
+
+def _apply_section_deltas(s, annotations, sign, dialect=None):
+    """
+    把一批标注（dict，含 chart_id / start_section / end_section / tags / expert_rating / annotator）
+    对段落汇总表的增量写入 s；sign=-1 表示删除
+    """
+    stats, tags, annotators = {}, {}, {}
+    for a in annotations:
+        chart = int(a["chart_id"])
+        rating = a.get("expert_rating")
+        rated = rating is not None and not pd.isna(rating)
+        tag_list = split_tags(a.get("tags"))
+        who = a.get("annotator") or ""
+        for sec in _annotation_sections(a):
+            n, r_sum, r_cnt = stats.get((chart, sec), (0, 0, 0))
+            stats[(chart, sec)] = (n + 1, r_sum + (int(rating) if rated else 0), r_cnt + int(rated))
+            for tag in tag_list:
+                tags[(chart, sec, tag)] = tags.get((chart, sec, tag), 0) + 1
+            annotators[(chart, sec, who)] = annotators.get((chart, sec, who), 0) + 1
+    if not stats:
+        return
+
+    s.execute(
+        text(_upsert_add_sql("chart_section_stats", ["chart_id", "section"],
+                             ["annotation_count", "rating_sum", "rating_count"], dialect=dialect)),
+        [{"chart_id": c, "section": sec, "annotation_count": sign * n,
+          "rating_sum": sign * r_sum, "rating_count": sign * r_cnt}
+         for (c, sec), (n, r_sum, r_cnt) in sorted(stats.items())]
+    )
+    if tags:
+        s.execute(
+            text(_upsert_add_sql("chart_section_tags", ["chart_id", "section", "tag"], ["hits"], dialect=dialect)),
+            [{"chart_id": c, "section": sec, "tag": t, "hits": sign * n}
+             for (c, sec, t), n in sorted(tags.items())]
+        )
+    s.execute(
+        text(_upsert_add_sql("chart_section_annotators", ["chart_id", "section", "annotator"],
+                             ["annotation_count"], dialect=dialect)),
+        [{"chart_id": c, "section": sec, "annotator": who, "annotation_count": sign * n}
+         for (c, sec, who), n in sorted(annotators.items())]
+    )
+    if sign < 0:
+        charts = [{"c": c} for c in sorted({c for c, _ in stats})]
+        s.execute(text("DELETE FROM chart_section_stats WHERE chart_id = :c AND annotation_count <= 0"), charts)
+        s.execute(text("DELETE FROM chart_section_tags WHERE chart_id = :c AND hits <= 0"), charts)
+        s.execute(text("DELETE FROM chart_section_annotators WHERE chart_id = :c AND annotation_count <= 0"), charts)
+
+def rebuild_chart_section_stats(executor, chunk_rows=2000):
+    """
+    从全部标注重建段落汇总表（按主键分块累加）
+    :param executor: Session 或 Connection（调用方负责提交）
+    :return: 参与统计的标注数
+    """
+    dialect = executor.get_bind().dialect.name if hasattr(executor, "get_bind") else executor.dialect.name
+    for table in ("chart_section_stats", "chart_section_tags", "chart_section_annotators"):
+        executor.execute(text(f"DELETE FROM {table}"))
+    since, total = 0, 0
+    while True:
+        chunk = executor.execute(
+            text(f"""
+                SELECT annotation_id, chart_id, start_section, end_section, tags, expert_rating, annotator
+                FROM annotations WHERE annotation_id > :since
+                ORDER BY annotation_id LIMIT {int(chunk_rows)}
+            """),
+            {"since": since}
+        ).mappings().all()
+        if not chunk:
+            return total
+        _apply_section_deltas(executor, chunk, +1, dialect=dialect)
+        total += len(chunk)
+        since = int(chunk[-1]["annotation_id"])
+
+@perf_monitor.timed_query
+def get_chart_section_stats(chart_id):
+    """
+    某张谱面按段落汇总的社区标注（只读汇总表，按主键前缀查询）
+    :return: {"sections": (section, annotation_count, annotator_count, consensus_rating),
+              "tags": (section, tag, hits)}
+    """
+    params = {"c": int(chart_id)}
+    sections = _typed_query(
+        """
+            SELECT section, annotation_count, rating_sum, rating_count FROM chart_section_stats
+            WHERE chart_id = :c ORDER BY section
+        """,
+        params
+    )
+    annotators = _typed_query(
+        """
+            SELECT section, COUNT(*) AS annotator_count FROM chart_section_annotators
+            WHERE chart_id = :c GROUP BY section
+        """,
+        params
+    )
+    sections = sections.merge(annotators, on="section", how="left")
+    sections["annotator_count"] = sections["annotator_count"].fillna(0).astype("int64")
+    sections["consensus_rating"] = sections["rating_sum"] / sections["rating_count"].where(sections["rating_count"] > 0)
+    tags = _typed_query(
+        "SELECT section, tag, hits FROM chart_section_tags WHERE chart_id = :c ORDER BY section",
+        params
+    )
+    return {
+        "sections": sections[["section", "annotation_count", "annotator_count", "consensus_rating"]],
+        "tags": tags,
+    }
 
 # =========================================================
 # 5. 游玩记录管理（新版：score + rating + comment）
 # =========================================================
 
+@perf_monitor.timed_query
 def add_play_record(data):
     """
     新版打歌记录（practice_count + miss_section + cause + comment）
+    写入时用弱点引擎把失误段落映射成技术标签，同一事务内更新报告汇总表
     """
+    data = _py(data)
+    data["detected_tags"] = _detect_record_tags(
+        pd.DataFrame([data]), get_annotations(chart_id=data["chart_id"])
+    )[0]
     conn = get_connection()
     with conn.session as s:
         s.execute(
             text(""" 
                 INSERT INTO play_records (username, chart_id, song_name, difficulty, level,
-                                          practice_count, miss_section, cause, comment)
+                                          practice_count, miss_section, cause, comment, detected_tags)
                 VALUES (:username, :chart_id, :song_name, :difficulty, :level,
-                        :practice_count, :miss_section, :cause, :comment)
+                        :practice_count, :miss_section, :cause, :comment, :detected_tags)
             """),
             data
         )
+        _apply_report_deltas(s, [data], +1)
         s.commit()
 
+@perf_monitor.timed_query
 def delete_play_record(record_id):
     conn = get_connection()
     with conn.session as s:
+        lock = " FOR UPDATE" if _dialect() == "mysql" else ""
+        row = s.execute(
+            text("""
+                SELECT username, cause, miss_count, practice_count, detected_tags, play_time
+                FROM play_records WHERE record_id = :id
+            """ + lock),
+            {"id": record_id}
+        ).mappings().first()
         s.execute(
             text("DELETE FROM play_records WHERE record_id = :id"),
             {"id": record_id}
         )
+        if row is not None:
+            _apply_report_deltas(s, [dict(row)], -1)
+        s.commit()
+
+@perf_monitor.timed_query
+def add_play_records_bulk(records, chunk_size=None):
+    """
+    批量写入打歌记录（executemany，按块提交），字段同 add_play_record
+    可额外带 play_time（历史记录导入用），为空时取数据库当前时间；
+    client_key 为后写队列的幂等键（重放时按它查重），没有时为空
+    :return: 写入行数
+    """
+    def tagged(chunks):
+        # 每块一次 IN 查询取标注，整块向量化计算 detected_tags
+        for chunk in chunks:
+            frame = pd.DataFrame(chunk)
+            tags = _detect_record_tags(frame, _annotations_for_charts(frame["chart_id"].dropna().unique()))
+            for row, tag in zip(chunk, tags):
+                yield {"play_time": None, "client_key": None, **row, "detected_tags": tag}
+
+    size = chunk_size or BULK_CHUNK_SIZE
+    return _bulk_insert(
+        """
+            INSERT INTO play_records (username, chart_id, song_name, difficulty, level,
+                                      practice_count, miss_section, cause, comment, detected_tags,
+                                      play_time, client_key)
+            VALUES (:username, :chart_id, :song_name, :difficulty, :level,
+                    :practice_count, :miss_section, :cause, :comment, :detected_tags,
+                    COALESCE(:play_time, CURRENT_TIMESTAMP), :client_key)
+        """,
+        tagged(_iter_chunks((_py(r) for r in records), size)),
+        size,
+        after_chunk=lambda s, chunk: _apply_report_deltas(s, chunk, +1)
+    )
+
+# 历史记录表格展示的列（record_id 用作分页游标）
+HISTORY_COLUMNS = ("record_id", "song_name", "difficulty", "level", "practice_count",
+                   "miss_section", "cause", "comment", "play_time")
+HISTORY_ORDER = (("play_time", "DESC"), ("record_id", "DESC"))
+
+@perf_monitor.timed_query
+def get_play_records_page(username, cursor=None, limit=20):
+    """
+    分页获取用户的历史记录（按时间倒序，键集分页走 (username, play_time) 索引）
+    :param cursor: 上一页返回的游标 (play_time, record_id)，None 表示第一页
+    :return: (当前页 DataFrame, 下一页游标 或 None)
+    """
+    params = {"u": username}
+    sql = f"SELECT {', '.join(HISTORY_COLUMNS)} FROM play_records WHERE username = :u"
+    if cursor is not None:
+        sql += " AND " + _keyset_condition(HISTORY_ORDER, cursor, params)
+    sql += " ORDER BY " + ", ".join(f"{c} {d}" for c, d in HISTORY_ORDER)
+    sql += f" LIMIT {int(limit) + 1}"
+
+    page = _typed_query(sql, params)
+    next_cursor = None
+    if len(page) > limit:
+        page = page.iloc[:limit]
+        last = page.iloc[-1]
+        next_cursor = (_cursor_value(last["play_time"]), int(last["record_id"]))
+    return page, next_cursor
+
+@perf_monitor.timed_query
+def count_play_records(username):
+    """
+    用户的记录总数（从按天汇总表求和，不扫描 play_records）；
+    汇总表里还没有该用户时退回按 (username, play_time) 索引计数
+    """
+    params = {"u": username}
+    df = _read_sql(
+        "SELECT COUNT(*) AS days, COALESCE(SUM(record_count), 0) AS n FROM user_daily_stats WHERE username = :u",
+        params=params
+    )
+    if int(df.iloc[0]["days"]):
+        return int(df.iloc[0]["n"])
+    df = _read_sql("SELECT COUNT(*) AS n FROM play_records WHERE username = :u", params=params)
+    return int(df.iloc[0]["n"])
+
+def _annotations_for_charts(chart_ids):
+    """
+    一次 IN 查询取多张谱面的标注区间（弱点引擎用，只取需要的列）
+    """
+    chart_ids = [int(c) for c in chart_ids]
+    if not chart_ids:
+        return pd.DataFrame(columns=["chart_id", "start_section", "end_section", "tags"])
+    keys = [f"c{i}" for i in range(len(chart_ids))]
+    return _read_sql(
+        "SELECT chart_id, start_section, end_section, tags FROM annotations WHERE chart_id IN ("
+        + ", ".join(":" + k for k in keys) + ")",
+        params=dict(zip(keys, chart_ids))
+    )
+
+def _detect_record_tags(records, annotations):
+    """
+    records 需含 chart_id / miss_section，返回 detected_tags 字符串列表
+    """
+    records = records.reindex(columns=["chart_id", "miss_section"])
+    return weakness_engine.detect_tags(records, annotations).tolist()
+
+# =========================================================
+# 5.1 报告汇总表（随打歌记录增删在同一事务内增量维护）
+#   user_tag_stats   (username, tag, miss_total)
+#   user_cause_stats (username, cause, record_count)
+#   user_daily_stats (username, play_date, miss_total, practice_total, record_count)
+# =========================================================
+def _record_tags(record):
+    tags = record.get("detected_tags") or ""
+    return [t.strip() for t in str(tags).split(",") if t.strip() and t.strip() != NO_TAG]
+
+def _record_misses(record):
+    # 新版记录每条代表一次失误；旧版记录自带 miss_count
+    miss = record.get("miss_count")
+    return 1 if miss is None or pd.isna(miss) else int(miss)
+
+def _apply_report_deltas(s, records, sign):
+    """
+    把一批记录折算成汇总表的增量（sign=+1 写入 / -1 删除），调用方负责提交
+    """
+    tag_delta, cause_delta, daily_delta = {}, {}, {}
+    for r in records:
+        user = r["username"]
+        miss = _record_misses(r)
+        for tag in _record_tags(r):
+            key = (user, tag)
+            tag_delta[key] = tag_delta.get(key, 0) + miss
+        if r.get("cause"):
+            key = (user, r["cause"])
+            cause_delta[key] = cause_delta.get(key, 0) + 1
+        # 未指定时间的记录落在数据库当前日期
+        play_time = r.get("play_time")
+        day = None if play_time is None or pd.isna(play_time) else pd.Timestamp(play_time).date()
+        m, p, c = daily_delta.get((user, day), (0, 0, 0))
+        daily_delta[(user, day)] = (m + miss, p + int(r.get("practice_count") or 0), c + 1)
+
+    if tag_delta:
+        s.execute(
+            text(_upsert_add_sql("user_tag_stats", ["username", "tag"], ["miss_total"])),
+            [{"username": u, "tag": t, "miss_total": sign * m} for (u, t), m in tag_delta.items()]
+        )
+    if cause_delta:
+        s.execute(
+            text(_upsert_add_sql("user_cause_stats", ["username", "cause"], ["record_count"])),
+            [{"username": u, "cause": c, "record_count": sign * n} for (u, c), n in cause_delta.items()]
+        )
+    if daily_delta:
+        s.execute(
+            text(_upsert_add_sql(
+                "user_daily_stats", ["username", "play_date"],
+                ["miss_total", "practice_total", "record_count"],
+                values={"play_date": "DATE(COALESCE(:play_date, CURRENT_TIMESTAMP))"}
+            )),
+            [{"username": u, "play_date": d, "miss_total": sign * m,
+              "practice_total": sign * p, "record_count": sign * n}
+             for (u, d), (m, p, n) in daily_delta.items()]
+        )
+    if sign < 0:
+        users = {"u": records[0]["username"]}
+        s.execute(text("DELETE FROM user_tag_stats WHERE username = :u AND miss_total <= 0"), users)
+        s.execute(text("DELETE FROM user_cause_stats WHERE username = :u AND record_count <= 0"), users)
+        s.execute(text("DELETE FROM user_daily_stats WHERE username = :u AND record_count <= 0"), users)
+
+@perf_monitor.timed_query
+def get_user_report_stats(username):
+    """
+    读取报告汇总表（只有几十行，不扫描原始记录）
+    :return: {"tags": (tag, miss_total), "causes": (cause, record_count),
+              "daily": (play_date, miss_total, practice_total, record_count)}
+    """
+    params = {"u": username}
+    return {
+        "tags": _read_sql("SELECT tag, miss_total FROM user_tag_stats WHERE username = :u", params=params),
+        "causes": _read_sql("SELECT cause, record_count FROM user_cause_stats WHERE username = :u", params=params),
+        "daily": _read_sql(
+            """
+                SELECT play_date, miss_total, practice_total, record_count
+                FROM user_daily_stats WHERE username = :u ORDER BY play_date
+            """,
+            params=params
+        ),
+    }
+
+@perf_monitor.timed_query
+def rebuild_user_report_stats(username):
+    """
+    从原始记录重建某个用户的汇总表（首次启用或数据被直接修改后使用）
+    :return: 参与统计的记录数
+    """
+    with get_connection().session as s:
+        total = _rebuild_report_stats(s, username)
         s.commit()
+    return total
+
+def backfill_user_report_stats(executor):
+    """
+    为有打歌记录、但汇总表里还没有数据的用户逐个重建汇总（迁移用，可重复执行）
+    :param executor: Session 或 Connection（调用方负责提交）
+    :return: 重建的用户数
+    """
+    users = executor.execute(text("""
+        SELECT DISTINCT username FROM play_records
+        WHERE username IS NOT NULL
+          AND username NOT IN (SELECT DISTINCT username FROM user_daily_stats)
+    """)).scalars().all()
+    for username in users:
+        _rebuild_report_stats(executor, username)
+    return len(users)
+
+def _rebuild_report_stats(s, username):
+    """
+    rebuild_user_report_stats 的实际步骤（在调用方的事务里执行，不提交）
+    """
+    params = {"u": username}
+    for table in ("user_tag_stats", "user_cause_stats", "user_daily_stats"):
+        s.execute(text(f"DELETE FROM {table} WHERE username = :u"), params)
+    s.execute(
+        text("""
+            INSERT INTO user_cause_stats (username, cause, record_count)
+            SELECT username, cause, COUNT(*) FROM play_records
+            WHERE username = :u AND cause IS NOT NULL AND cause <> ''
+            GROUP BY username, cause
+        """),
+        params
+    )
+    s.execute(
+        text("""
+            INSERT INTO user_daily_stats (username, play_date, miss_total, practice_total, record_count)
+            SELECT username, DATE(play_time), SUM(COALESCE(miss_count, 1)),
+                   SUM(COALESCE(practice_count, 0)), COUNT(*)
+            FROM play_records
+            WHERE username = :u AND play_time IS NOT NULL
+            GROUP BY username, DATE(play_time)
+        """),
+        params
+    )
+    # 技术标签：有 chart_id + miss_section 的记录用弱点引擎按当前标注整段重算，
+    # 并把结果写回 play_records.detected_tags（删除记录时按存储的标签扣减，两边必须一致）；
+    # 旧版记录（没有谱面 ID）沿用当时保存的 detected_tags
+    history = pd.DataFrame(s.execute(
+        text("""
+            SELECT record_id, chart_id, miss_section, COALESCE(miss_count, 1) AS miss_count, detected_tags
+            FROM play_records WHERE username = :u
+        """),
+        params
+    ).mappings().all(), columns=["record_id", "chart_id", "miss_section", "miss_count", "detected_tags"])
+    tag_totals = {}
+    if not history.empty:
+        mapped = history["chart_id"].notna() & history["miss_section"].notna()
+        annotations = pd.DataFrame(s.execute(
+            text("""
+                SELECT chart_id, start_section, end_section, tags FROM annotations
+                WHERE chart_id IN (SELECT DISTINCT chart_id FROM play_records WHERE username = :u)
+            """),
+            params
+        ).mappings().all(), columns=["chart_id", "start_section", "end_section", "tags"])
+        masks = weakness_engine.record_masks(history[mapped], annotations)
+        engine_totals = weakness_engine.tag_miss_totals(masks, history.loc[mapped, "miss_count"])
+        recomputed = pd.Series(masks_to_strings(masks), index=history.index[mapped])
+        stale = recomputed != history.loc[mapped, "detected_tags"]
+        if stale.any():
+            s.execute(
+                text("UPDATE play_records SET detected_tags = :t WHERE record_id = :id"),
+                [{"t": t, "id": int(i)} for i, t in zip(history.loc[stale[stale].index, "record_id"], recomputed[stale])]
+            )
+        tag_totals = dict(zip(engine_totals["tag"], engine_totals["miss_count"]))
+        for r in history[~mapped].to_dict("records"):
+            for tag in _record_tags(r):
+                tag_totals[tag] = tag_totals.get(tag, 0) + int(r["miss_count"])
+    if tag_totals:
+        s.execute(
+            text("INSERT INTO user_tag_stats (username, tag, miss_total) VALUES (:u, :t, :m)"),
+            [{"u": username, "t": t, "m": m} for t, m in tag_totals.items()]
+        )
+    total = s.execute(
+        text("SELECT COALESCE(SUM(record_count), 0) FROM user_daily_stats WHERE username = :u"), params
+    ).scalar()
+    return int(total)
 
 # =========================================================
 # 6. 旧版「miss 统计」系统（保留）
 # =========================================================
+@perf_monitor.timed_query
 def add_old_play_record(data_dict):
     """
     旧版 miss 记录（保留以兼容旧功能）
     """
+    data_dict = _py(data_dict)
     conn = get_connection()
     with conn.session as s:
         s.execute(
@@ -133,19 +1292,20 @@ def add_old_play_record(data_dict):
             """),
             data_dict
         )
+        _apply_report_deltas(s, [{
+            "username": data_dict["u"], "cause": data_dict.get("cause"),
+            "miss_count": data_dict.get("mc"), "detected_tags": data_dict.get("tags"),
+        }], +1)
         s.commit()
 
+@perf_monitor.timed_query
 def get_old_play_records(username):
-    conn = get_connection()
-    return conn.query(
-        "SELECT * FROM play_records WHERE username = :u AND score IS NULL",
-        params={"u": username},
-        ttl=0
-    )
+    return _typed_query("SELECT * FROM play_records WHERE username = :u AND score IS NULL", {"u": username})
 
 # =========================================================
 # 7. 用户反馈
 # =========================================================
+@perf_monitor.timed_query
 def add_feedback(username, feedback_type, content):
     conn = get_connection()
     with conn.session as s:
@@ -154,26 +1314,132 @@ def add_feedback(username, feedback_type, content):
                 INSERT INTO user_feedback (username, feedback_type, content)
                 VALUES (:u, :t, :c)
             """),
-            {"u": username, "t": feedback_type, "c": content}
+            _py({"u": username, "t": feedback_type, "c": content})
         )
         s.commit()
 
+@perf_monitor.timed_query
+def add_feedbacks_bulk(rows, chunk_size=None):
+    """
+    批量写入反馈（write_behind 后台刷写用）
+    :param rows: dict(username, feedback_type, content, created_at 可选，为空时取数据库当前时间，
+                 client_key 可选，后写队列的幂等键)
+    :return: 写入行数
+    """
+    return _bulk_insert(
+        """
+            INSERT INTO user_feedback (username, feedback_type, content, created_at, client_key)
+            VALUES (:username, :feedback_type, :content, COALESCE(:created_at, CURRENT_TIMESTAMP), :client_key)
+        """,
+        ({"created_at": None, "client_key": None, **_py(row)} for row in rows),
+        chunk_size or BULK_CHUNK_SIZE
+    )
+
+@perf_monitor.timed_query
 def get_play_records(username):
     """
     获取用户的历史记录（按时间倒序）
     """
-    try:
-        conn = get_connection()
-        query = """
-            SELECT record_id, username, song_name, difficulty, level,
-                   practice_count, miss_section, cause, comment, play_time
-            FROM play_records
-            WHERE username = :u
-            ORDER BY play_time DESC
-        """
-        df = conn.query(query, params={"u": username}, ttl=0)
-        return df
-    except Exception as e:
-        print("Error get_play_records:", e)
-        return pd.DataFrame()
+    query = """
+        SELECT record_id, username, song_name, difficulty, level,
+               practice_count, miss_section, cause, comment, play_time
+        FROM play_records
+        WHERE username = :u
+        ORDER BY play_time DESC
+    """
+    return _typed_query(query, {"u": username})
+
+
+# =========================================================
+# 8. 数据导出（分块读取，任何时刻只有一块在内存里）
+# =========================================================
+# 说明：SQLAlchemy 对 mysql-connector 关闭了服务端游标（stream_results 会退化成
+# 整个结果集先缓冲到客户端），所以这里按索引顺序做键集分块，每块一次短查询。
+EXPORT_CHUNK_ROWS = 5000
+
+PLAY_RECORD_EXPORT_COLUMNS = ("record_id", "chart_id", "song_name", "difficulty", "level", "practice_count",
+                              "miss_section", "miss_count", "cause", "detected_tags", "comment",
+                              "chart_name", "notes", "play_time")
+
+def _cursor_value(value):
+    if isinstance(value, pd.Timestamp):
+        return str(value)
+    return value.item() if hasattr(value, "item") else value
+
+def _iter_keyset(table, columns, where, params, order, chunk_rows):
+    """
+    按 order 分块读取 table，逐块 yield DataFrame
+    """
+    cursor = None
+    while True:
+        chunk_params = dict(params)
+        conditions = list(where)
+        if cursor is not None:
+            conditions.append(_keyset_condition(order, cursor, chunk_params))
+        sql = f"SELECT {columns} FROM {table}"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY " + ", ".join(f"{c} {d}" for c, d in order) + f" LIMIT {int(chunk_rows)}"
+
+        chunk = _typed_query(sql, chunk_params)
+        if chunk.empty:
+            return
+        yield chunk
+        if len(chunk) < chunk_rows:
+            return
+        last = chunk.iloc[-1]
+        cursor = tuple(_cursor_value(last[c]) for c, _ in order)
+
+def iter_play_records(username, chunk_rows=EXPORT_CHUNK_ROWS):
+    """
+    分块读取某个用户的全部打歌记录（按时间倒序，走 (username, play_time) 索引）
+    """
+    return _iter_keyset(
+        "play_records", ", ".join(PLAY_RECORD_EXPORT_COLUMNS), ["username = :u"], {"u": username},
+        HISTORY_ORDER, chunk_rows
+    )
 
+def iter_annotations(chart_id=None, chunk_rows=EXPORT_CHUNK_ROWS):
+    """
+    分块读取标注（chart_id 为 None 时导出全部，按 annotation_id 顺序）
+    """
+    where, params = [], {}
+    if chart_id is not None:
+        where.append("chart_id = :id")
+        params["id"] = int(chart_id)
+    return _iter_keyset("annotations", "*", where, params, (("annotation_id", "ASC"),), chunk_rows)
+
+# =========================================================
+# 9. 查询结果内存报告（对比列类型转换前后的占用）
+# =========================================================
+# (名称, 作用范围, SQL, 是否按用户查询)；进程共享的结果所有会话共用一份，每会话的结果随会话数线性增长
+MEMORY_REPORT_QUERIES = (
+    ("谱面目录", "进程共享", "SELECT * FROM charts", False),
+    ("全部标注", "进程共享", "SELECT * FROM annotations", False),
+    ("打歌记录", "每会话", """
+        SELECT record_id, username, song_name, difficulty, level,
+               practice_count, miss_section, cause, comment, play_time
+        FROM play_records WHERE username = :u ORDER BY play_time DESC
+    """, True),
+    ("导出块", "每会话", f"""
+        SELECT {', '.join(PLAY_RECORD_EXPORT_COLUMNS)} FROM play_records
+        WHERE username = :u ORDER BY play_time DESC LIMIT {EXPORT_CHUNK_ROWS}
+    """, True),
+)
+
+@perf_monitor.timed_query
+def dataframe_memory_report(username):
+    """
+    典型查询的结果分别按原始类型 / 显式类型 / 显式类型 + Arrow 字符串计算内存占用（deep=True）
+    :return: DataFrame(query, scope, rows, raw_bytes, typed_bytes, arrow_bytes)
+    """
+    rows = []
+    for name, scope, sql, per_user in MEMORY_REPORT_QUERIES:
+        raw = _read_sql(sql, params={"u": username} if per_user else {})
+        rows.append({
+            "query": name, "scope": scope, "rows": len(raw),
+            "raw_bytes": int(raw.memory_usage(deep=True).sum()),
+            "typed_bytes": int(_apply_schema(raw.copy(), arrow=False).memory_usage(deep=True).sum()),
+            "arrow_bytes": int(_apply_schema(raw.copy(), arrow=True).memory_usage(deep=True).sum()),
+        })
+    return pd.DataFrame(rows)
@@ -0,0 +1,116 @@
+import os
+import tempfile
+import time
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# =========================================================
+# 数据导出：把分块读取的 DataFrame 逐块写进临时文件（CSV / Parquet）
+# 内存里同时只有一块数据，写完后由页面把文件交给下载按钮
+# =========================================================
+EXPORT_DIR = os.path.join(tempfile.gettempdir(), "rhythmcoach_exports")
+EXPORT_TTL = 3600        # 临时导出文件保留时间（秒）
+
+# 格式 -> (扩展名, MIME)
+FORMATS = {
+    "CSV": ("csv", "text/csv"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet"),
+}
+
+def _cleanup_stale():
+    """
+    删除超过 EXPORT_TTL 的旧导出文件（每次导出前顺手清理）
+    """
+    now = time.time()
+    for name in os.listdir(EXPORT_DIR):
+        path = os.path.join(EXPORT_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > EXPORT_TTL:
+                os.remove(path)
+        except OSError:
+            pass
+
+def write_csv(chunks, path):
+    """
+    逐块追加写 CSV（utf-8-sig，Excel 直接打开不乱码），返回行数
+    """
+    rows = 0
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        for chunk in chunks:
+            chunk.to_csv(f, index=False, header=rows == 0)
+            rows += len(chunk)
+    return rows
+
+def _arrow_schema(chunk):
+    """
+    以第一块推断 Parquet 表结构：文本列一律 string，整型列用 int64（允许空值），
+    避免后面的块因为全空 / 带空值导致类型对不上
+    """
+    fields = []
+    for name, dtype in chunk.dtypes.items():
+        if pd.api.types.is_datetime64_any_dtype(dtype):
+            arrow_type = pa.timestamp("us")
+        elif pd.api.types.is_bool_dtype(dtype):
+            arrow_type = pa.bool_()
+        elif pd.api.types.is_integer_dtype(dtype):
+            arrow_type = pa.int64()
+        elif pd.api.types.is_float_dtype(dtype):
+            arrow_type = pa.float64()
+        else:
+            arrow_type = pa.string()
+        fields.append(pa.field(name, arrow_type))
+    return pa.schema(fields)
+
+def _to_arrow(chunk, schema):
+    arrays = []
+    for field in schema:
+        column = chunk[field.name]
+        if pa.types.is_string(field.type):
+            column = column.astype(object).where(column.notna(), None).map(
+                lambda v: v if v is None or isinstance(v, str) else str(v)
+            )
+        elif pa.types.is_timestamp(field.type):
+            column = pd.to_datetime(column, errors="coerce")
+        elif pa.types.is_integer(field.type):
+            column = pd.to_numeric(column, errors="coerce").astype("Int64")
+        arrays.append(pa.array(column, type=field.type, from_pandas=True))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+def write_parquet(chunks, path):
+    """
+    逐块写 Parquet（每块一个 row group），返回行数
+    """
+    rows, writer = 0, None
+    try:
+        for chunk in chunks:
+            if writer is None:
+                schema = _arrow_schema(chunk)
+                writer = pq.ParquetWriter(path, schema, compression="zstd")
+            writer.write_table(_to_arrow(chunk, schema))
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+def export_to_file(chunks, fmt, prefix):
+    """
+    :param chunks: DataFrame 生成器（如 db.iter_play_records）
+    :param fmt: FORMATS 中的键
+    :return: (文件路径, 行数)；没有数据时返回 (None, 0)
+    """
+    ext, _ = FORMATS[fmt]
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    _cleanup_stale()
+    fd, path = tempfile.mkstemp(prefix=f"{prefix}_", suffix=f".{ext}", dir=EXPORT_DIR)
+    os.close(fd)
+    try:
+        rows = write_csv(chunks, path) if fmt == "CSV" else write_parquet(chunks, path)
+    except Exception:
+        os.remove(path)
+        raise
+    if rows == 0:
+        os.remove(path)
+        return None, 0
+    return path, rows
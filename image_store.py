@@ -0,0 +1,445 @@
+import argparse
+import email.utils
+import hashlib
+import io
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import cloudinary
+import cloudinary.uploader
+import streamlit as st
+from PIL import Image
+
+# =========================================================
+# 图片存储后端：Cloudinary 图床 / 本地内容寻址存储
+# charts.chart_image_path 与 chart_assets 里保存的是「引用」，引用本身说明了图片在哪个后端：
+#   https://res.cloudinary.com/...   Cloudinary（以及旧数据里的任意 http 链接）
+#   local://<sha256>.<扩展名>         本地存储，由本模块内置的 HTTP 服务提供（支持 ETag / Range）
+# 页面展示前用 resolve_url / resolve_assets 把引用换成浏览器可访问的地址。
+# =========================================================
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 默认参数，可在 secrets.toml 的 [image_store] 中覆盖：
+#   backend（cloudinary / local）、root（本地存储目录）、host / port（本地图片服务监听地址）、
+#   base_url（浏览器访问本地图片服务的地址，默认 http://localhost:<port>）、thumb_cache_mb（缩略图缓存上限）
+STORE_DEFAULTS = {
+    "backend": "cloudinary",
+    "root": os.path.join(APP_DIR, ".image_store"),
+    "host": "127.0.0.1",
+    "port": 8765,
+    "base_url": "",
+    "thumb_cache_mb": 256,
+}
+# 设置该环境变量时覆盖 backend（如离线部署 / 本地测试用 local）
+BACKEND_ENV = "RHYTHMCOACH_IMAGE_BACKEND"
+
+LOCAL_SCHEME = "local://"
+CLOUDINARY_FOLDER = "rhythm_charts"
+THUMB_WIDTHS = (120, 240, 480)      # 允许的缩略图宽度（限定取值，缓存才有上界）
+THUMB_QUALITY = 70
+CACHE_MAX_AGE = 31536000            # 内容寻址的文件永不变化，浏览器可以缓存一年
+READ_CHUNK = 256 * 1024
+
+_KEY_RE = re.compile(r"^[0-9a-f]{64}\.(webp|jpg|png|gif|bin)$")
+_MIME = {"webp": "image/webp", "jpg": "image/jpeg", "png": "image/png", "gif": "image/gif",
+         "bin": "application/octet-stream"}
+
+def store_settings():
+    settings = dict(STORE_DEFAULTS)
+    try:
+        settings.update(st.secrets.get("image_store", {}))
+    except FileNotFoundError:
+        pass
+    if os.environ.get(BACKEND_ENV):
+        settings["backend"] = os.environ[BACKEND_ENV]
+    return settings
+
+def _sniff_ext(data):
+    """
+    按文件头判断图片格式（决定本地文件扩展名和 Content-Type）
+    """
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    if data[:3] == b"\xff\xd8\xff":
+        return "jpg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    return "bin"
+
+# ============================ 1. 两种后端 ============================
+class CloudinaryStore:
+    """
+    Cloudinary 图床（配置从 secrets.toml 的 [cloudinary] 读取，缺少时抛出 KeyError）
+    """
+    name = "cloudinary"
+
+    def __init__(self):
+        cloudinary.config(
+            cloud_name = st.secrets["cloudinary"]["cloud_name"],
+            api_key    = st.secrets["cloudinary"]["api_key"],
+            api_secret = st.secrets["cloudinary"]["api_secret"],
+            secure = True
+        )
+
+    def put(self, data, public_id):
+        """
+        上传一段图片字节，返回 https 链接；public_id 由内容哈希决定，overwrite=False 让重复上传直接返回已有资源
+        """
+        response = cloudinary.uploader.upload(
+            io.BytesIO(data),
+            public_id=public_id,
+            folder=CLOUDINARY_FOLDER,
+            resource_type="image",
+            overwrite=False
+        )
+        return response['secure_url']
+
+    def exists(self, ref):
+        return True   # 不为校验缓存去请求一次网络
+
+class LocalStore:
+    """
+    本地内容寻址存储：文件名就是内容的 sha256，同样的字节只存一份，写入后不再修改
+    """
+    name = "local"
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def put(self, data, public_id=None):
+        """
+        :param public_id: 不使用（文件名由内容决定），与 CloudinaryStore 保持同一签名
+        :return: local://<sha256>.<扩展名>
+        """
+        key = f"{hashlib.sha256(data).hexdigest()}.{_sniff_ext(data)}"
+        path = self.path(key)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)   # 原子替换，并发写同一内容也不会读到半个文件
+        return LOCAL_SCHEME + key
+
+    def exists(self, ref):
+        return os.path.exists(self.path(local_key(ref)))
+
+    def usage(self):
+        """
+        (原图文件数, 总字节数)
+        """
+        files = size = 0
+        for dirpath, dirs, names in os.walk(self.root):
+            dirs[:] = [d for d in dirs if not d.startswith("_")]   # 跳过 _thumbs 缩略图缓存
+            for n in names:
+                files += 1
+                size += os.path.getsize(os.path.join(dirpath, n))
+        return files, size
+
+_store_lock = threading.Lock()
+_store = None
+
+def get_store():
+    """
+    当前配置的写入后端（进程内只创建一次）；选本地后端时顺带启动本地图片服务
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                settings = store_settings()
+                if settings["backend"] == "local":
+                    _store = LocalStore(settings["root"])
+                    ensure_server()
+                elif settings["backend"] == "cloudinary":
+                    _store = CloudinaryStore()
+                else:
+                    raise ValueError(f"未知的图片存储后端: {settings['backend']}")
+    return _store
+
+# ============================ 2. 引用 -> 访问地址 ============================
+def local_key(ref):
+    return ref[len(LOCAL_SCHEME):]
+
+def backend_of(ref):
+    if not ref:
+        return None
+    if ref.startswith(LOCAL_SCHEME):
+        return "local"
+    if "res.cloudinary.com" in ref:
+        return "cloudinary"
+    return "url"
+
+def _base_url():
+    settings = store_settings()
+    return (settings["base_url"] or f"http://localhost:{settings['port']}").rstrip("/")
+
+def resolve_url(ref):
+    """
+    把存储引用换成浏览器可访问的地址（http 链接原样返回）
+    """
+    if ref and ref.startswith(LOCAL_SCHEME):
+        ensure_server()
+        return f"{_base_url()}/i/{local_key(ref)}"
+    return ref
+
+def thumbnail_url(ref, width=240):
+    """
+    缩略图地址：本地图片走磁盘缩略图缓存，Cloudinary 用 URL 变换参数
+    """
+    width = min((w for w in THUMB_WIDTHS if w >= width), default=THUMB_WIDTHS[-1])
+    backend = backend_of(ref)
+    if backend == "local":
+        ensure_server()
+        return f"{_base_url()}/thumb/{width}/{local_key(ref)}"
+    if backend == "cloudinary" and "/upload/" in ref:
+        return ref.replace("/upload/", f"/upload/w_{width},c_limit,q_auto/", 1)
+    return ref
+
+def resolve_assets(assets):
+    """
+    chart_assets 资源清单里的引用全部换成访问地址（返回新 dict）
+    """
+    return {
+        **assets,
+        "full": resolve_url(assets["full"]),
+        "preview": {**assets["preview"], "url": resolve_url(assets["preview"]["url"])},
+        "tiles": [{**t, "url": resolve_url(t["url"])} for t in assets["tiles"]],
+    }
+
+# ============================ 3. 缩略图磁盘缓存 ============================
+class ThumbnailCache:
+    """
+    有上限的缩略图缓存：超出 max_bytes 时按最近访问时间删除最旧的文件
+    """
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._entries = {}   # 文件名 -> (最近访问时间, 字节数)
+        for n in os.listdir(root):
+            stat = os.stat(os.path.join(root, n))
+            self._entries[n] = (stat.st_mtime, stat.st_size)
+
+    def get(self, source_path, key, width):
+        """
+        :return: 缩略图文件路径（没有时从原图生成）
+        """
+        name = f"{key.split('.')[0]}_w{width}.webp"
+        path = os.path.join(self.root, name)
+        with self._lock:
+            if name in self._entries and os.path.exists(path):
+                self._entries[name] = (time.time(), self._entries[name][1])
+                return path
+        with Image.open(source_path) as src:
+            src.thumbnail((width, width * 64))   # 长图只限制宽度
+            buf = io.BytesIO()
+            src.convert("RGB").save(buf, format="WEBP", quality=THUMB_QUALITY)
+        data = buf.getvalue()
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            self._entries[name] = (time.time(), len(data))
+            self._evict(keep=name)
+        return path
+
+    def _evict(self, keep=None):
+        total = sum(size for _, size in self._entries.values())
+        if total <= self.max_bytes:
+            return
+        for name, (_, size) in sorted(self._entries.items(), key=lambda kv: kv[1][0]):
+            if total <= self.max_bytes * 0.9:   # 一次多清一点，避免每张新图都触发
+                break
+            if name == keep:
+                continue
+            try:
+                os.remove(os.path.join(self.root, name))
+            except OSError:
+                pass
+            del self._entries[name]
+            total -= size
+
+    def usage(self):
+        with self._lock:
+            return len(self._entries), sum(size for _, size in self._entries.values())
+
+# ============================ 4. 本地图片服务 ============================
+class _ImageHandler(BaseHTTPRequestHandler):
+    """
+    GET/HEAD /i/<key>               原图（ETag、If-None-Match、单段 Range）
+    GET/HEAD /thumb/<宽度>/<key>     缩略图
+    """
+    store = None
+    thumbs = None
+
+    def do_HEAD(self):
+        self._serve(head=True)
+
+    def do_GET(self):
+        self._serve(head=False)
+
+    def log_message(self, format, *args):
+        pass   # 不往 Streamlit 控制台刷访问日志
+
+    def _serve(self, head):
+        parts = self.path.split("?", 1)[0].strip("/").split("/")
+        try:
+            if len(parts) == 2 and parts[0] == "i" and _KEY_RE.match(parts[1]):
+                key = parts[1]
+                path, etag, mime = self.store.path(key), f'"{key.split(".")[0]}"', _MIME[key.rsplit(".", 1)[1]]
+                if self._not_modified(etag):
+                    return
+            elif (len(parts) == 3 and parts[0] == "thumb" and parts[1].isdigit()
+                    and int(parts[1]) in THUMB_WIDTHS and _KEY_RE.match(parts[2])):
+                key, width = parts[2], int(parts[1])
+                source = self.store.path(key)
+                if not os.path.exists(source):
+                    return self.send_error(404)
+                etag, mime = f'"{key.split(".")[0]}-w{width}"', "image/webp"
+                if self._not_modified(etag):   # 浏览器已缓存时不必生成缩略图
+                    return
+                path = self.thumbs.get(source, key, width)
+            else:
+                return self.send_error(404)
+        except OSError:
+            return self.send_error(500)
+
+        try:
+            f = open(path, "rb")   # 先打开：之后即使缩略图被淘汰删除，也不影响本次响应
+        except OSError:
+            return self.send_error(404)
+        with f:
+            self._send_file(f, etag, mime, head)
+
+    def _send_file(self, f, etag, mime, head):
+        stat = os.fstat(f.fileno())
+        size = stat.st_size
+        start, end = 0, size - 1
+        status = 200
+        range_header = self.headers.get("Range")
+        if range_header and self.headers.get("If-Range", etag) == etag:
+            parsed = _parse_range(range_header, size)
+            if parsed is None:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            start, end = parsed
+            status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Type", mime)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", email.utils.formatdate(stat.st_mtime, usegmt=True))
+        self.send_header("Cache-Control", f"public, max-age={CACHE_MAX_AGE}, immutable")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if head:
+            return
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(READ_CHUNK, remaining))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            remaining -= len(chunk)
+
+    def _not_modified(self, etag):
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", f"public, max-age={CACHE_MAX_AGE}, immutable")
+            self.end_headers()
+            return True
+        return False
+
+def _parse_range(header, size):
+    """
+    解析单段 Range（bytes=a-b / bytes=a- / bytes=-n），不满足时返回 None
+    """
+    m = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", header)
+    if not m or (not m.group(1) and not m.group(2)) or size == 0:
+        return None
+    if not m.group(1):
+        start, end = max(0, size - int(m.group(2))), size - 1
+    else:
+        start = int(m.group(1))
+        end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+    if start > end or start >= size:
+        return None
+    return start, end
+
+_server_lock = threading.Lock()
+_server = None
+
+def make_server(settings=None):
+    settings = settings or store_settings()
+    handler = type("ImageHandler", (_ImageHandler,), {
+        "store": LocalStore(settings["root"]),
+        "thumbs": ThumbnailCache(os.path.join(settings["root"], "_thumbs"),
+                                 int(float(settings["thumb_cache_mb"]) * 1024 * 1024)),
+    })
+    return ThreadingHTTPServer((settings["host"], int(settings["port"])), handler)
+
+def ensure_server():
+    """
+    进程内启动一次本地图片服务（后台线程）；端口已被占用时视为已有独立服务在运行
+    """
+    global _server
+    if _server is not None:
+        return _server
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = make_server()
+            except OSError:
+                _server = False
+                return _server
+            threading.Thread(target=_server.serve_forever, name="image-store-http", daemon=True).start()
+    return _server
+
+def server_stats():
+    """
+    本地存储 / 缩略图缓存占用（给管理页面展示），未使用本地后端时返回 None
+    """
+    server = ensure_server() if store_settings()["backend"] == "local" else None
+    if not server:
+        return None
+    handler = server.RequestHandlerClass
+    files, size = handler.store.usage()
+    thumbs, thumb_size = handler.thumbs.usage()
+    return {"files": files, "bytes": size, "thumbs": thumbs, "thumb_bytes": thumb_size,
+            "thumb_limit": handler.thumbs.max_bytes}
+
+# ============================ 5. 命令行 ============================
+# 单独运行本地图片服务（多个 Streamlit 进程共用一个服务，或放在反向代理后面）：
+#   python image_store.py serve [--host 0.0.0.0] [--port 8765]
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地图片存储服务")
+    parser.add_argument("command", choices=["serve"])
+    parser.add_argument("--host")
+    parser.add_argument("--port", type=int)
+    args = parser.parse_args()
+    settings = store_settings()
+    settings.update({k: v for k, v in {"host": args.host, "port": args.port}.items() if v})
+    server = make_server(settings)
+    print(f"本地图片服务: http://{settings['host']}:{settings['port']}  目录: {settings['root']}")
+    server.serve_forever()
@@ -1,38 +1,249 @@
-import cloudinary
-import cloudinary.uploader
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
+from PIL import Image
+import image_store
+import upload_cache
 
-def upload_image_to_cloud(file_obj, filename_tag):
+# =========================================================
+# 派生图参数
+# =========================================================
+FULL_QUALITY = 85        # 整图重新压缩质量
+PREVIEW_QUALITY = 70     # 预览图质量
+PREVIEW_WIDTH = 480      # 预览图宽度（像素）
+TILE_HEIGHT = 1024       # 长图切片高度（像素）
+WEBP_MAX_SIDE = 16383    # WebP 单边最大像素，超出时整图改用 JPEG
+UPLOAD_WORKERS = 4       # 编码 / 上传并发数
+UPLOAD_ATTEMPTS = 4      # 单个资源最多上传次数
+UPLOAD_BACKOFF = 1.0     # 重试退避基数（秒）
+
+# 进程内共享的工作线程池（Pillow 编码与网络上传都会释放 GIL）
+_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="chart-assets")
+
+def _upload_bytes(data, public_id):
+    """
+    把一段图片字节写入当前存储后端，返回存储引用（失败时抛异常，可在工作线程中调用）
+    Cloudinary 返回 https 链接，本地存储返回 local://<sha256>.<扩展名>
+    """
+    return image_store.get_store().put(data, public_id)
+
+def _variant(name):
+    """
+    上传缓存的产物签名带上后端名：切换后端后不会拿到另一个后端的引用
+    （Cloudinary 沿用原来的签名，已有缓存继续有效）
+    """
+    store = image_store.get_store()
+    return name if store.name == "cloudinary" else f"{store.name}-{name}"
+
+def upload_image_to_cloud(file_obj, filename_tag=None):
     """
-    将图片文件上传到 Cloudinary 图床
-    :param file_obj: Streamlit 上传的文件对象
-    :param filename_tag: 给图片起个标签（通常用歌名）
-    :return: 图片的 HTTPS 链接 (URL)
+    将图片文件上传到当前存储后端（按内容哈希去重，同一张图只上传一次）
+    :param file_obj: Streamlit 上传的文件对象（或 bytes）
+    :param filename_tag: 已不再使用（public_id 改由内容哈希决定），保留参数以兼容旧调用
+    :return: 存储引用（Cloudinary 为 HTTPS 链接，本地存储为 local://…，展示前用 image_store.resolve_url 转换）
     """
-    # 1. 配置 Cloudinary (从 secrets.toml 读取)
+    # 1. 初始化存储后端（Cloudinary 配置从 secrets.toml 读取）
     try:
-        cloudinary.config( 
-            cloud_name = st.secrets["cloudinary"]["cloud_name"], 
-            api_key    = st.secrets["cloudinary"]["api_key"], 
-            api_secret = st.secrets["cloudinary"]["api_secret"],
-            secure = True
-        )
+        store = image_store.get_store()
     except KeyError:
         st.error("❌ 缺少 Cloudinary 配置！请检查 .streamlit/secrets.toml")
         return None
 
+    data = file_obj if isinstance(file_obj, bytes) else file_obj.getvalue()
+    digest = upload_cache.content_hash(data)
+    cached = upload_cache.lookup(digest, _variant("image"))
+    if cached and store.exists(cached["url"]):
+        return cached["url"]
+
     # 2. 执行上传
     try:
-        # folder="rhythm_charts" 会自动在云端建一个文件夹，方便管理
-        response = cloudinary.uploader.upload(
-            file_obj, 
-            public_id=filename_tag, 
-            folder="rhythm_charts", 
-            resource_type="image"
-        )
-        # 返回安全的 https 链接
-        return response['secure_url']
-    
+        url = _upload_bytes(data, digest[:32])
+        upload_cache.remember(digest, _variant("image"), {"url": url})
+        return url
+
     except Exception as e:
         st.error(f"❌ 图片上传失败: {e}")
-        return None
\ No newline at end of file
+        return None
+
+# =========================================================
+# 上传预处理：重新压缩 + 预览图 + 长图切片
+# =========================================================
+def _flatten(img):
+    """
+    统一转成 RGB（透明背景铺白色）
+    """
+    if img.mode in ("RGBA", "LA", "P"):
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel("A"))
+        return background
+    return img.convert("RGB")
+
+def _encode(img, fmt, quality):
+    buf = io.BytesIO()
+    if fmt == "WEBP":
+        img.save(buf, format="WEBP", quality=quality, method=4)
+    else:
+        img.save(buf, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return buf.getvalue()
+
+def _encode_tile(img, top, height, quality):
+    return _encode(img.crop((0, top, img.width, top + height)), "WEBP", quality)
+
+def build_chart_derivatives(image_bytes, quality=FULL_QUALITY, tile_height=TILE_HEIGHT, preview_width=PREVIEW_WIDTH):
+    """
+    生成谱面长图的派生资源（纯计算，不访问网络）
+    :return: {"width", "height", "format", "full": bytes,
+              "preview": {"data", "width", "height"},
+              "tile_height": 切片高度, "tiles": [{"data", "y", "height"}, ...], "dhash": 感知哈希}
+    """
+    with Image.open(io.BytesIO(image_bytes)) as src:
+        img = _flatten(src)
+    width, height = img.size
+    dhash_future = _executor.submit(upload_cache.dhash, img)
+
+    # 1. 整图重新压缩（超出 WebP 尺寸上限时用 JPEG）
+    full_format = "WEBP" if max(width, height) <= WEBP_MAX_SIDE else "JPEG"
+    full_future = _executor.submit(_encode, img, full_format, quality)
+
+    # 2. 小预览图（首屏占位用）
+    preview_height = max(1, round(height * preview_width / width))
+    # 窄图不缩放时也要复制一份：Pillow 把保存参数挂在 Image 对象上，与整图并发编码会互相覆盖质量参数
+    preview = img.resize((preview_width, preview_height), Image.LANCZOS) if width > preview_width else img.copy()
+    preview_future = _executor.submit(_encode, preview, "WEBP", PREVIEW_QUALITY)
+
+    # 3. 固定高度切片
+    tile_futures = []
+    for top in range(0, height, tile_height):
+        h = min(tile_height, height - top)
+        tile_futures.append((top, h, _executor.submit(_encode_tile, img, top, h, quality)))
+
+    return {
+        "width": width,
+        "height": height,
+        "format": full_format.lower(),
+        "full": full_future.result(),
+        "preview": {"data": preview_future.result(), "width": preview.width, "height": preview.height},
+        "tile_height": tile_height,
+        "tiles": [{"data": f.result(), "y": top, "height": h} for top, h, f in tile_futures],
+        "dhash": dhash_future.result(),
+    }
+
+def _upload_with_retry(data, public_id, attempts, backoff, on_retry=None):
+    """
+    带指数退避的上传：第 n 次失败后等待 backoff * 2^(n-1) 秒再试
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return _upload_bytes(data, public_id)
+        except Exception as e:
+            if attempt == attempts:
+                raise
+            if on_retry:
+                on_retry(public_id, attempt, e)
+            time.sleep(backoff * 2 ** (attempt - 1))
+
+def upload_derivatives(derived, filename_tag, progress=None, attempts=UPLOAD_ATTEMPTS,
+                       backoff=UPLOAD_BACKOFF, on_retry=None):
+    """
+    并发上传 build_chart_derivatives 的结果（失败时抛异常，可在后台线程中调用）
+    :param progress: 可选回调 progress(已完成数, 总数)
+    :param on_retry: 可选回调 on_retry(public_id, 第几次失败, 异常)
+    :return: 资源清单 dict（存入 charts.chart_assets，其中的地址都是存储引用）
+    """
+    image_store.get_store()   # 缺少配置时在这里直接失败，不必等每个资源各自报错
+
+    jobs = [("full", derived["full"])]
+    jobs.append(("preview", derived["preview"]["data"]))
+    jobs += [(f"tile_{i:03d}", t["data"]) for i, t in enumerate(derived["tiles"])]
+
+    futures = {
+        name: _executor.submit(_upload_with_retry, blob, f"{filename_tag}/{name}", attempts, backoff, on_retry)
+        for name, blob in jobs
+    }
+    urls = {}
+    for done, (name, future) in enumerate(futures.items(), start=1):
+        urls[name] = future.result()
+        if progress:
+            progress(done, len(futures))
+
+    return {
+        "version": 1,
+        "width": derived["width"],
+        "height": derived["height"],
+        "format": derived["format"],
+        "full": urls["full"],
+        "preview": {
+            "url": urls["preview"],
+            "width": derived["preview"]["width"],
+            "height": derived["preview"]["height"],
+        },
+        "tile_height": derived["tile_height"],
+        "tiles": [
+            {"url": urls[f"tile_{i:03d}"], "y": t["y"], "height": t["height"]}
+            for i, t in enumerate(derived["tiles"])
+        ],
+    }
+
+# 派生图参数签名：参数变了就是另一份产物，不能复用旧缓存 / 旧 public_id
+ASSETS_VARIANT = f"assets-q{FULL_QUALITY}-t{TILE_HEIGHT}-p{PREVIEW_WIDTH}"
+
+def content_tag(digest):
+    """
+    按内容哈希生成资源目录，派生资源放在 rhythm_charts/<tag>/ 下（本地存储按各文件内容寻址，不使用）
+    """
+    return f"{digest[:32]}_{ASSETS_VARIANT}"
+
+def cached_chart_assets(digest):
+    """
+    同一张图之前上传过（且资源仍在当前后端）时直接返回资源清单，否则返回 None
+    """
+    assets = upload_cache.lookup(digest, _variant(ASSETS_VARIANT))
+    if assets and image_store.get_store().exists(assets["full"]):
+        return assets
+    return None
+
+def store_derivatives(digest, derived, progress=None, on_retry=None):
+    """
+    上传派生图并记入本地索引（内容哈希 -> 资源清单 / 感知哈希）
+    """
+    assets = upload_derivatives(derived, content_tag(digest), progress=progress, on_retry=on_retry)
+    upload_cache.remember(digest, _variant(ASSETS_VARIANT), assets)
+    upload_cache.remember_perceptual(digest, derived["dhash"], assets["full"])
+    return assets
+
+def upload_chart_image(data, progress=None, on_retry=None):
+    """
+    预处理并上传谱面长图；同一张图已上传过时不重新处理、不走网络
+    （失败时抛异常，可在后台线程中调用）
+    :return: 资源清单 dict
+    """
+    digest = upload_cache.content_hash(data)
+    cached = cached_chart_assets(digest)
+    if cached:
+        if progress:
+            progress(1, 1)
+        return cached
+    return store_derivatives(digest, build_chart_derivatives(data), progress=progress, on_retry=on_retry)
+
+def upload_chart_assets(file_obj, filename_tag=None, progress=None):
+    """
+    预处理并上传谱面长图（整图 / 预览 / 切片并发上传，按内容去重）
+    :param file_obj: Streamlit 上传的文件对象（或 bytes）
+    :param filename_tag: 已不再使用（资源目录改由内容哈希决定），保留参数以兼容旧调用
+    :param progress: 可选回调 progress(已完成数, 总数)
+    :return: 资源清单 dict（存入 charts.chart_assets），失败返回 None
+    """
+    try:
+        image_store.get_store()
+    except KeyError:
+        st.error("❌ 缺少 Cloudinary 配置！请检查 .streamlit/secrets.toml")
+        return None
+
+    try:
+        data = file_obj if isinstance(file_obj, bytes) else file_obj.getvalue()
+        return upload_chart_image(data, progress=progress)
+    except Exception as e:
+        st.error(f"❌ 图片处理或上传失败: {e}")
+        return None
@@ -0,0 +1,140 @@
+import threading
+import time
+from collections import deque
+import db_manager as db
+
+# =========================================================
+# 标注实时推送：进程内 pub/sub（所有 Streamlit 会话共享）
+# 正在看某张谱面的会话按 chart_id 订阅；本进程里 add_annotation / delete_annotation
+# 提交后，变更的那一行（连同该谱面最新的段落汇总，只查一次）推给所有订阅者，
+# 各会话把它并入自己手里的数据，不用各自再查数据库。
+#
+# 会话侧用 run_every 的 fragment 每 POLL_SECONDS 秒看一眼自己的队列（纯内存），
+# 有新事件才整页重跑一次并 drain()。
+# 只覆盖同一进程内的写入；多进程部署时其他进程的写入仍需手动刷新。
+# =========================================================
+POLL_SECONDS = 3             # 会话检查队列的间隔
+SUBSCRIBER_TTL = 60          # 超过这么久没来检查的订阅视为会话已关闭，自动清理
+MAX_PENDING = 100            # 单个订阅者积压的事件上限，超过后只标记「需要整体重新加载」
+
+_lock = threading.Lock()
+_charts = {}        # chart_id -> set(token)
+_subscribers = {}   # token -> {"chart_id", "events": deque, "overflow": bool, "seen": 时间戳}
+_stats = {"published": 0, "delivered": 0, "overflows": 0, "expired": 0}
+
+def _expire(now):
+    """
+    清理长时间没有检查队列的订阅（调用方持有 _lock）
+    """
+    for token in [t for t, sub in _subscribers.items() if now - sub["seen"] > SUBSCRIBER_TTL]:
+        _drop(token)
+        _stats["expired"] += 1
+
+def _drop(token):
+    sub = _subscribers.pop(token, None)
+    if sub is not None:
+        tokens = _charts.get(sub["chart_id"])
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del _charts[sub["chart_id"]]
+
+# ============================ 1. 订阅 ============================
+def subscribe(token, chart_id):
+    """
+    会话开始关注某张谱面（一个会话同一时间只订阅一张，换谱面时自动退订上一张）
+    """
+    chart_id = int(chart_id)
+    now = time.time()
+    with _lock:
+        _expire(now)
+        _drop(token)
+        _subscribers[token] = {"chart_id": chart_id, "events": deque(), "overflow": False, "seen": now}
+        _charts.setdefault(chart_id, set()).add(token)
+
+def unsubscribe(token):
+    with _lock:
+        _drop(token)
+
+def pending(token):
+    """
+    队列里待处理的事件数（fragment 轮询用，同时刷新存活时间）
+    :return: 事件数；订阅已过期 / 不存在时返回 None，调用方应重新加载并订阅
+    """
+    with _lock:
+        sub = _subscribers.get(token)
+        if sub is None:
+            return None
+        sub["seen"] = time.time()
+        return len(sub["events"]) + (1 if sub["overflow"] else 0)
+
+def drain(token, chart_id):
+    """
+    取走并清空队列
+    :return: 事件列表；订阅不存在、订的不是这张谱面或积压溢出时返回 None（需要整体重新加载）
+    """
+    with _lock:
+        sub = _subscribers.get(token)
+        if sub is None or sub["chart_id"] != int(chart_id) or sub["overflow"]:
+            return None
+        sub["seen"] = time.time()
+        events = list(sub["events"])
+        sub["events"].clear()
+        return events
+
+# ============================ 2. 发布 ============================
+def publish(chart_id, event):
+    chart_id = int(chart_id)
+    with _lock:
+        _stats["published"] += 1
+        for token in _charts.get(chart_id, ()):
+            sub = _subscribers[token]
+            if sub["overflow"]:
+                continue
+            if len(sub["events"]) >= MAX_PENDING:
+                sub["events"].clear()
+                sub["overflow"] = True
+                _stats["overflows"] += 1
+            else:
+                sub["events"].append(event)
+                _stats["delivered"] += 1
+
+def _has_subscribers(chart_id):
+    with _lock:
+        return bool(_charts.get(int(chart_id)))
+
+def _on_annotation_changed(event):
+    if not _has_subscribers(event["chart_id"]):
+        return
+    # 段落汇总在这里查一次，所有订阅者共用（查询失败时订阅者各自重新加载）
+    try:
+        stats = db.get_chart_section_stats(event["chart_id"])
+    except Exception:
+        stats = None
+    publish(event["chart_id"], {**event, "stats": stats})
+
+db.on_annotation_changed(_on_annotation_changed)
+
+# ============================ 3. 会话侧合并 ============================
+def apply_events(view, events):
+    """
+    把事件并入会话手里的数据
+    :param view: {"stats": get_chart_section_stats 的结果, "annotations": 标注 DataFrame 或 None（还没加载）}
+    :return: 是否需要整体重新加载（某个事件没有带段落汇总）
+    """
+    for event in events:
+        if event["stats"] is None:
+            return True
+        view["stats"] = event["stats"]
+        anns = view.get("annotations")
+        if anns is None:
+            continue
+        if event["op"] == "add":
+            view["annotations"] = db.merge_annotation_row(anns, event["row"])
+        else:
+            view["annotations"] = anns[anns["annotation_id"] != event["annotation_id"]].reset_index(drop=True)
+    return False
+
+def hub_stats():
+    with _lock:
+        return {**_stats, "subscribers": len(_subscribers), "charts": len(_charts)}
@@ -0,0 +1,117 @@
+import functools
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+import pandas as pd
+
+# =========================================================
+# 性能监控：数据库调用 / 页面 rerun 耗时（进程内环形缓冲区）
+# =========================================================
+BUFFER_SIZE = 20_000     # 最多保留的事件数，写满后自动丢弃最早的
+QUERY, PAGE = "query", "page"
+
+_events = deque(maxlen=BUFFER_SIZE)
+_events_lock = threading.Lock()
+_local = threading.local()
+_started = time.time()
+
+def _row_count(result):
+    """
+    尽量从返回值推断行数（DataFrame / (DataFrame, cursor) / 批量写入条数）
+    """
+    if isinstance(result, pd.DataFrame):
+        return len(result)
+    if isinstance(result, tuple) and result and isinstance(result[0], pd.DataFrame):
+        return len(result[0])
+    if isinstance(result, dict) and result and all(isinstance(v, pd.DataFrame) for v in result.values()):
+        return sum(len(v) for v in result.values())
+    return None
+
+def record(kind, name, elapsed_ms, rows=None, error=None, user=None):
+    with _events_lock:
+        _events.append({
+            "ts": time.time(), "kind": kind, "name": name, "ms": elapsed_ms,
+            "rows": rows, "error": error, "user": user,
+        })
+
+def timed_query(fn):
+    """
+    装饰 db_manager 的函数：记录函数名、行数和耗时（异常照常抛出）。
+    嵌套调用（如 get_chart_facets 内部调用 get_all_charts）只记录最外层。
+    """
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if getattr(_local, "depth", 0):
+            return fn(*args, **kwargs)
+        _local.depth = 1
+        start = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            record(QUERY, name, (time.perf_counter() - start) * 1000, error=f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            _local.depth = 0
+        record(QUERY, name, (time.perf_counter() - start) * 1000, rows=_row_count(result))
+        return result
+
+    return wrapper
+
+@contextmanager
+def page_timer(name, user=None):
+    """
+    计时一次页面 rerun。st.stop() / st.rerun() 通过异常跳出脚本，
+    它们不算错误，只有普通 Exception 才记为失败。
+    """
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        record(PAGE, name, (time.perf_counter() - start) * 1000, error=error, user=user)
+
+def get_events(kind=None):
+    """
+    缓冲区快照（DataFrame，按时间先后）
+    """
+    with _events_lock:
+        rows = list(_events)
+    df = pd.DataFrame(rows, columns=["ts", "kind", "name", "ms", "rows", "error", "user"])
+    if kind:
+        df = df[df["kind"] == kind]
+    df["time"] = pd.to_datetime(df["ts"], unit="s")
+    return df.reset_index(drop=True)
+
+def summarize(events):
+    """
+    按 (kind, name) 汇总调用次数、失败数、平均行数和 p50 / p95 / p99 / 最大耗时
+    """
+    columns = ["kind", "name", "calls", "errors", "avg_rows", "p50_ms", "p95_ms", "p99_ms", "max_ms"]
+    if events.empty:
+        return pd.DataFrame(columns=columns)
+    grouped = events.groupby(["kind", "name"])
+    summary = grouped["ms"].quantile([0.5, 0.95, 0.99]).unstack()
+    summary.columns = ["p50_ms", "p95_ms", "p99_ms"]
+    summary["calls"] = grouped.size()
+    summary["errors"] = grouped["error"].count()
+    summary["avg_rows"] = grouped["rows"].mean()
+    summary["max_ms"] = grouped["ms"].max()
+    return summary.reset_index()[columns].sort_values("p95_ms", ascending=False, ignore_index=True)
+
+def slowest(events, n=50):
+    return events.nlargest(n, "ms")
+
+def buffer_info():
+    with _events_lock:
+        size = len(_events)
+    return {"size": size, "capacity": BUFFER_SIZE, "since": _started}
+
+def clear():
+    with _events_lock:
+        _events.clear()
@@ -0,0 +1,202 @@
+import threading
+import time
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+import db_manager as db
+import perf_monitor
+from tech_tags import TECH_TAGS
+
+# =========================================================
+# 练习推荐：谱面 × 技术特征矩阵 + 用户弱点向量
+# 矩阵第 i 行是谱面 chart_ids[i]，第 j 列是 TECH_TAGS[j]，值为该谱面上带这个标签的标注
+# 的专家评分之和（来自 annotation_tags）。进程内只建一次：
+#   新标注 -> 按 annotation_id > last_id 增量累加（走主键索引）
+#   删除标注 -> db_manager 的删除监听直接减掉
+#   谱面目录变化 -> 按新目录重排行（不重新查标注）
+# 其他进程里的删除看不到，每隔 FULL_REBUILD_SECONDS 整体重建一次兜底。
+# =========================================================
+DEFAULT_RATING = 3           # 没有专家评分的标注按中间分计
+REFRESH_SECONDS = 5          # 增量拉取新标注的最小间隔
+FULL_REBUILD_SECONDS = 600
+LEVEL_BAND = 2               # 默认推荐「最近常打等级 ± LEVEL_BAND」的谱面
+
+_TAG_COLUMN = {tag: i for i, tag in enumerate(TECH_TAGS)}
+
+_lock = threading.Lock()
+_state = {
+    "chart_ids": np.empty(0, dtype=np.int64),
+    "matrix": np.zeros((0, len(TECH_TAGS)), dtype=np.float32),
+    "catalog": None,     # 构建时使用的 get_all_charts() 结果（同一对象说明目录没变）
+    "charts": None,      # 按 chart_ids 顺序排好的谱面目录
+    "last_id": 0,
+    "built_at": 0.0,
+    "refreshed_at": 0.0,
+}
+
+# ============================ 1. 特征矩阵 ============================
+def _accumulate(chart_ids, matrix, rows, sign=1):
+    """
+    把 (chart_id, tag, weight) 行累加进矩阵（目录里没有的谱面、未知标签直接忽略）
+    """
+    rows = pd.DataFrame(rows, columns=["chart_id", "tag", "weight"])
+    if rows.empty or len(chart_ids) == 0:
+        return
+    cols = rows["tag"].map(_TAG_COLUMN)
+    pos = np.searchsorted(chart_ids, rows["chart_id"].to_numpy(dtype=np.int64))
+    pos = np.minimum(pos, len(chart_ids) - 1)
+    valid = cols.notna().to_numpy() & (chart_ids[pos] == rows["chart_id"].to_numpy(dtype=np.int64))
+    np.add.at(
+        matrix, (pos[valid], cols[valid].to_numpy(dtype=np.int64)),
+        sign * rows.loc[valid, "weight"].to_numpy(dtype=np.float32)
+    )
+
+def _aligned(catalog, chart_ids):
+    return catalog.set_index("song_id").reindex(chart_ids)
+
+def _full_build(catalog):
+    chart_ids = np.sort(catalog["song_id"].to_numpy(dtype=np.int64))
+    matrix = np.zeros((len(chart_ids), len(TECH_TAGS)), dtype=np.float32)
+    with db.get_connection().session as s:
+        last_id = s.execute(text("SELECT COALESCE(MAX(annotation_id), 0) FROM annotation_tags")).scalar()
+        rows = s.execute(
+            text("""
+                SELECT chart_id, tag, SUM(COALESCE(expert_rating, :dr)) AS weight
+                FROM annotation_tags WHERE annotation_id <= :last
+                GROUP BY chart_id, tag
+            """),
+            {"dr": DEFAULT_RATING, "last": last_id}
+        ).all()
+    _accumulate(chart_ids, matrix, rows)
+    now = time.time()
+    _state.update(chart_ids=chart_ids, matrix=matrix, catalog=catalog, charts=_aligned(catalog, chart_ids),
+                  last_id=int(last_id), built_at=now, refreshed_at=now)
+
+def _apply_new_annotations():
+    with db.get_connection().session as s:
+        rows = s.execute(
+            text("""
+                SELECT annotation_id, chart_id, tag, COALESCE(expert_rating, :dr) AS weight
+                FROM annotation_tags WHERE annotation_id > :last
+            """),
+            {"dr": DEFAULT_RATING, "last": _state["last_id"]}
+        ).mappings().all()
+    if rows:
+        _accumulate(_state["chart_ids"], _state["matrix"], [(r["chart_id"], r["tag"], r["weight"]) for r in rows])
+        _state["last_id"] = max(_state["last_id"], max(int(r["annotation_id"]) for r in rows))
+    _state["refreshed_at"] = time.time()
+
+def _realign(catalog):
+    """
+    谱面目录变了：按新目录重排矩阵行，已有谱面的特征原样保留，新谱面从 0 开始
+    （删掉又新增同一 song_id 的情况由定期整体重建纠正）
+    """
+    chart_ids = np.sort(catalog["song_id"].to_numpy(dtype=np.int64))
+    matrix = np.zeros((len(chart_ids), len(TECH_TAGS)), dtype=np.float32)
+    old_ids = _state["chart_ids"]
+    if len(old_ids):
+        pos = np.minimum(np.searchsorted(old_ids, chart_ids), len(old_ids) - 1)
+        kept = old_ids[pos] == chart_ids
+        matrix[kept] = _state["matrix"][pos[kept]]
+    _state.update(chart_ids=chart_ids, matrix=matrix, catalog=catalog, charts=_aligned(catalog, chart_ids))
+
+def _on_deleted(tag_rows):
+    with _lock:
+        # last_id 之后的行还没累加过，不用减
+        counted = [
+            (r["chart_id"], r["tag"], DEFAULT_RATING if r["expert_rating"] is None else r["expert_rating"])
+            for r in tag_rows if int(r["annotation_id"]) <= _state["last_id"]
+        ]
+        _accumulate(_state["chart_ids"], _state["matrix"], counted, sign=-1)
+
+db.on_annotations_deleted(_on_deleted)
+
+def feature_matrix():
+    """
+    :return: (chart_ids, matrix, 与矩阵行对齐的谱面目录)，按需增量刷新
+    """
+    catalog = db.get_all_charts()
+    with _lock:
+        now = time.time()
+        if _state["catalog"] is None or now - _state["built_at"] > FULL_REBUILD_SECONDS:
+            _full_build(catalog)
+        else:
+            if _state["catalog"] is not catalog:
+                _realign(catalog)
+            if now - _state["refreshed_at"] > REFRESH_SECONDS:
+                _apply_new_annotations()
+        return _state["chart_ids"], _state["matrix"].copy(), _state["charts"]
+
+def invalidate():
+    with _lock:
+        _state["catalog"] = None
+
+# ============================ 2. 弱点向量 ============================
+def weakness_vector(username):
+    """
+    用户在各技术标签上的失误占比（来自报告汇总表，和为 1；没有数据时全 0）
+    """
+    with db.get_connection().session as s:
+        tags = s.execute(
+            text("SELECT tag, miss_total FROM user_tag_stats WHERE username = :u"), {"u": username}
+        ).all()
+    vec = np.zeros(len(TECH_TAGS), dtype=np.float32)
+    for tag, total in tags:
+        col = _TAG_COLUMN.get(tag)
+        if col is not None and total > 0:
+            vec[col] = total
+    return vec / vec.sum() if vec.sum() > 0 else vec
+
+def default_level_range(username):
+    """
+    最近 50 条记录的等级中位数 ± LEVEL_BAND；没有记录时返回 None（不限等级）
+    """
+    recent, _ = db.get_play_records_page(username, limit=50)
+    levels = recent["level"].dropna() if "level" in recent else pd.Series(dtype="Int8")
+    if levels.empty:
+        return None
+    center = int(round(float(levels.median())))
+    return max(1, center - LEVEL_BAND), center + LEVEL_BAND
+
+# ============================ 3. 推荐 ============================
+@perf_monitor.timed_query
+def recommend(username, level_range=None, difficulties=None, top_n=10):
+    """
+    按用户弱点给谱面打分：谱面技术特征与弱点向量的余弦相似度，一次矩阵运算覆盖全部谱面
+    :param level_range: (最低等级, 最高等级)，None 表示不限
+    :param difficulties: 难度列表，None 表示不限
+    :return: DataFrame[song_id, song_name, difficulty, level, chart_image_path, score, focus]，
+             score 越高越对症；focus 是贡献最大的两个技术特征
+    """
+    columns = ["song_id", "song_name", "difficulty", "level", "chart_image_path", "score", "focus"]
+    weakness = weakness_vector(username)
+    if not weakness.any():
+        return pd.DataFrame(columns=columns)
+
+    chart_ids, matrix, charts = feature_matrix()
+    # 余弦相似度：0 表示毫不相关，1 表示谱面的技术构成与弱点分布完全一致
+    norms = np.linalg.norm(matrix, axis=1)
+    scores = (matrix @ (weakness / np.linalg.norm(weakness))) / np.where(norms > 0, norms, 1)
+
+    mask = scores > 0
+    if level_range is not None:
+        levels = charts["level"].to_numpy(dtype="float64", na_value=np.nan)
+        mask &= (levels >= level_range[0]) & (levels <= level_range[1])
+    if difficulties is not None:
+        mask &= charts["difficulty"].isin(difficulties).to_numpy()
+    candidates = np.flatnonzero(mask)
+    if len(candidates) == 0:
+        return pd.DataFrame(columns=columns)
+
+    if len(candidates) > top_n:
+        candidates = candidates[np.argpartition(-scores[candidates], top_n)[:top_n]]
+    top = candidates[np.argsort(-scores[candidates], kind="stable")]
+    contrib = matrix[top] * weakness
+    focus = [
+        "、".join(TECH_TAGS[j] for j in np.argsort(-row)[:2] if row[j] > 0)
+        for row in contrib
+    ]
+    result = charts.iloc[top].reset_index()
+    result["score"] = scores[top]
+    result["focus"] = focus
+    return result[columns]
@@ -0,0 +1,322 @@
+"""
+数据库结构版本管理
+
+    python schema_migrations.py status     # 当前版本与待执行的迁移
+    python schema_migrations.py migrate    # 执行到最新版本
+
+已执行的版本记在 schema_migrations 表里。每个步骤都先检查再创建（表 / 索引 / 字段
+已存在就跳过），所以线上已有的表、之前手动补过的索引都不会冲突；MySQL 的 DDL
+会隐式提交，某个版本中途失败时修好问题重跑即可。
+"""
+import argparse
+from sqlalchemy import inspect, text
+
+# =========================================================
+# 1. 迁移步骤（幂等）
+# =========================================================
+# 同一份 DDL 兼容 MySQL 与 SQLite（离线基准测试）：{pk} 自增主键，{opts} 表选项
+_DDL_PARTS = {
+    "mysql": {"pk": "INT AUTO_INCREMENT PRIMARY KEY", "opts": " DEFAULT CHARSET=utf8mb4"},
+    "sqlite": {"pk": "INTEGER PRIMARY KEY AUTOINCREMENT", "opts": ""},
+}
+
+def _dialect_parts(conn):
+    return _DDL_PARTS.get(conn.dialect.name, _DDL_PARTS["sqlite"])
+
+def create_table(name, ddl):
+    def step(conn):
+        if inspect(conn).has_table(name):
+            return None
+        conn.execute(text(f"CREATE TABLE {name} ({ddl}){{opts}}".format(**_dialect_parts(conn))))
+        return f"表 {name}"
+    return step
+
+def _leading_columns(conn, table):
+    """
+    表上已有的每个索引（含主键 / 唯一约束）的列序列
+    """
+    insp = inspect(conn)
+    # SQLite 的列级 UNIQUE 只体现为自动索引，反射唯一约束时拿不到
+    kw = {"include_auto_indexes": True} if conn.dialect.name == "sqlite" else {}
+    found = [tuple(ix["column_names"]) for ix in insp.get_indexes(table, **kw)]
+    found += [tuple(uc["column_names"]) for uc in insp.get_unique_constraints(table)]
+    pk = insp.get_pk_constraint(table).get("constrained_columns")
+    if pk:
+        found.append(tuple(pk))
+    return found
+
+def create_index(table, name, columns, fulltext=False):
+    """
+    columns 已经是某个现有索引的前缀时跳过（不重复建等价索引）；
+    全文索引只在 MySQL 上创建（ngram 分词，支持中文）
+    """
+    columns = tuple(columns)
+
+    def step(conn):
+        if fulltext:
+            if conn.dialect.name != "mysql":
+                return None
+            if any(ix["name"] == name for ix in inspect(conn).get_indexes(table)):
+                return None
+            conn.execute(text(
+                f"CREATE FULLTEXT INDEX {name} ON {table} ({', '.join(columns)}) WITH PARSER ngram"
+            ))
+            return f"全文索引 {table}.{name}"
+        if any(existing[:len(columns)] == columns for existing in _leading_columns(conn, table)):
+            return None
+        conn.execute(text(f"CREATE INDEX {name} ON {table} ({', '.join(columns)})"))
+        return f"索引 {table}.{name}"
+    return step
+
+def add_column(table, column, definition):
+    def step(conn):
+        if any(c["name"] == column for c in inspect(conn).get_columns(table)):
+            return None
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {definition}"))
+        return f"字段 {table}.{column}"
+    return step
+
+def backfill_annotation_tags():
+    """
+    把已有标注的 tags 字符串拆进 annotation_tags（只补还没有标签行的标注，可重复执行）
+    """
+    def step(conn):
+        import db_manager
+        written, _ = db_manager.sync_annotation_tags(conn)
+        return f"回填 annotation_tags {written} 行" if written else None
+    return step
+
+def backfill_user_report_stats():
+    """
+    为已有打歌记录的用户补建能力报告汇总（只处理汇总表里还没有数据的用户，可重复执行）
+    """
+    def step(conn):
+        import db_manager
+        users = db_manager.backfill_user_report_stats(conn)
+        return f"回填 {users} 个用户的报告汇总" if users else None
+    return step
+
+def backfill_chart_section_stats():
+    def step(conn):
+        import db_manager
+        total = db_manager.rebuild_chart_section_stats(conn)
+        return f"按 {total} 条标注回填段落汇总" if total else None
+    return step
+
+# =========================================================
+# 2. 版本列表（只能追加，不要修改已发布的版本）
+# =========================================================
+MIGRATIONS = [
+    (1, "基础表", [
+        create_table("users", """
+            user_id {pk},
+            username VARCHAR(64) NOT NULL UNIQUE,
+            password VARCHAR(128) NOT NULL,
+            role VARCHAR(16) NOT NULL DEFAULT 'user',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        """),
+        create_table("charts", """
+            song_id {pk},
+            song_name VARCHAR(255) NOT NULL,
+            difficulty VARCHAR(16) NOT NULL,
+            level INT,
+            chart_image_path VARCHAR(512),
+            upload_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        """),
+        create_table("annotations", """
+            annotation_id {pk},
+            chart_id INT NOT NULL,
+            chart_name VARCHAR(255),
+            difficulty VARCHAR(16),
+            start_section INT,
+            end_section INT,
+            tags VARCHAR(255),
+            desc_text TEXT,
+            expert_rating INT,
+            annotator VARCHAR(64),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        """),
+        # 同一张表同时存放新版记录与旧版 miss 统计（chart_name / miss_count / notes / score）
+        create_table("play_records", """
+            record_id {pk},
+            username VARCHAR(64) NOT NULL,
+            chart_id INT,
+            chart_name VARCHAR(255),
+            song_name VARCHAR(255),
+            difficulty VARCHAR(16),
+            level INT,
+            practice_count INT,
+            miss_section INT,
+            miss_count INT,
+            cause VARCHAR(64),
+            detected_tags VARCHAR(255),
+            comment TEXT,
+            notes TEXT,
+            score INT,
+            play_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        """),
+        create_table("user_feedback", """
+            feedback_id {pk},
+            username VARCHAR(64),
+            feedback_type VARCHAR(32),
+            content TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        """),
+    ]),
+    (2, "热路径索引", [
+        create_index("users", "idx_users_username", ["username"]),
+        create_index("play_records", "idx_play_records_user_time", ["username", "play_time"]),
+        create_index("annotations", "idx_annotations_chart", ["chart_id"]),
+        create_index("charts", "idx_charts_difficulty_level", ["difficulty", "level"]),
+    ]),
+    (3, "谱面检索索引", [
+        create_index("charts", "idx_charts_song_name", ["song_name"]),
+        create_index("charts", "ft_charts_song_name", ["song_name"], fulltext=True),
+    ]),
+    (4, "谱面派生资源清单字段", [
+        add_column("charts", "chart_assets", "MEDIUMTEXT NULL"),
+    ]),
+    (5, "能力报告汇总表", [
+        create_table("user_tag_stats", """
+            username VARCHAR(64) NOT NULL,
+            tag VARCHAR(64) NOT NULL,
+            miss_total INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (username, tag)
+        """),
+        create_table("user_cause_stats", """
+            username VARCHAR(64) NOT NULL,
+            cause VARCHAR(64) NOT NULL,
+            record_count INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (username, cause)
+        """),
+        create_table("user_daily_stats", """
+            username VARCHAR(64) NOT NULL,
+            play_date DATE NOT NULL,
+            miss_total INT NOT NULL DEFAULT 0,
+            practice_total INT NOT NULL DEFAULT 0,
+            record_count INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (username, play_date)
+        """),
+        backfill_user_report_stats(),
+    ]),
+    (6, "标注标签规范化表", [
+        create_table("annotation_tags", """
+            annotation_id INT NOT NULL,
+            tag VARCHAR(64) NOT NULL,
+            chart_id INT NOT NULL,
+            expert_rating INT,
+            PRIMARY KEY (annotation_id, tag)
+        """),
+        create_index("annotation_tags", "idx_annotation_tags_search", ["tag", "expert_rating", "chart_id"]),
+        backfill_annotation_tags(),
+    ]),
+    (7, "谱面段落汇总表", [
+        create_table("chart_section_stats", """
+            chart_id INT NOT NULL,
+            section INT NOT NULL,
+            annotation_count INT NOT NULL DEFAULT 0,
+            rating_sum INT NOT NULL DEFAULT 0,
+            rating_count INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (chart_id, section)
+        """),
+        create_table("chart_section_tags", """
+            chart_id INT NOT NULL,
+            section INT NOT NULL,
+            tag VARCHAR(64) NOT NULL,
+            hits INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (chart_id, section, tag)
+        """),
+        create_table("chart_section_annotators", """
+            chart_id INT NOT NULL,
+            section INT NOT NULL,
+            annotator VARCHAR(64) NOT NULL,
+            annotation_count INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (chart_id, section, annotator)
+        """),
+        backfill_chart_section_stats(),
+    ]),
+    # 后写队列（write_behind）重放时按条目生成时附带的键查重，已写入的不再插入
+    (8, "后写队列幂等键", [
+        add_column("play_records", "client_key", "VARCHAR(32) NULL"),
+        add_column("user_feedback", "client_key", "VARCHAR(32) NULL"),
+        create_index("play_records", "idx_play_records_client_key", ["client_key"]),
+        create_index("user_feedback", "idx_user_feedback_client_key", ["client_key"]),
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# =========================================================
+# 3. 执行
+# =========================================================
+def _default_engine():
+    import db_manager
+    return db_manager.get_connection().engine
+
+def _ensure_version_table(conn):
+    create_table("schema_migrations", """
+        version INT PRIMARY KEY,
+        description VARCHAR(255),
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    """)(conn)
+
+def current_version(engine=None):
+    engine = engine or _default_engine()
+    with engine.begin() as conn:
+        _ensure_version_table(conn)
+        return conn.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")).scalar()
+
+def pending(engine=None):
+    version = current_version(engine)
+    return [(v, desc) for v, desc, _ in MIGRATIONS if v > version]
+
+def migrate(engine=None, target=None, log=None):
+    """
+    依次执行未执行的版本（每个版本一个事务）
+    :param engine: SQLAlchemy Engine，默认用 db_manager 的连接
+    :param log: 可选回调 log(version, description, 本版本实际创建的对象列表)
+    :return: 本次执行的版本号列表
+    """
+    engine = engine or _default_engine()
+    target = target or LATEST_VERSION
+    done = current_version(engine)
+    applied = []
+    for version, description, steps in MIGRATIONS:
+        if version <= done or version > target:
+            continue
+        with engine.begin() as conn:
+            created = [c for c in (step(conn) for step in steps) if c]
+            conn.execute(
+                text("INSERT INTO schema_migrations (version, description) VALUES (:v, :d)"),
+                {"v": version, "d": description}
+            )
+        if log:
+            log(version, description, created)
+        applied.append(version)
+
+    if applied:
+        # 谱面表结构可能变了（如新增 chart_assets），清掉进程内的谱面缓存
+        import db_manager
+        db_manager.invalidate_chart_catalog()
+    return applied
+
+def main():
+    parser = argparse.ArgumentParser(description="RhythmCoach 数据库结构迁移")
+    parser.add_argument("command", choices=["status", "migrate"])
+    parser.add_argument("--target", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.command == "status":
+        print(f"当前版本 {current_version()}，最新版本 {LATEST_VERSION}")
+        for version, description in pending():
+            print(f"  待执行 v{version}: {description}")
+        return
+
+    def log(version, description, created):
+        print(f"v{version} {description}: {', '.join(created) or '无需变更'}")
+
+    applied = migrate(target=args.target, log=log)
+    print(f"完成，执行了 {len(applied)} 个版本" if applied else "已是最新版本")
+
+if __name__ == "__main__":
+    main()
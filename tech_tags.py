@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+
+# 技术特征标签（顺序固定：第 i 个标签对应位掩码的第 i 位，不要调整已有顺序，只能在末尾追加）
+TECH_TAGS = [
+    "交互 (Trill)", "楼梯 (Stairs)", "纵连 (Jack)", "划键 (Flick)","大跨度 (Jump)", 
+    "多押 (Chord)", "变速 (Soflan)", "读谱难 (Reading)", 
+    "耐力 (Stamina)", "锁手 (Tech)", "各显神通 (Gimmick)"
+]
+
+# 没有命中任何标注区间时的占位标签
+NO_TAG = "常规段落"
+
+# 单条标注最多覆盖的段落数：弱点引擎展开区间、段落汇总表计数都按这个上限截断，
+# 两边口径一致（误填的超大区间不会撑爆内存 / 汇总表）
+MAX_ANNOTATION_SPAN = 256
+
+def tags_to_masks(tags):
+    """
+    逗号拼接的标签字符串（Series）-> 位掩码数组（向量化，每个标签扫描一次）
+    """
+    tags = pd.Series(tags)
+    if isinstance(tags.dtype, pd.CategoricalDtype):
+        # 分类列只需对去重后的取值计算一次，再按编码取回（空值编码为 -1）
+        category_masks = np.append(tags_to_masks(tags.cat.categories.astype(str)), 0)
+        return category_masks[tags.cat.codes.to_numpy()]
+    tags = tags.fillna("").astype(str)
+    masks = np.zeros(len(tags), dtype=np.int64)
+    for bit, tag in enumerate(TECH_TAGS):
+        masks |= tags.str.contains(tag, regex=False).to_numpy(dtype=np.int64) << bit
+    return masks
+
+def mask_to_tags(mask):
+    return [tag for bit, tag in enumerate(TECH_TAGS) if (int(mask) >> bit) & 1]
+
+def masks_to_strings(masks):
+    """
+    位掩码数组 -> 逗号拼接的标签字符串数组（无标签时为 NO_TAG）
+    """
+    masks = np.asarray(masks, dtype=np.int64)
+    uniq, inverse = np.unique(masks, return_inverse=True)
+    labels = np.array([",".join(mask_to_tags(m)) or NO_TAG for m in uniq], dtype=object)
+    return labels[inverse]
+
+def split_tags(tags):
+    """
+    逗号拼接的标签字符串 -> 去重后的标签列表（保持原顺序，空值返回 []）
+    """
+    if tags is None or pd.isna(tags):
+        return []
+    return list(dict.fromkeys(t.strip()[:64] for t in str(tags).split(",") if t.strip()))
+
+def annotation_tag_rows(annotations):
+    """
+    标注行（含 annotation_id / chart_id / tags / expert_rating 的 dict）-> annotation_tags 表的行
+    """
+    rows = []
+    for a in annotations:
+        rating = a.get("expert_rating")
+        rating = None if rating is None or pd.isna(rating) else int(rating)
+        for tag in split_tags(a.get("tags")):
+            rows.append({"annotation_id": int(a["annotation_id"]), "tag": tag,
+                         "chart_id": int(a["chart_id"]), "expert_rating": rating})
+    return rows
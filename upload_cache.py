@@ -0,0 +1,122 @@
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+from PIL import Image
+
+# =========================================================
+# 上传结果缓存：图片内容哈希 -> 已上传的链接 / 派生资源清单
+# 同一张图第二次上传（或失败后整批重跑）时直接返回，不再走网络。
+# 另存每张谱面的感知哈希（dHash），用来提示库里已有的近似重复谱面。
+# 索引放在本机 SQLite 文件里（路径可用环境变量 RHYTHMCOACH_UPLOAD_INDEX 覆盖）。
+# =========================================================
+INDEX_PATH = os.environ.get(
+    "RHYTHMCOACH_UPLOAD_INDEX",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "upload_index.db")
+)
+DHASH_SIZE = 8                 # 8x8 差值哈希，共 64 位
+NEAR_DUPLICATE_DISTANCE = 6    # 汉明距离不超过该值视为近似重复
+
+_local = threading.local()
+
+def _db():
+    """
+    每个线程一个连接（sqlite3 连接不能跨线程共享）
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        os.makedirs(os.path.dirname(INDEX_PATH), exist_ok=True)
+        conn = sqlite3.connect(INDEX_PATH, timeout=30)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS uploads (
+                digest TEXT NOT NULL,
+                variant TEXT NOT NULL,
+                value TEXT NOT NULL,
+                created REAL NOT NULL,
+                PRIMARY KEY (digest, variant)
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS perceptual (
+                digest TEXT PRIMARY KEY,
+                dhash INTEGER NOT NULL,
+                url TEXT,
+                created REAL NOT NULL
+            )
+        """)
+        conn.commit()
+        _local.conn = conn
+    return conn
+
+# ============================ 1. 内容哈希 ============================
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def lookup(digest, variant):
+    """
+    :param variant: 同一张图的不同产物（如 "image" / 派生图参数签名）
+    :return: 之前 remember 的值，没有时返回 None
+    """
+    row = _db().execute(
+        "SELECT value FROM uploads WHERE digest = ? AND variant = ?", (digest, variant)
+    ).fetchone()
+    return json.loads(row[0]) if row else None
+
+def remember(digest, variant, value):
+    conn = _db()
+    conn.execute(
+        "INSERT OR REPLACE INTO uploads (digest, variant, value, created) VALUES (?, ?, ?, ?)",
+        (digest, variant, json.dumps(value, ensure_ascii=False), time.time())
+    )
+    conn.commit()
+
+def known(digest):
+    """
+    这张图（按内容）是否已经上传过
+    """
+    return _db().execute("SELECT 1 FROM uploads WHERE digest = ? LIMIT 1", (digest,)).fetchone() is not None
+
+# ============================ 2. 感知哈希 ============================
+def dhash(img):
+    """
+    差值哈希：缩成 (N+1) x N 灰度图，比较左右相邻像素，返回 64 位有符号整数
+    （重新压缩、缩放后的同一张图哈希几乎不变）
+    """
+    if isinstance(img, (bytes, bytearray)):
+        with Image.open(io.BytesIO(img)) as src:
+            return dhash(src.convert("L"))
+    small = np.asarray(img.convert("L").resize((DHASH_SIZE + 1, DHASH_SIZE), Image.LANCZOS), dtype=np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    value = int(np.packbits(bits).view(">u8")[0])
+    return value - (1 << 64) if value >= 1 << 63 else value   # 存进 SQLite INTEGER
+
+def remember_perceptual(digest, hash_value, url):
+    conn = _db()
+    conn.execute(
+        "INSERT OR REPLACE INTO perceptual (digest, dhash, url, created) VALUES (?, ?, ?, ?)",
+        (digest, int(hash_value), url, time.time())
+    )
+    conn.commit()
+
+def find_similar(hash_value, max_distance=NEAR_DUPLICATE_DISTANCE, exclude_digest=None):
+    """
+    在已上传的图片里找近似重复（一次向量化计算所有汉明距离）
+    :return: [(url, 汉明距离, digest), ...]，按距离升序
+    """
+    rows = _db().execute("SELECT digest, dhash, url FROM perceptual").fetchall()
+    if not rows:
+        return []
+    hashes = np.array([r[1] for r in rows], dtype=np.int64).view(np.uint64)
+    xor = hashes ^ np.uint64(hash_value & ((1 << 64) - 1))
+    distances = np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+    order = np.argsort(distances, kind="stable")
+    return [
+        (rows[i][2], int(distances[i]), rows[i][0])
+        for i in order
+        if distances[i] <= max_distance and rows[i][0] != exclude_digest
+    ]
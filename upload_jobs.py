@@ -0,0 +1,98 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import db_manager as db
+import image_utils as img_host
+import upload_cache
+
+# =========================================================
+# 谱面上传后台任务队列（进程级，页面 rerun 不影响任务）
+# =========================================================
+MAX_CONCURRENT_JOBS = 3   # 同时处理的谱面数
+MAX_KEPT_JOBS = 200       # 最多保留的任务记录数（超出时丢弃最早的已结束任务）
+
+# 任务状态
+QUEUED, PROCESSING, UPLOADING, SAVING, DONE, FAILED = (
+    "排队中", "处理中", "上传中", "写入数据库", "完成", "失败"
+)
+FINISHED = (DONE, FAILED)
+
+_jobs_lock = threading.Lock()
+_jobs = {}
+_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_JOBS, thread_name_prefix="upload-jobs")
+
+def _update(job_id, **fields):
+    with _jobs_lock:
+        _jobs[job_id].update(fields, updated=time.time())
+
+def _run_job(job_id, data, section_count):
+    with _jobs_lock:
+        job = dict(_jobs[job_id])
+    try:
+        # 1. 同一张图之前上传过时直接复用资源清单
+        _update(job_id, status=PROCESSING, progress=0.05)
+        digest = upload_cache.content_hash(data)
+        assets = img_host.cached_chart_assets(digest)
+        if assets is None:
+            # 2. 压缩 / 预览 / 切片（只做一次，上传重试不重复计算）
+            derived = img_host.build_chart_derivatives(data)
+
+            # 3. 并发上传，单个资源失败按指数退避重试
+            _update(job_id, status=UPLOADING, progress=0.1)
+
+            def on_progress(done, total):
+                _update(job_id, progress=0.1 + 0.85 * done / total, message=f"{done}/{total} 个文件")
+
+            def on_retry(public_id, attempt, error):
+                with _jobs_lock:
+                    _jobs[job_id]["retries"] += 1
+                _update(job_id, message=f"{public_id.rsplit('/', 1)[-1]} 第 {attempt} 次失败，稍后重试: {error}")
+
+            assets = img_host.store_derivatives(digest, derived, progress=on_progress, on_retry=on_retry)
+        if section_count:
+            assets["section_count"] = int(section_count)
+
+        # 4. 全部上传成功后才写入 charts
+        _update(job_id, status=SAVING, progress=0.97)
+        db.add_chart(job["song_name"], job["difficulty"], job["level"], assets["full"], assets=assets)
+        _update(job_id, status=DONE, progress=1.0, message="", url=assets["full"])
+    except Exception as e:
+        _update(job_id, status=FAILED, message=str(e))
+
+def submit_chart_upload(data, filename, song_name, difficulty, level, section_count=0, owner=""):
+    """
+    提交一个谱面上传任务（立即返回任务 ID，处理在后台线程中进行）
+    :param data: 图片字节（必须在脚本线程里先读出来）
+    """
+    job_id = uuid.uuid4().hex[:12]
+    now = time.time()
+    with _jobs_lock:
+        _jobs[job_id] = {
+            "id": job_id, "owner": owner, "filename": filename,
+            "song_name": song_name, "difficulty": difficulty, "level": int(level),
+            "status": QUEUED, "progress": 0.0, "retries": 0, "message": "", "url": None,
+            "created": now, "updated": now,
+        }
+        _prune()
+    _executor.submit(_run_job, job_id, data, section_count)
+    return job_id
+
+def _prune():
+    finished = [j for j in _jobs.values() if j["status"] in FINISHED]
+    overflow = len(_jobs) - MAX_KEPT_JOBS
+    for job in sorted(finished, key=lambda j: j["updated"])[:max(overflow, 0)]:
+        del _jobs[job["id"]]
+
+def list_jobs(owner):
+    """
+    某个用户提交的任务（按提交时间倒序，返回副本）
+    """
+    with _jobs_lock:
+        jobs = [dict(j) for j in _jobs.values() if j["owner"] == owner]
+    return sorted(jobs, key=lambda j: j["created"], reverse=True)
+
+def clear_finished(owner):
+    with _jobs_lock:
+        for job_id in [j["id"] for j in _jobs.values() if j["owner"] == owner and j["status"] in FINISHED]:
+            del _jobs[job_id]
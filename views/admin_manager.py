@@ -2,53 +2,172 @@ import streamlit as st
 import pandas as pd
 import time
 import db_manager as db       # 引入数据库管家
-import image_utils as img_host # 引入刚才写的图床工具
+import upload_jobs            # 谱面上传后台任务队列
+import schema_migrations      # 数据库结构版本管理
+import chart_import           # 谱面包批量导入
+import upload_cache           # 上传去重索引（内容哈希 / 感知哈希）
+import image_store            # 图片存储后端（Cloudinary / 本地）
 
 st.title("⚙️ 谱面库管理 (云端版)")
 st.markdown("**管理员专用：在此上传新谱面，图片将自动托管至 CDN。**")
 
-# --- 区域 1：上传新谱面 ---
+DIFFICULTIES = chart_import.DIFFICULTIES
+current_admin = st.session_state.get("username", "")
+
+# --- 区域 1：上传新谱面（后台队列，可一次提交多张） ---
 with st.expander("📤 上传新谱面", expanded=True):
-    with st.form("upload_chart_form", clear_on_submit=True):
-        col1, col2,col3 = st.columns([2,1,1])
-        with col1:
-            song_name = st.text_input("🎵 歌曲名称", placeholder="例如：Freedom Dive")
-        with col2:
-            difficulty = st.selectbox("⭐ 难度", ["Easy", "Normal", "Hard", "Expert", "Master", "Append"])
-        with col3:
-            level = st.number_input("🔢 等级", min_value=1, max_value=38, step=1)
-        
-        uploaded_file = st.file_uploader("🖼️ 选择谱面长图", type=["png", "jpg", "jpeg"])
-        
-        submitted = st.form_submit_button("🚀 上传并保存")
-        
-        if submitted:
-            if not (song_name and uploaded_file):
-                st.error("请填写完整信息（歌名 + 图片）！")
-            else:
+    # 换一个 key 即可在提交后清空上传框
+    uploader_key = f"chart_uploader_{st.session_state.get('chart_uploader_round', 0)}"
+    uploaded_files = st.file_uploader(
+        "🖼️ 选择谱面长图（可多选）", type=["png", "jpg", "jpeg"],
+        accept_multiple_files=True, key=uploader_key
+    )
+
+    if uploaded_files:
+        st.caption("逐行确认歌名 / 难度 / 等级后提交，图片会在后台压缩、切片并上传。")
+        draft = pd.DataFrame({
+            "文件": [f.name for f in uploaded_files],
+            "歌曲名称": [f.name.rsplit(".", 1)[0] for f in uploaded_files],
+            "难度": "Master",
+            "等级": 30,
+            "小节总数": 0,
+        })
+        # 查重：完全相同的图片会直接复用已上传资源；感知哈希相近的提示可能是同一张谱面
+        fingerprints = st.session_state.setdefault("upload_fingerprints", {})
+        duplicate_notes = []
+        charts_by_url = None
+        for f in uploaded_files:
+            if f.file_id not in fingerprints:
+                data = f.getvalue()
                 try:
-                    with st.spinner("☁️ 正在将图片传输到 Cloudinary 服务器..."):
-                        # 1. 生成一个干净的文件名标签 (去除特殊字符)
-                        timestamp = int(time.time())
-                        clean_name = "".join([c for c in song_name if c.isalnum() or c in (' ','-','_')]).strip()
-                        file_tag = f"{clean_name}_{difficulty}_{timestamp}"
-                        
-                        # 2. 上传图片 -> 获取 URL
-                        image_url = img_host.upload_image_to_cloud(uploaded_file, file_tag)
-                        
-                        if image_url:
-                            # 3. 将 URL 和信息存入数据库
-                            db.add_chart(song_name, difficulty, level, image_url)
-                            
-                            st.success(f"✅ 上传成功！")
-                            st.caption(f"图片链接: {image_url}") # 调试用，让你看到生成的链接
-                            time.sleep(1.5)
-                            st.rerun()
-                        else:
-                            st.error("图片上传失败，请重试。")
-                            
-                except Exception as e:
-                    st.error(f"系统错误: {e}")
+                    fingerprints[f.file_id] = (upload_cache.content_hash(data), upload_cache.dhash(data))
+                except Exception:
+                    fingerprints[f.file_id] = (upload_cache.content_hash(data), None)
+            digest, hash_value = fingerprints[f.file_id]
+            if upload_cache.known(digest):
+                duplicate_notes.append(f"**{f.name}**：与已上传的图片完全相同，将直接复用已有资源")
+                continue
+            if hash_value is None:
+                continue
+            similar = upload_cache.find_similar(hash_value, exclude_digest=digest)
+            if similar:
+                if charts_by_url is None:
+                    catalog = db.get_all_charts()
+                    charts_by_url = dict(zip(catalog["chart_image_path"], catalog["song_name"].astype(str) + " [" + catalog["difficulty"].astype(str) + "]"))
+                names = [charts_by_url.get(url, url) for url, _, _ in similar[:3]]
+                duplicate_notes.append(f"**{f.name}**：与库中谱面相似（{'、'.join(names)}），请确认不是重复上传")
+        if duplicate_notes:
+            st.warning("\n\n".join(duplicate_notes), icon="⚠️")
+
+        edited = st.data_editor(
+            draft,
+            column_config={
+                "文件": st.column_config.TextColumn(disabled=True),
+                "难度": st.column_config.SelectboxColumn(options=DIFFICULTIES, required=True),
+                "等级": st.column_config.NumberColumn(min_value=1, max_value=38, step=1, required=True),
+                "小节总数": st.column_config.NumberColumn(min_value=0, step=1, help="用于标注一键跳转，0 表示未知"),
+            },
+            hide_index=True,
+            use_container_width=True,
+            key=f"{uploader_key}_editor"
+        )
+
+        if st.button("🚀 加入上传队列", type="primary"):
+            if (edited["歌曲名称"].astype(str).str.strip() == "").any():
+                st.error("请填写完整信息（每张图片都需要歌名）！")
+            else:
+                for f, (_, row) in zip(uploaded_files, edited.iterrows()):
+                    upload_jobs.submit_chart_upload(
+                        f.getvalue(), f.name,
+                        str(row["歌曲名称"]).strip(), row["难度"], int(row["等级"]),
+                        section_count=int(row["小节总数"] or 0), owner=current_admin
+                    )
+                st.session_state["chart_uploader_round"] = st.session_state.get("chart_uploader_round", 0) + 1
+                st.rerun()
+
+def render_upload_jobs():
+    jobs = upload_jobs.list_jobs(current_admin)
+    if not jobs:
+        return
+
+    # 有任务结束时刷新整页：谱面库列表随之更新，没有进行中的任务后也停止轮询
+    finished_ids = {j["id"] for j in jobs if j["status"] in upload_jobs.FINISHED}
+    known_ids = st.session_state.get("upload_jobs_finished")
+    st.session_state["upload_jobs_finished"] = finished_ids
+    if known_ids is not None and finished_ids - known_ids:
+        st.rerun()
+
+    st.markdown("**⏳ 上传任务**")
+    for job in jobs:
+        label = f"{job['song_name']} ({job['difficulty']}, Lv{job['level']}) · {job['status']}"
+        if job["retries"]:
+            label += f" · 重试 {job['retries']} 次"
+        if job["status"] == upload_jobs.FAILED:
+            st.error(f"{label}：{job['message']}")
+        elif job["status"] == upload_jobs.DONE:
+            st.success(label)
+        else:
+            st.progress(job["progress"], text=f"{label} {job['message']}")
+
+    if any(j["status"] in upload_jobs.FINISHED for j in jobs):
+        if st.button("清除已结束的任务"):
+            upload_jobs.clear_finished(current_admin)
+            st.rerun()
+
+# 还有未结束的任务时每秒局部刷新一次进度
+has_active = any(j["status"] not in upload_jobs.FINISHED for j in upload_jobs.list_jobs(current_admin))
+st.fragment(render_upload_jobs, run_every=1.0 if has_active else None)()
+
+# --- 区域 1.1：谱面包批量导入（zip + 清单 CSV） ---
+with st.expander("📦 批量导入谱面包"):
+    st.caption(
+        "上传谱面长图的 zip 压缩包和清单 CSV（列：song_name, difficulty, level, filename，"
+        "可选 section_count）；清单也可以直接放在 zip 根目录，命名为 manifest.csv。"
+        "整份清单先统一校验，全部通过后才开始处理，谱面在最后一次性写入。"
+    )
+    pack = st.file_uploader("谱面包 (zip)", type=["zip"], key="chart_pack")
+    manifest_file = st.file_uploader("清单 (CSV，可选)", type=["csv"], key="chart_pack_manifest")
+
+    if pack is not None and st.button("校验并开始导入"):
+        try:
+            manifest = chart_import.read_manifest(manifest_file.getvalue()) if manifest_file else None
+            import_id, checked = chart_import.start_import(pack.getvalue(), manifest, owner=current_admin)
+            if import_id is None:
+                bad = checked[checked["error"] != ""]
+                st.error(f"清单共 {len(checked)} 行，{len(bad)} 行未通过校验，请修正后重新上传：")
+                st.dataframe(bad[["row_no", "song_name", "difficulty", "level", "filename", "error"]],
+                             hide_index=True, use_container_width=True)
+            else:
+                st.session_state["chart_import_id"] = import_id
+        except Exception as e:
+            st.error(f"无法读取谱面包: {e}")
+
+def render_chart_import():
+    state = chart_import.get_import(st.session_state.get("chart_import_id"))
+    if state is None:
+        return
+    report = state["report"]
+    if not state["finished"]:
+        st.progress(state["progress"], text=f"批量导入 {state['total']} 张谱面 · {state['message']}")
+        return
+
+    # 刚结束时刷新整页，谱面库列表随之更新
+    if st.session_state.get("chart_import_done") != state["id"]:
+        st.session_state["chart_import_done"] = state["id"]
+        st.rerun()
+
+    succeeded = int((report["status"] == chart_import.OK).sum())
+    summary = f"批量导入完成：成功 {succeeded} / {state['total']}"
+    if state["message"]:
+        summary += f"（{state['message']}）"
+    (st.success if succeeded == state["total"] else st.warning)(summary)
+    st.dataframe(report, hide_index=True, use_container_width=True)
+    if st.button("关闭导入结果"):
+        st.session_state.pop("chart_import_id", None)
+        st.rerun()
+
+import_state = chart_import.get_import(st.session_state.get("chart_import_id"))
+st.fragment(render_chart_import, run_every=1.0 if import_state and not import_state["finished"] else None)()
 
 # --- 区域 2：当前谱面库列表 ---
 st.markdown("---")
@@ -59,9 +178,16 @@ df_charts = db.get_all_charts()
 
 if not df_charts.empty:
     # 显示表格
+    listing = df_charts[['song_id', 'song_name', 'difficulty', 'level', 'upload_time']].copy()
+    listing.insert(0, "thumb", df_charts["chart_image_path"].map(lambda ref: image_store.thumbnail_url(ref, 120)))
+    listing["backend"] = df_charts["chart_image_path"].map(image_store.backend_of)
     st.dataframe(
-        df_charts[['song_id', 'song_name', 'difficulty','level',  'upload_time']], 
-        use_container_width=True, 
+        listing,
+        column_config={
+            "thumb": st.column_config.ImageColumn("缩略图", width="small"),
+            "backend": st.column_config.TextColumn("存储"),
+        },
+        use_container_width=True,
         hide_index=True
     )
     
@@ -90,4 +216,62 @@ if not df_charts.empty:
                 except Exception as e:
                     st.error(f"删除失败: {e}")
 else:
-    st.info("谱面库为空，请在上方上传第一张谱面。")
\ No newline at end of file
+    st.info("谱面库为空，请在上方上传第一张谱面。")
+# --- 区域 3：数据库连接池 ---
+st.markdown("---")
+st.subheader("🔌 数据库连接池")
+try:
+    pool = db.get_pool_status()
+    m1, m2, m3, m4 = st.columns(4)
+    m1.metric("使用中连接", f"{pool.get('checked_out', '-')} / {pool.get('pool_size', '-')}")
+    m2.metric("溢出连接", pool.get("overflow", "-"))
+    m3.metric("平均等待", f"{pool['avg_wait_ms']:.1f} ms")
+    m4.metric("P95 / 最大等待", f"{pool['p95_wait_ms']:.0f} / {pool['max_wait_ms']:.0f} ms")
+    st.caption(
+        f"累计取连接 {pool['waits']} 次，超时 {pool['timeouts']} 次 · 当前配置: "
+        + ", ".join(f"{k}={v}" for k, v in pool["settings"].items())
+        + "（可在 secrets.toml 的 [db_pool] 中调整）"
+    )
+except Exception as e:
+    st.error(f"读取连接池状态失败: {e}")
+
+# --- 区域 3.5：图片存储 ---
+st.markdown("---")
+st.subheader("🗄️ 图片存储")
+store_config = image_store.store_settings()
+st.caption(f"当前写入后端: **{store_config['backend']}**（可在 secrets.toml 的 [image_store] 中切换 cloudinary / local）")
+if store_config["backend"] == "local":
+    stats = image_store.server_stats()
+    if stats is None:
+        st.info(f"本地图片服务由独立进程提供: {store_config['base_url'] or store_config['port']}")
+    else:
+        s1, s2, s3 = st.columns(3)
+        s1.metric("原图文件数", stats["files"])
+        s2.metric("原图占用", f"{stats['bytes'] / 1024 / 1024:.1f} MB")
+        s3.metric("缩略图缓存", f"{stats['thumb_bytes'] / 1024 / 1024:.1f} / {stats['thumb_limit'] / 1024 / 1024:.0f} MB",
+                  help=f"{stats['thumbs']} 个文件，超出上限时删除最久未访问的缩略图")
+
+# --- 区域 4：数据库结构迁移 ---
+st.markdown("---")
+with st.expander("🛠️ 数据库结构迁移"):
+    st.caption("建表、热路径索引（用户名 / 打歌记录 / 标注 / 难度等级）、谱面检索索引、"
+               "chart_assets 字段与能力报告汇总表都由 schema_migrations 按版本管理，已存在的会跳过。")
+    try:
+        todo = schema_migrations.pending()
+        st.write(f"当前版本 **v{schema_migrations.current_version()}** / "
+                 f"最新版本 v{schema_migrations.LATEST_VERSION}")
+        for version, description in todo:
+            st.write(f"- 待执行 v{version}: {description}")
+    except Exception as e:
+        todo = []
+        st.error(f"读取结构版本失败: {e}")
+
+    if todo and st.button("执行迁移"):
+        try:
+            logs = []
+            schema_migrations.migrate(
+                log=lambda v, d, created: logs.append(f"v{v} {d}: {', '.join(created) or '无需变更'}")
+            )
+            st.success("迁移完成\n\n" + "\n\n".join(logs))
+        except Exception as e:
+            st.error(f"迁移失败: {e}")
@@ -0,0 +1,130 @@
+import streamlit as st
+from datetime import datetime
+import db_manager as db
+import live_hub
+import perf_monitor
+import write_behind
+
+st.title("⏱️ 性能监控")
+st.markdown("**管理员专用：最近的数据库调用与页面 rerun 耗时（进程内缓存，重启后清空）。**")
+
+info = perf_monitor.buffer_info()
+events = perf_monitor.get_events()
+
+# --- 区域 1：筛选 ---
+c1, c2, c3 = st.columns([2, 2, 1])
+with c1:
+    window = st.selectbox("时间范围", ["全部", "最近 5 分钟", "最近 1 小时", "最近 24 小时"])
+with c2:
+    only_errors = st.checkbox("只看失败的调用")
+with c3:
+    if st.button("🗑️ 清空缓冲区"):
+        perf_monitor.clear()
+        st.rerun()
+
+seconds = {"最近 5 分钟": 300, "最近 1 小时": 3600, "最近 24 小时": 86400}.get(window)
+if seconds:
+    events = events[events["ts"] >= datetime.now().timestamp() - seconds]
+if only_errors:
+    events = events[events["error"].notna()]
+
+st.caption(
+    f"缓冲区 {info['size']} / {info['capacity']} 条 · 自 "
+    f"{datetime.fromtimestamp(info['since']):%Y-%m-%d %H:%M:%S} 起统计"
+)
+
+with st.expander("🧮 查询结果内存占用"):
+    st.caption("对比典型查询结果在原始类型、显式类型（分类 / 小整数 / 时间）、显式类型 + Arrow 字符串下的内存占用。"
+               "「每会话」的结果每个在线用户各有一份。")
+    report_user = st.text_input("按该用户的数据估算", value=st.session_state.get("username", ""))
+    if st.button("生成内存报告"):
+        try:
+            st.session_state["memory_report"] = db.dataframe_memory_report(report_user.strip())
+        except Exception as e:
+            st.error(f"生成失败: {e}")
+    memory = st.session_state.get("memory_report")
+    if memory is not None:
+        memory = memory.copy()
+        for col in ["raw_bytes", "typed_bytes", "arrow_bytes"]:
+            memory[col.replace("bytes", "mb")] = memory[col] / 1024 / 1024
+        memory["saved_pct"] = (1 - memory["typed_bytes"] / memory["raw_bytes"].where(memory["raw_bytes"] > 0)) * 100
+        st.dataframe(
+            memory[["query", "scope", "rows", "raw_mb", "typed_mb", "arrow_mb", "saved_pct"]],
+            column_config={
+                **{c: st.column_config.NumberColumn(format="%.2f") for c in ["raw_mb", "typed_mb", "arrow_mb"]},
+                "saved_pct": st.column_config.NumberColumn("节省 %", format="%.0f%%"),
+            },
+            hide_index=True, use_container_width=True
+        )
+        per_session = memory[memory["scope"] == "每会话"]
+        m1, m2 = st.columns(2)
+        m1.metric("每会话占用（原始类型）", f"{per_session['raw_mb'].sum():.2f} MB")
+        m2.metric("每会话占用（显式类型）", f"{per_session['typed_mb'].sum():.2f} MB",
+                  delta=f"-{per_session['raw_mb'].sum() - per_session['typed_mb'].sum():.2f} MB",
+                  delta_color="inverse")
+
+queue = write_behind.queue_stats()
+if queue is not None:
+    with st.expander(f"📮 后写队列（待写入 {queue['pending']} 条）"):
+        q1, q2, q3, q4 = st.columns(4)
+        q1.metric("待写入", queue["pending"])
+        q2.metric("已写入", queue["flushed"], help=f"启动时从日志重放 {queue['replayed']} 条")
+        q3.metric("写入失败批次", queue["failures"])
+        q4.metric("死信", queue["dead"], help="反复写入失败、已移到 .dead 文件的条目")
+        st.caption(
+            f"日志 {queue['journal_bytes'] / 1024:.1f} KB · 上次写入 "
+            + (f"{datetime.fromtimestamp(queue['last_flush']):%H:%M:%S}" if queue["last_flush"] else "—")
+        )
+        if queue["last_error"]:
+            st.warning(f"最近一次错误: {queue['last_error']}")
+
+hub = live_hub.hub_stats()
+with st.expander(f"📡 标注实时推送（{hub['subscribers']} 个会话订阅 {hub['charts']} 张谱面）"):
+    h1, h2, h3, h4 = st.columns(4)
+    h1.metric("已发布", hub["published"])
+    h2.metric("已送达", hub["delivered"])
+    h3.metric("积压溢出", hub["overflows"], help="积压过多、改为整体重新加载的次数")
+    h4.metric("过期清理", hub["expired"], help="长时间没有检查队列、被自动退订的会话")
+
+if events.empty:
+    st.info("暂无数据，先去其他页面操作一下再回来看看。")
+    st.stop()
+
+# --- 区域 2：分位数汇总 ---
+summary = perf_monitor.summarize(events)
+number_format = {c: st.column_config.NumberColumn(format="%.1f") for c in
+                 ["avg_rows", "p50_ms", "p95_ms", "p99_ms", "max_ms"]}
+
+st.subheader("🗄️ 数据库调用")
+st.dataframe(
+    summary[summary["kind"] == perf_monitor.QUERY].drop(columns="kind"),
+    column_config=number_format, hide_index=True, use_container_width=True
+)
+
+st.subheader("📄 页面 rerun")
+st.dataframe(
+    summary[summary["kind"] == perf_monitor.PAGE].drop(columns=["kind", "avg_rows"]),
+    column_config=number_format, hide_index=True, use_container_width=True
+)
+
+# --- 区域 3：最慢的调用 ---
+st.subheader("🐢 最慢的调用")
+top_n = st.slider("显示条数", 10, 200, 50, step=10)
+st.dataframe(
+    perf_monitor.slowest(events, top_n)[["time", "kind", "name", "ms", "rows", "user", "error"]],
+    column_config={"ms": st.column_config.NumberColumn(format="%.1f")},
+    hide_index=True, use_container_width=True
+)
+
+# --- 区域 4：导出 ---
+st.subheader("📦 导出")
+stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+d1, d2 = st.columns(2)
+d1.download_button(
+    "下载原始事件 (CSV)", events.drop(columns="ts").to_csv(index=False).encode("utf-8-sig"),
+    file_name=f"perf_events_{stamp}.csv", mime="text/csv"
+)
+d2.download_button(
+    "下载汇总 (JSON)", summary.to_json(orient="records", force_ascii=False, indent=2),
+    file_name=f"perf_summary_{stamp}.json", mime="application/json"
+)
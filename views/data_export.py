@@ -0,0 +1,71 @@
+import os
+import re
+import streamlit as st
+from datetime import datetime
+import db_manager as db
+import exporter
+from chart_picker import chart_filters, select_chart
+
+st.title("📦 导出数据")
+st.markdown("把打歌记录或谱面标注导出为 **CSV**（Excel 可直接打开）或 **Parquet**（体积小，适合 pandas 分析）。")
+
+current_user = st.session_state.get("username", None)
+if not current_user:
+    st.error("请先登录")
+    st.stop()
+is_admin = st.session_state.get("role") == "admin"
+
+# ============================ 选择导出内容 ============================
+kind = st.radio("导出内容", ["我的打歌记录", "谱面标注"], horizontal=True)
+fmt = st.radio("文件格式", list(exporter.FORMATS), horizontal=True)
+
+if kind == "我的打歌记录":
+    username = current_user
+    if is_admin:
+        username = st.text_input("用户名（管理员可导出任意用户）", value=current_user).strip()
+    chunks_factory = lambda: db.iter_play_records(username)
+    name = f"play_records_{username}"
+else:
+    scope = st.radio("范围", ["单张谱面", "全部谱面"], horizontal=True)
+    if scope == "单张谱面":
+        with st.expander("🎛️ 筛选谱面", expanded=True):
+            filters = chart_filters()
+        chart = select_chart(filters, "选择谱面", key="export_chart")
+        if chart is None:
+            st.warning("没有符合条件的谱面，请调整筛选条件。")
+            st.stop()
+        chart_id = int(chart["song_id"])
+        chunks_factory = lambda: db.iter_annotations(chart_id)
+        name = f"annotations_{chart_id}"
+    else:
+        chunks_factory = lambda: db.iter_annotations()
+        name = "annotations_all"
+
+# ============================ 生成文件 ============================
+if st.button("生成导出文件", type="primary"):
+    previous = st.session_state.pop("export_file", None)
+    if previous and os.path.exists(previous["path"]):
+        os.remove(previous["path"])
+    try:
+        with st.spinner("正在分块读取并写入文件…"):
+            prefix = re.sub(r"[^\w-]", "_", name)
+            path, rows = exporter.export_to_file(chunks_factory(), fmt, prefix)
+        if path is None:
+            st.info("没有可导出的数据")
+        else:
+            ext, mime = exporter.FORMATS[fmt]
+            st.session_state["export_file"] = {
+                "path": path, "rows": rows, "mime": mime,
+                "file_name": f"{prefix}_{datetime.now():%Y%m%d_%H%M%S}.{ext}",
+            }
+    except Exception as e:
+        st.error(f"导出失败: {e}")
+
+export_file = st.session_state.get("export_file")
+if export_file and os.path.exists(export_file["path"]):
+    size_mb = os.path.getsize(export_file["path"]) / 1024 / 1024
+    st.success(f"已生成 {export_file['rows']} 行，{size_mb:.2f} MB")
+    with open(export_file["path"], "rb") as f:
+        st.download_button(
+            "⬇️ 下载", f, file_name=export_file["file_name"], mime=export_file["mime"]
+        )
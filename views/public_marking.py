@@ -1,7 +1,16 @@
+import json
+import uuid
 import streamlit as st
 import pandas as pd
 import streamlit.components.v1 as components
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
 import db_manager as db
+import db_async
+import image_store
+import live_hub
+from chart_picker import chart_filters, select_chart
+from tech_tags import TECH_TAGS
 
 # ================= 样式优化 =================
 st.markdown("""
@@ -92,12 +101,213 @@ def display_html_viewer(image_url, height=850):
     except Exception as e:
         st.error(f"加载失败: {e}")
 
-# ================= 主程序逻辑 =================
+# ================= HTML/JS 切片懒加载查看器 =================
+def display_tiled_viewer(assets, height=850, jump_section=None):
+    """
+    先显示低清预览图，放大到预览图分辨率不够时才加载视野内的切片；
+    jump_section 不为空且谱面记录了小节总数时，直接定位到该段落
+    """
+    try:
+        config = json.dumps({
+            "width": assets["width"],
+            "height": assets["height"],
+            "previewWidth": assets["preview"]["width"],
+            "tiles": assets["tiles"],
+            "sectionCount": assets.get("section_count") or 0,
+            "jump": int(jump_section) if jump_section else 0,
+        })
+        html_code = f"""
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <style>
+                body {{ margin: 0; padding: 0; background-color: #ffffff; overflow: hidden; }}
+                #container {{
+                    position: relative; width: 100vw; height: {height}px;
+                    overflow: hidden; cursor: grab; touch-action: none;
+                    border: 1px solid #e0e0e0; border-radius: 8px;
+                }}
+                #container:active {{ cursor: grabbing; }}
+                #stage {{
+                    position: absolute; left: 0; top: 0; transform-origin: 0 0;
+                    box-shadow: 0 5px 15px rgba(0,0,0,0.1);
+                }}
+                #stage img {{ position: absolute; left: 0; width: 100%; user-select: none; }}
+                #preview {{ top: 0; height: 100%; }}
+                .tile {{ opacity: 0; transition: opacity 0.2s; }}
+                .controls {{
+                    position: absolute; top: 10px; right: 20px; z-index: 100;
+                    background: rgba(0,0,0,0.6); padding: 5px 10px; border-radius: 20px;
+                    color: white; font-family: sans-serif; font-size: 12px; pointer-events: none;
+                }}
+                .zoom {{ position: absolute; bottom: 16px; right: 20px; z-index: 100; }}
+                .zoom button {{
+                    width: 36px; height: 36px; margin-left: 6px; border: none; border-radius: 18px;
+                    background: rgba(0,0,0,0.6); color: white; font-size: 18px;
+                }}
+            </style>
+        </head>
+        <body>
+            <div class="controls">🖱️ 滚轮缩放 | ✋ 拖拽平移 | 双击复位</div>
+            <div class="zoom"><button id="zoom-in">＋</button><button id="zoom-out">－</button></div>
+            <div id="container">
+                <div id="stage">
+                    <img id="preview" src="{assets['preview']['url']}" draggable="false">
+                </div>
+            </div>
+            <script>
+                const cfg = {config};
+                const container = document.getElementById('container');
+                const stage = document.getElementById('stage');
+                stage.style.width = cfg.width + 'px';
+                stage.style.height = cfg.height + 'px';
+
+                // 切片占位（src 在进入视野时才设置）
+                const tiles = cfg.tiles.map(t => {{
+                    const img = document.createElement('img');
+                    img.className = 'tile'; img.draggable = false;
+                    img.style.top = t.y + 'px'; img.style.height = t.height + 'px';
+                    img.onload = () => {{ img.style.opacity = 1; }};
+                    stage.appendChild(img);
+                    return {{ img: img, url: t.url, y: t.y, h: t.height, loaded: false }};
+                }});
+
+                let scale = 1; let pointX = 0; let pointY = 0;
+                let panning = false; let startX = 0; let startY = 0;
+                let pending = false;
+
+                function loadVisibleTiles() {{
+                    pending = false;
+                    // 屏幕上的显示宽度没超过预览图分辨率时，预览图已经够清楚
+                    if (cfg.width * scale <= cfg.previewWidth * 1.05) return;
+                    const margin = container.clientHeight * 0.5;
+                    for (const t of tiles) {{
+                        if (t.loaded) continue;
+                        const top = pointY + t.y * scale;
+                        const bottom = top + t.h * scale;
+                        if (bottom > -margin && top < container.clientHeight + margin) {{
+                            t.img.src = t.url; t.loaded = true;
+                        }}
+                    }}
+                }}
+                function setTransform() {{
+                    stage.style.transform = `translate(${{pointX}}px, ${{pointY}}px) scale(${{scale}})`;
+                    if (!pending) {{ pending = true; requestAnimationFrame(loadVisibleTiles); }}
+                }}
+                function fitAll() {{
+                    scale = Math.min(container.clientWidth * 0.95 / cfg.width, container.clientHeight * 0.95 / cfg.height);
+                    pointX = (container.clientWidth - cfg.width * scale) / 2;
+                    pointY = (container.clientHeight - cfg.height * scale) / 2;
+                    setTransform();
+                }}
+                function jumpTo(section) {{
+                    if (!cfg.sectionCount || section < 1) return false;
+                    const y = (Math.min(section, cfg.sectionCount) - 1) / cfg.sectionCount * cfg.height;
+                    scale = container.clientWidth * 0.95 / cfg.width;
+                    pointX = (container.clientWidth - cfg.width * scale) / 2;
+                    pointY = -y * scale + 10;
+                    setTransform();
+                    return true;
+                }}
+                function zoomAt(cx, cy, factor) {{
+                    const xs = (cx - pointX) / scale;
+                    const ys = (cy - pointY) / scale;
+                    scale = Math.max(0.02, scale * factor);
+                    pointX = cx - xs * scale;
+                    pointY = cy - ys * scale;
+                    setTransform();
+                }}
 
-# 1. 从数据库加载谱面列表
-charts_df = db.get_all_charts()
+                container.onpointerdown = function (e) {{
+                    e.preventDefault(); container.setPointerCapture(e.pointerId);
+                    startX = e.clientX - pointX; startY = e.clientY - pointY; panning = true;
+                }};
+                container.onpointerup = function (e) {{ panning = false; }};
+                container.onpointercancel = function (e) {{ panning = false; }};
+                container.onpointermove = function (e) {{
+                    if (!panning) return;
+                    pointX = (e.clientX - startX);
+                    pointY = (e.clientY - startY);
+                    setTransform();
+                }};
+                container.onwheel = function (e) {{
+                    e.preventDefault();
+                    zoomAt(e.clientX, e.clientY, (-e.deltaY > 0) ? 1.1 : 1 / 1.1);
+                }};
+                container.ondblclick = function (e) {{ fitAll(); }};
+                document.getElementById('zoom-in').onclick = () => zoomAt(container.clientWidth / 2, container.clientHeight / 2, 1.25);
+                document.getElementById('zoom-out').onclick = () => zoomAt(container.clientWidth / 2, container.clientHeight / 2, 0.8);
 
-if charts_df.empty:
+                if (!jumpTo(cfg.jump)) fitAll();
+            </script>
+        </body>
+        </html>
+        """
+        components.html(html_code, height=height + 20)
+    except Exception as e:
+        st.error(f"加载失败: {e}")
+
+# ================= 段落共识热力图 =================
+def section_heatmap(stats, height=850, section_count=None):
+    """
+    左列：每段的共识难度（专家评分均值）；右侧：每段各技术特征被标注的次数
+    """
+    sections = stats["sections"].set_index("section")
+    last = int(section_count or sections.index.max())
+    full = pd.RangeIndex(1, last + 1, name="section")
+    sections = sections.reindex(full)
+
+    hits = stats["tags"].assign(tag=stats["tags"]["tag"].astype(str))
+    tag_order = [t for t in TECH_TAGS if t in set(hits["tag"])]
+    tag_order += sorted(set(hits["tag"]) - set(tag_order))
+    grid = (hits.pivot_table(index="section", columns="tag", values="hits", aggfunc="sum")
+            .reindex(index=full, columns=tag_order).fillna(0))
+
+    fig = make_subplots(rows=1, cols=2, shared_yaxes=True, column_widths=[0.18, 0.82], horizontal_spacing=0.02)
+    fig.add_trace(go.Heatmap(
+        z=sections[["consensus_rating"]].to_numpy(dtype="float64", na_value=float("nan")),
+        x=["难度"], y=full, zmin=1, zmax=5, colorscale="Reds", showscale=False,
+        customdata=sections[["annotator_count", "annotation_count"]].fillna(0).to_numpy()[:, None, :],
+        hovertemplate="#%{y} 共识难度 %{z:.1f}⭐<br>%{customdata[0]} 人 · %{customdata[1]} 条标注<extra></extra>",
+    ), row=1, col=1)
+    fig.add_trace(go.Heatmap(
+        z=grid.to_numpy(), x=[t.split(" (")[0] for t in tag_order], y=full,
+        colorscale="Blues", showscale=False,
+        hovertemplate="#%{y} %{x}：%{z} 次<extra></extra>",
+    ), row=1, col=2)
+    fig.update_yaxes(autorange="reversed", title_text="段落", row=1, col=1)
+    fig.update_xaxes(side="top", tickangle=-60)
+    fig.update_layout(height=height, margin=dict(l=0, r=0, t=60, b=0))
+    return fig
+
+def render_annotation(row):
+    contributor = row['annotator'] if row['annotator'] else '未知'
+    label = f"#{row['start_section']}-{row['end_section']} {row['tags'].split(',')[0]} (by {contributor})"
+
+    with st.expander(label):
+        st.write(f"**贡献者**: {contributor}")
+        st.write(f"**标签**: {row['tags']}")
+        st.write(f"**描述**: {row['desc_text']}")
+        st.write(f"**难度**: {'⭐'*int(row['expert_rating'])}")
+
+        st.button(
+            f"📍 跳转到 #{row['start_section']}", key=f"jump_{row['annotation_id']}",
+            on_click=lambda sec=int(row['start_section']): st.session_state.update(
+                marking_jump=(int(current_chart_id), sec)
+            )
+        )
+
+        can_delete = (current_role == 'admin') or (str(contributor) == str(current_user))
+        if can_delete:
+            if st.button("🗑️ 删除", key=f"del_{row['annotation_id']}"):
+                db.delete_annotation(row['annotation_id'])
+                st.success("删除成功")
+                st.rerun()
+
+# ================= 主程序逻辑 =================
+
+# 1. 谱面库为空时直接提示（筛选项走缓存，不拉全表）
+if not db.get_chart_facets()["difficulties"]:
     st.warning("⚠️ 谱面库为空，请联系管理员上传谱面。")
     st.stop()
 
@@ -105,68 +315,74 @@ if charts_df.empty:
 with st.sidebar:
     st.header("🎛️ 标注控制台")
 
-    # ======== ① 搜索歌名 ========
-    search_text = st.text_input("搜索歌名", placeholder="输入关键字…")
-
-    # ======== ② 难度筛选 ========
-    all_difficulties = sorted(charts_df["difficulty"].unique())
-    selected_difficulty = st.multiselect(
-        "筛选难度", 
-        all_difficulties,
-        default=all_difficulties
-    )
-
-    # ======== ③ 等级筛选（单选） ========
-    all_levels = sorted(charts_df["level"].dropna().unique().tolist())
-    selected_level = st.selectbox(
-        "筛选等级（Lv）", 
-        ["全部"] + [str(lv) for lv in all_levels]
-    )
-
-    # ======== ④ 应用过滤逻辑 ========
-    filtered_df = charts_df[
-        charts_df["difficulty"].isin(selected_difficulty) &
-        charts_df["song_name"].str.contains(search_text, case=False, na=False)
-    ]
+    # ======== ①-③ 歌名 / 难度 / 等级筛选（在数据库端完成） ========
+    filters = chart_filters()
 
-    if selected_level != "全部":
-        filtered_df = filtered_df[filtered_df["level"] == int(selected_level)]
+    # ======== ④ 分页选择谱面 ========
+    selected_row = select_chart(filters, "选择谱面", key="marking_chart")
 
     # 无结果提示
-    if filtered_df.empty:
+    if selected_row is None:
         st.warning("没有符合条件的谱面，请调整筛选条件。")
         st.stop()
 
-    # ======== ⑤ 构建下拉选项 ========
-    chart_options = filtered_df.apply(
-        lambda x: f"ID:{x['song_id']} | {x['song_name']} ({x['difficulty']}, Lv{x['level']})",
-        axis=1
-    )
-
-    selected_label = st.selectbox("选择谱面", chart_options)
-
-    # ======== ⑥ 获取选中的谱面 ========
-    selected_row = filtered_df[
-        chart_options == selected_label
-    ].iloc[0]
-
     current_chart_id = selected_row["song_id"]
     current_chart_name = selected_row["song_name"]
     image_url = selected_row["chart_image_path"]
 
-# ================= 主界面：大图展示 =================
-if image_url:
-    display_html_viewer(image_url, height=850)
+# ================= 主界面：大图展示 + 段落共识热力图 =================
+# 段落汇总和标注列表保存在会话里，别人新增 / 删除标注时由 live_hub 推送变更行增量合并；
+# 只有换谱面、订阅过期或推送积压时才重新查询
+live_token = st.session_state.setdefault("live_token", uuid.uuid4().hex)
+view = st.session_state.get("marking_view")
+events = None
+if view is not None and view["chart_id"] == int(current_chart_id):
+    events = live_hub.drain(live_token, current_chart_id)
+
+if events is None or live_hub.apply_events(view, events):
+    # 先订阅再查询，查询期间的写入不会漏掉（重复合并是幂等的）
+    live_hub.subscribe(live_token, current_chart_id)
+    # 切片清单和段落汇总互不依赖，并发查询
+    chart_assets, section_stats = db_async.gather(
+        lambda: db.get_chart_assets(current_chart_id),
+        lambda: db.get_chart_section_stats(current_chart_id),
+    )
+    view = {"chart_id": int(current_chart_id), "stats": section_stats, "annotations": None}
+    st.session_state["marking_view"] = view
 else:
-    st.error("❌ 图片链接无效")
+    chart_assets = db.get_chart_assets(current_chart_id)
+    section_stats = view["stats"]
 
-# ================= 标注表单（保持原样） =================
+# 有切片资源的谱面走懒加载查看器，旧谱面仍整图加载
+jump = st.session_state.get("marking_jump")
+jump_section = jump[1] if jump and jump[0] == int(current_chart_id) else None
 
-TECH_TAGS = [
-    "交互 (Trill)", "楼梯 (Stairs)", "纵连 (Jack)", "划键 (Flick)","大跨度 (Jump)", 
-    "多押 (Chord)", "变速 (Soflan)", "读谱难 (Reading)", 
-    "耐力 (Stamina)", "锁手 (Tech)", "各显神通 (Gimmick)"
-]
+if section_stats["sections"].empty:
+    view_col, heat_col = st.container(), None
+else:
+    view_col, heat_col = st.columns([4, 1])
+
+with view_col:
+    if chart_assets and chart_assets.get("tiles"):
+        if chart_assets.get("section_count"):
+            jump_section = st.number_input(
+                "📍 跳转到段落 #", min_value=1, max_value=int(chart_assets["section_count"]),
+                value=jump_section, placeholder="输入段落号直接定位", key=f"jump_input_{current_chart_id}_{jump_section}"
+            )
+        display_tiled_viewer(image_store.resolve_assets(chart_assets), height=850, jump_section=jump_section)
+    elif image_url:
+        display_html_viewer(image_store.resolve_url(image_url), height=850)
+    else:
+        st.error("❌ 图片链接无效")
+
+if heat_col is not None:
+    with heat_col:
+        st.plotly_chart(
+            section_heatmap(section_stats, section_count=(chart_assets or {}).get("section_count")),
+            use_container_width=True, config={"displayModeBar": False}
+        )
+
+# ================= 标注表单（保持原样） =================
 
 current_user = st.session_state.get("username", "Unknown")
 current_role = st.session_state.get("role", "user")
@@ -207,29 +423,59 @@ with st.sidebar:
                     st.error(f"保存失败: {e}")
 
 # ================= 社区标注记录 =================
+@st.fragment(run_every=live_hub.POLL_SECONDS)
+def live_updates(token):
+    """
+    定时看一眼本会话的推送队列（纯内存），有新的标注变更时整页重跑合并
+    """
+    if live_hub.pending(token) != 0:
+        st.rerun()
+    c1, c2 = st.columns([3, 1])
+    c1.caption("🟢 实时同步中：同一谱面上其他人的新标注会自动出现")
+    # 推送只覆盖本进程内的写入，多进程部署时可手动重新加载
+    if c2.button("🔄", key="live_reload", help="从数据库重新加载标注"):
+        st.session_state.pop("marking_view", None)
+        st.rerun()
+
 with st.sidebar:
     st.markdown("---")
     st.markdown("### 3. 社区标注记录")
+    live_updates(live_token)
 
-    current_anns = db.get_annotations(chart_id=int(current_chart_id))
-
-    if not current_anns.empty:
-        st.caption(f"共 {len(current_anns)} 条")
-        for idx, row in current_anns[::-1].iterrows():
-            contributor = row['annotator'] if row['annotator'] else '未知'
-            label = f"#{row['start_section']}-{row['end_section']} {row['tags'].split(',')[0]} (by {contributor})"
-
-            with st.expander(label):
-                st.write(f"**贡献者**: {contributor}")
-                st.write(f"**标签**: {row['tags']}")
-                st.write(f"**描述**: {row['desc_text']}")
-                st.write(f"**难度**: {'⭐'*int(row['expert_rating'])}")
-
-                can_delete = (current_role == 'admin') or (str(contributor) == str(current_user))
-                if can_delete:
-                    if st.button("🗑️ 删除", key=f"del_{row['annotation_id']}"):
-                        db.delete_annotation(row['annotation_id'])
-                        st.success("删除成功")
-                        st.rerun()
-    else:
+    # 按需加载：选了段落或打开「全部」时才取标注、逐条渲染
+    sections = section_stats["sections"]
+    if sections.empty:
         st.info("暂无标注")
+    else:
+        st.caption(f"{len(sections)} 个段落有标注，单段最多 {int(sections['annotator_count'].max())} 人")
+        section_key = f"ann_section_{current_chart_id}"
+        counts = dict(zip(sections["section"].astype(int), sections["annotation_count"]))
+
+        def jump_to_section():
+            # 选中段落时查看器同步定位过去
+            if st.session_state[section_key] is not None:
+                st.session_state["marking_jump"] = (int(current_chart_id), st.session_state[section_key])
+
+        picked = st.selectbox(
+            "查看段落标注", [None] + list(counts),
+            format_func=lambda sec: "选择段落…" if sec is None else f"#{sec} · {counts[sec]} 条",
+            key=section_key, on_change=jump_to_section
+        )
+        show_all = st.toggle("显示全部标注", key=f"ann_all_{current_chart_id}")
+
+        if picked is not None or show_all:
+            if view["annotations"] is None:
+                view["annotations"] = db.get_annotations(chart_id=int(current_chart_id))
+            current_anns = view["annotations"]
+            if picked is not None and not show_all:
+                current_anns = current_anns[
+                    (current_anns["start_section"] <= picked) & (current_anns["end_section"] >= picked)
+                ]
+            limit_key = f"ann_limit_{current_chart_id}"
+            limit = st.session_state.get(limit_key, 20)
+            st.caption(f"共 {len(current_anns)} 条，最新的在前")
+            for idx, row in current_anns[::-1].head(limit).iterrows():
+                render_annotation(row)
+            if len(current_anns) > limit:
+                st.button("加载更多", key=f"ann_more_{current_chart_id}",
+                          on_click=lambda: st.session_state.update({limit_key: limit + 20}))
@@ -0,0 +1,68 @@
+import streamlit as st
+import db_manager as db
+import image_store
+from tech_tags import TECH_TAGS
+
+st.title("🔎 按技术找谱面")
+st.markdown("**按社区标注的技术特征组合检索谱面，例如「交互 + 纵连、专家评分 4 分以上」。**")
+
+facets = db.get_chart_facets()
+
+# --- 区域 1：检索条件 ---
+c1, c2 = st.columns([3, 1])
+with c1:
+    selected_tags = st.multiselect("技术特征", TECH_TAGS, placeholder="选择一个或多个技术特征")
+with c2:
+    match_mode = st.radio("匹配方式", ["包含全部", "包含任一"], horizontal=True)
+
+c3, c4, c5 = st.columns(3)
+with c3:
+    min_rating = st.slider("最低专家评分", 1, 5, 1, help="只统计评分不低于该值的标注；1 表示不限")
+with c4:
+    all_difficulties = facets["difficulties"]
+    selected_difficulty = st.multiselect("难度", all_difficulties, default=all_difficulties)
+with c5:
+    levels = facets["levels"] or [1]
+    lo, hi = int(min(levels)), int(max(levels))
+    if lo == hi:
+        # 只有一个等级时没有范围可选（st.slider 要求 min < max）
+        level_range = (lo, hi)
+        st.caption(f"等级：{lo}")
+    else:
+        level_range = st.slider("等级范围", lo, hi, (lo, hi))
+
+if not selected_tags:
+    st.info("先选择至少一个技术特征。")
+    st.stop()
+
+# --- 区域 2：结果 ---
+results = db.search_charts_by_tags(
+    selected_tags,
+    min_rating=None if min_rating <= 1 else min_rating,
+    match_all=match_mode == "包含全部",
+    # 全选 / 全范围时不下推条件，只走标签索引
+    difficulties=None if len(selected_difficulty) == len(all_difficulties) else selected_difficulty,
+    level_range=None if level_range == (lo, hi) else level_range,
+)
+
+if results.empty:
+    st.warning("没有符合条件的谱面，试试放宽评分或改成「包含任一」。")
+    st.stop()
+
+st.caption(f"共 {len(results)} 张谱面（最多显示 100 张），命中的技术特征多、相关标注多的排在前面")
+listing = results[["song_id", "song_name", "difficulty", "level", "matched_tags", "annotation_hits", "best_rating"]].copy()
+listing.insert(0, "thumb", results["chart_image_path"].map(lambda ref: image_store.thumbnail_url(ref, 120)))
+st.dataframe(
+    listing,
+    column_config={
+        "thumb": st.column_config.ImageColumn("缩略图", width="small"),
+        "song_name": "歌名",
+        "difficulty": "难度",
+        "level": "等级",
+        "matched_tags": st.column_config.NumberColumn("命中特征数"),
+        "annotation_hits": st.column_config.NumberColumn("相关标注数"),
+        "best_rating": st.column_config.NumberColumn("最高评分", format="%d ⭐"),
+    },
+    use_container_width=True,
+    hide_index=True
+)
@@ -1,5 +1,5 @@
 import streamlit as st
-import db_manager as db
+import write_behind
 
 st.title("💬 用户反馈与报错")
 st.markdown("遇到 Bug 或者有功能建议？请告诉我们！")
@@ -18,8 +18,8 @@ with st.form("feedback_form"):
             st.error("请填写描述内容！")
         else:
             try:
-                # 调用数据库管家写入数据
-                db.add_feedback(
+                # 开启后写队列时先落本地日志，后台批量写库
+                write_behind.submit_feedback(
                     username=st.session_state.username,
                     feedback_type=fb_type,
                     content=content
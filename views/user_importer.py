@@ -0,0 +1,144 @@
+import json
+import streamlit as st
+import pandas as pd
+import db_manager as db
+
+st.title("📥 导入历史记录")
+st.markdown("把表格里积累的练习日志一次性导入。支持 **CSV** 与 **JSON Lines**（每行一个 JSON 对象），也支持普通 JSON 数组。")
+
+current_user = st.session_state.get("username", None)
+if not current_user:
+    st.error("请先登录")
+    st.stop()
+
+# 每次从上传文件里读多少行做一次校验 + 批量写入
+CHUNK_ROWS = 2000
+
+with st.expander("📄 文件格式说明"):
+    st.markdown("""
+- 定位谱面：提供 `chart_id`，或同时提供 `song_name` + `difficulty`（需与谱面库完全一致）
+- `miss_section`：失误段落（必填，>= 1）
+- `practice_count`：练习次数（可选，默认 0）
+- `cause`：失误原因（可选，默认「其他」）
+- `comment`：备注（可选）
+- `play_time`：游玩时间（可选，如 `2024-05-01 21:30`，为空时记为导入时间）
+""")
+    st.code("song_name,difficulty,miss_section,practice_count,cause,play_time\nFreedom Dive,Master,12,5,手速跟不上,2024-05-01 21:30", language="csv")
+
+uploaded = st.file_uploader("选择文件", type=["csv", "json", "jsonl"])
+dry_run = st.checkbox("仅校验，不写入", value=False)
+
+# ============================ 工具函数 ============================
+def iter_chunks(file_obj, name):
+    """
+    把上传文件按块读成 DataFrame（CSV / JSON Lines 流式读取，不整体载入）
+    """
+    lower = name.lower()
+    if lower.endswith(".csv"):
+        yield from pd.read_csv(file_obj, chunksize=CHUNK_ROWS, dtype=str, keep_default_na=False)
+        return
+
+    head = file_obj.read(1)
+    while head and head.isspace():
+        head = file_obj.read(1)
+    file_obj.seek(0)
+    if head == b"[":
+        # 普通 JSON 数组无法流式解析，只能整体读入后再分块
+        rows = pd.DataFrame(json.loads(file_obj.read().decode("utf-8")))
+        for start in range(0, len(rows), CHUNK_ROWS):
+            yield rows.iloc[start:start + CHUNK_ROWS]
+    else:
+        yield from pd.read_json(file_obj, lines=True, chunksize=CHUNK_ROWS, dtype=False)
+
+def text_col(df, name):
+    if name not in df.columns:
+        return pd.Series("", index=df.index)
+    return df[name].fillna("").astype(str).str.strip()
+
+def validate_chunk(chunk, catalog, offset):
+    """
+    一次性（向量化）校验一块数据，返回 (可写入的记录列表, 错误 DataFrame)
+    """
+    df = chunk.reset_index(drop=True).copy()
+    df["row_no"] = range(offset + 1, offset + len(df) + 1)
+    df["error"] = ""
+
+    # ① 关联谱面库
+    if (text_col(df, "chart_id") != "").any():
+        df["chart_id"] = pd.to_numeric(text_col(df, "chart_id"), errors="coerce")
+        merged = df.merge(
+            catalog, left_on="chart_id", right_on="song_id", how="left", suffixes=("_in", "")
+        )
+    elif {"song_name", "difficulty"} <= set(df.columns):
+        # 同名同难度的谱面有多张时无法确定，按不存在处理
+        unique_catalog = catalog.drop_duplicates(["song_name", "difficulty"], keep=False)
+        df["song_name"] = text_col(df, "song_name")
+        df["difficulty"] = text_col(df, "difficulty")
+        merged = df.merge(unique_catalog, on=["song_name", "difficulty"], how="left", suffixes=("_in", ""))
+    else:
+        df["error"] = "缺少 chart_id 或 song_name + difficulty 列"
+        return [], df[["row_no", "error"]]
+
+    def flag(mask, message):
+        merged["error"] = merged["error"].mask((merged["error"] == "") & mask, message)
+
+    flag(merged["song_id"].isna(), "谱面不存在或不唯一")
+
+    # ② 数值字段
+    miss = pd.to_numeric(text_col(merged, "miss_section"), errors="coerce")
+    flag(~(miss >= 1), "miss_section 无效")
+
+    raw_practice = text_col(merged, "practice_count")
+    practice = pd.to_numeric(raw_practice.where(raw_practice != "", "0"), errors="coerce")
+    flag(~(practice >= 0), "practice_count 无效")
+
+    # ③ 时间字段
+    raw_time = text_col(merged, "play_time")
+    play_time = pd.to_datetime(raw_time.where(raw_time != ""), errors="coerce")
+    flag((raw_time != "") & play_time.isna(), "play_time 无法解析")
+
+    # ④ 文本字段
+    cause = text_col(merged, "cause")
+    cause = cause.where(cause != "", "其他")
+
+    ok = merged["error"] == ""
+    records = pd.DataFrame({
+        "username": current_user,
+        "chart_id": merged.loc[ok, "song_id"].astype(int),
+        "song_name": merged.loc[ok, "song_name"],
+        "difficulty": merged.loc[ok, "difficulty"],
+        "level": merged.loc[ok, "level"],
+        "practice_count": practice[ok].astype(int),
+        "miss_section": miss[ok].astype(int),
+        "cause": cause[ok],
+        "comment": text_col(merged, "comment")[ok],
+        "play_time": play_time[ok].astype(object).where(play_time[ok].notna(), None),
+    }).to_dict("records")
+    return records, merged.loc[~ok, ["row_no", "error"]]
+
+# ============================ 执行导入 ============================
+if uploaded is not None and st.button("🚀 开始" + ("校验" if dry_run else "导入"), type="primary"):
+    catalog = db.get_all_charts()[["song_id", "song_name", "difficulty", "level"]]
+    progress = st.progress(0.0, text="处理中…")
+    total_rows, imported = 0, 0
+    errors = []
+
+    try:
+        for chunk in iter_chunks(uploaded, uploaded.name):
+            records, bad = validate_chunk(chunk, catalog, total_rows)
+            total_rows += len(chunk)
+            errors.append(bad)
+            if records and not dry_run:
+                imported += db.add_play_records_bulk(records)
+            elif records:
+                imported += len(records)
+            progress.progress(min(uploaded.tell() / max(uploaded.size, 1), 1.0), text=f"已处理 {total_rows} 行")
+    except Exception as e:
+        st.error(f"导入中断: {e}（此前的批次已写入 {imported} 行）")
+    progress.empty()
+
+    bad_rows = pd.concat(errors, ignore_index=True) if errors else pd.DataFrame()
+    verb = "可导入" if dry_run else "已导入"
+    st.success(f"共 {total_rows} 行，{verb} {imported} 行，失败 {len(bad_rows)} 行")
+    if not bad_rows.empty:
+        st.dataframe(bad_rows.head(500), use_container_width=True, hide_index=True)
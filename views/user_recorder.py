@@ -1,6 +1,8 @@
 import streamlit as st
-import pandas as pd
 import db_manager as db
+import db_async
+import write_behind
+from chart_picker import chart_filters, select_chart
 
 st.title("📊 我的游玩记录")
 
@@ -10,68 +12,24 @@ if not current_user:
     st.error("请先登录")
     st.stop()
 
-# 读取谱面列表
-charts_df = db.get_all_charts()
-if charts_df.empty:
+# 谱面库为空时直接提示（筛选项走缓存，不拉全表）
+if not db.get_chart_facets()["difficulties"]:
     st.warning("⚠️ 谱面库空")
     st.stop()
 
 # ============================ 侧边栏筛选区域 ============================
 with st.sidebar:
     st.header("🎛️ 筛选曲目")
+    filters = chart_filters(show_sort=True)
 
-    # ① 搜索歌名
-    search_text = st.text_input("搜索歌名", placeholder="输入关键词…")
-
-    # ② 难度筛选
-    all_diff = sorted(charts_df["difficulty"].unique())
-    selected_diff = st.multiselect("难度", all_diff, default=all_diff)
-
-    # ③ 等级筛选（单一等级）
-    all_lv = sorted(charts_df["level"].dropna().unique().tolist())
-    selected_lv = st.selectbox(
-        "选择等级 Lv", ["全部"] + [str(lv) for lv in all_lv]
-    )
-
-    # ④ 等级排序方式
-    sort_mode = st.radio(
-        "等级排序方式",
-        ["默认", "从低到高 (升序)", "从高到低 (降序)"]
-    )
-
-# ============================ 筛选逻辑 ============================
-
-filtered = charts_df[
-    charts_df["difficulty"].isin(selected_diff) &
-    charts_df["song_name"].str.contains(search_text, case=False, na=False)
-]
-
-if selected_lv != "全部":
-    filtered = filtered[filtered["level"] == int(selected_lv)]
-
-# 排序
-if sort_mode == "从低到高 (升序)":
-    filtered = filtered.sort_values(by="level", ascending=True)
-elif sort_mode == "从高到低 (降序)":
-    filtered = filtered.sort_values(by="level", ascending=False)
+# ============================ 下拉选择曲目（数据库端筛选 + 分页） ============================
+selected_row = select_chart(filters, "选择你游玩的谱面", key="recorder_chart")
 
 # 空过滤提示
-if filtered.empty:
+if selected_row is None:
     st.warning("没有符合条件的谱面，请调整筛选条件。")
     st.stop()
 
-# ============================ 下拉选择曲目 ============================
-chart_options = filtered.apply(
-    lambda x: f"ID:{x['song_id']} | {x['song_name']} ({x['difficulty']}, Lv{x['level']})",
-    axis=1
-)
-
-selected_label = st.selectbox("选择你游玩的谱面", chart_options)
-
-selected_row = filtered[
-    chart_options == selected_label
-].iloc[0]
-
 chart_id = selected_row["song_id"]
 song_name = selected_row["song_name"]
 difficulty = selected_row["difficulty"]
@@ -103,7 +61,7 @@ with st.form("record_form"):
 
     if submitted:
         try:
-            db.add_play_record({
+            queued = write_behind.submit_play_record({
                 "username": current_user,
                 "chart_id": chart_id,
                 "song_name": song_name,
@@ -114,7 +72,13 @@ with st.form("record_form"):
                 "cause": cause,
                 "comment": comment
             })
-            st.success("🎉 已成功记录练习情况")
+            if queued:
+                # 后写队列：数据已落本地日志，几秒内写入数据库，历史表格稍后刷新即可看到
+                st.toast("🎉 已记录练习情况，正在后台保存")
+            else:
+                st.success("🎉 已成功记录练习情况")
+            # 新记录在最前面，历史表格回到第一页
+            st.session_state.pop("history_pages", None)
             st.rerun()
         except Exception as e:
             st.error(f"保存失败: {e}")
@@ -123,13 +87,46 @@ with st.form("record_form"):
 st.markdown("---")
 st.subheader("📜 我的历史记录")
 
-records = db.get_play_records(current_user)
-
-if not records.empty:
-    st.dataframe(
-        records[["song_name", "difficulty", "level", "practice_count", "miss_section", "cause", "comment", "play_time"]],
-        use_container_width=True,
-        hide_index=True
-    )
-else:
-    st.info("暂无记录")
+HISTORY_PAGE_SIZES = [20, 50, 100]
+
+@st.fragment
+def render_history(username):
+    """
+    历史记录分页表格（翻页只重跑这一块，每次只查一页）
+    """
+    pages = st.session_state.setdefault("history_pages", {"cursors": [None], "index": 0})
+    page_size = st.selectbox("每页条数", HISTORY_PAGE_SIZES, key="history_page_size",
+                             on_change=lambda: st.session_state.pop("history_pages", None))
+
+    try:
+        total, (records, next_cursor) = db_async.gather(
+            lambda: db.count_play_records(username),
+            lambda: db.get_play_records_page(username, cursor=pages["cursors"][pages["index"]], limit=page_size),
+        )
+    except Exception as e:
+        st.error(f"读取历史记录失败: {e}")
+        return
+
+    if records.empty:
+        st.info("暂无记录")
+        return
+
+    start = pages["index"] * page_size
+    st.caption(f"第 {start + 1}–{start + len(records)} 条，共 {total} 条")
+    st.dataframe(records.drop(columns="record_id"), use_container_width=True, hide_index=True)
+
+    def go_prev():
+        pages["index"] -= 1
+
+    def go_next():
+        del pages["cursors"][pages["index"] + 1:]
+        pages["cursors"].append(next_cursor)
+        pages["index"] += 1
+
+    if pages["index"] > 0 or next_cursor is not None:
+        c1, c2, c3 = st.columns([1, 1, 1])
+        c1.button("⬅️ 上一页", key="history_prev", on_click=go_prev, disabled=pages["index"] == 0)
+        c2.caption(f"第 {pages['index'] + 1} 页")
+        c3.button("下一页 ➡️", key="history_next", on_click=go_next, disabled=next_cursor is None)
+
+render_history(current_user)
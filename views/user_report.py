@@ -3,36 +3,47 @@ import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 import db_manager as db
+import db_async
+import image_store
+import recommender
 
 st.title("📊 个人能力诊断报告")
 
-# 1. 从数据库获取数据
-my_records = db.get_play_records(st.session_state.username)
+# 1. 从汇总表获取数据（几十行，不拉原始记录）
+#    推荐区要用的筛选项和默认等级范围与它互不依赖，一起并发查询
+stats, facets, default_band = db_async.gather(
+    lambda: db.get_user_report_stats(st.session_state.username),
+    db.get_chart_facets,
+    lambda: recommender.default_level_range(st.session_state.username),
+)
 
-if my_records.empty:
+# 汇总表还没有数据时，从原始记录补建一次
+if stats["daily"].empty and not st.session_state.get("report_stats_rebuilt"):
+    st.session_state["report_stats_rebuilt"] = True
+    if db.rebuild_user_report_stats(st.session_state.username):
+        stats = db.get_user_report_stats(st.session_state.username)
+
+if stats["daily"].empty:
     st.info(f"Hi, {st.session_state.username}，你还没有提交过任何实战记录，无法生成报告。")
     st.stop()
 
-# 2. 数据清洗 (Tags 拆分)
-# 去除"常规段落"
-valid_records = my_records[my_records['detected_tags'] != '常规段落'].copy()
+if st.button("🔄 重新统计", help="按当前的社区标注，把全部历史记录的失误段落重新映射到技术标签"):
+    db.rebuild_user_report_stats(st.session_state.username)
+    st.rerun()
+
+# 2. 技术标签失误汇总（"常规段落"在写入汇总表时已排除）
+tag_stats = stats["tags"].rename(columns={"miss_total": "miss_count"})
+tag_stats = tag_stats[tag_stats["miss_count"] > 0].copy()
 
 # 如果没有任何包含Tag的记录
-if valid_records.empty:
+if tag_stats.empty:
     st.warning("目前的记录中没有包含技术标签（都是常规段落），无法生成雷达图。")
 else:
-    # 拆分 Tags
-    tags_expanded = valid_records.assign(tag=valid_records['detected_tags'].str.split(',')).explode('tag')
-    tags_expanded['tag'] = tags_expanded['tag'].str.strip() # 去除空格
-
     # ================= 雷达图 =================
     st.header("1. 弱点雷达图")
     col1, col2 = st.columns([3, 2])
 
     with col1:
-        # 统计每个Tag的失误总数
-        tag_stats = tags_expanded.groupby('tag')['miss_count'].sum().reset_index()
-        
         if not tag_stats.empty:
             # 简单算法：假设基准分100，每失误一次扣分 (为了演示效果)
             # 实际可以根据你的统计学模型调整
@@ -55,8 +66,8 @@ else:
 
     with col2:
         st.subheader("📉 失误原因分布")
-        cause_counts = my_records['cause'].value_counts().reset_index()
-        cause_counts.columns = ['原因', '次数']
+        cause_counts = stats["causes"].rename(columns={"cause": "原因", "record_count": "次数"})
+        cause_counts = cause_counts[cause_counts["次数"] > 0]
         fig_pie = px.pie(cause_counts, values='次数', names='原因', hole=0.4)
         st.plotly_chart(fig_pie, use_container_width=True)
 
@@ -64,9 +75,47 @@ else:
 st.markdown("---")
 st.header("2. 近期状态趋势")
 
-# 按日期统计总失误
-daily_stats = my_records.groupby('date_time')['miss_count'].sum().reset_index()
+# 按日期统计总失误（日汇总表）
+daily_stats = stats["daily"]
 if not daily_stats.empty:
-    fig_line = px.line(daily_stats, x="date_time", y="miss_count", 
+    fig_line = px.line(daily_stats, x="play_date", y="miss_total", 
                        title="每日总失误数变化", markers=True)
-    st.plotly_chart(fig_line, use_container_width=True)
\ No newline at end of file
+    st.plotly_chart(fig_line, use_container_width=True)
+# ================= 练习推荐 =================
+st.markdown("---")
+st.header("3. 推荐练习谱面")
+st.caption("按你失误最多的技术特征，从社区标注里找最对症的谱面。")
+
+levels = facets["levels"] or [1]
+lo, hi = int(min(levels)), int(max(levels))
+band = default_band or (lo, hi)
+r1, r2 = st.columns([3, 1])
+with r1:
+    if lo == hi:
+        # 只有一个等级时没有范围可选（st.slider 要求 min < max）
+        level_range = (lo, hi)
+        st.caption(f"等级：{lo}")
+    else:
+        band_lo = min(max(lo, band[0]), hi)
+        level_range = st.slider("等级范围", lo, hi, (band_lo, max(band_lo, min(hi, band[1]))))
+with r2:
+    top_n = st.number_input("推荐数量", 5, 50, 10, step=5)
+
+recs = recommender.recommend(st.session_state.username, level_range=level_range, top_n=int(top_n))
+if recs.empty:
+    st.info("这个等级范围内还没有与你的弱点匹配的标注谱面，试试放宽等级范围。")
+else:
+    recs.insert(0, "thumb", recs["chart_image_path"].map(lambda ref: image_store.thumbnail_url(ref, 120)))
+    st.dataframe(
+        recs.drop(columns="chart_image_path"),
+        column_config={
+            "thumb": st.column_config.ImageColumn("缩略图", width="small"),
+            "song_name": "歌名",
+            "difficulty": "难度",
+            "level": "等级",
+            "score": st.column_config.ProgressColumn("匹配度", min_value=0.0, max_value=1.0, format="%.2f"),
+            "focus": "主要练习点",
+        },
+        use_container_width=True,
+        hide_index=True
+    )
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+from tech_tags import MAX_ANNOTATION_SPAN, TECH_TAGS, tags_to_masks, masks_to_strings
+
+# =========================================================
+# 弱点引擎：把打歌记录的失误段落映射到谱面标注区间
+# 做法：把每条标注 [start, end] 展开成 (chart_id, section) 键，
+# 同一键上的标签位掩码按位或合并，得到有序的键数组；
+# 查询时对整批记录一次 searchsorted，全程没有 Python 逐行循环。
+# =========================================================
+SECTION_BITS = 20        # 键 = chart_id << 20 | section
+
+def build_section_index(annotations):
+    """
+    :param annotations: 含 chart_id / start_section / end_section / tags 的 DataFrame
+    :return: (keys, masks)，keys 升序且唯一，masks[i] 为该 (谱面, 段落) 上所有标签的并集
+    """
+    ann = annotations.dropna(subset=["chart_id", "start_section", "end_section"])
+    if ann.empty:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    chart = ann["chart_id"].to_numpy(dtype=np.int64)
+    start = ann["start_section"].to_numpy(dtype=np.int64)
+    end = np.maximum(ann["end_section"].to_numpy(dtype=np.int64), start)
+    lengths = np.minimum(end - start + 1, MAX_ANNOTATION_SPAN)
+    masks = tags_to_masks(ann["tags"])
+
+    # 展开区间：第 k 条标注生成 start_k ... start_k + len_k - 1
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    sections = np.repeat(start, lengths) + offsets
+    keys = (np.repeat(chart, lengths) << SECTION_BITS) | sections
+    expanded = np.repeat(masks, lengths)
+
+    order = np.argsort(keys, kind="stable")
+    keys, expanded = keys[order], expanded[order]
+    uniq, first = np.unique(keys, return_index=True)
+    return uniq, np.bitwise_or.reduceat(expanded, first)
+
+def lookup_masks(index, chart_ids, sections):
+    """
+    批量查询若干 (chart_id, section) 的标签位掩码，未命中为 0
+    """
+    keys, masks = index
+    chart_ids = np.asarray(chart_ids, dtype=np.int64)
+    sections = np.asarray(sections, dtype=np.int64)
+    if len(keys) == 0 or len(chart_ids) == 0:
+        return np.zeros(len(chart_ids), dtype=np.int64)
+    query = (chart_ids << SECTION_BITS) | sections
+    pos = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+    return np.where(keys[pos] == query, masks[pos], 0)
+
+def record_masks(records, annotations):
+    """
+    每条记录失误段落命中的标签位掩码（缺少 chart_id / miss_section 的记录为 0）
+    """
+    valid = records["chart_id"].notna() & records["miss_section"].notna()
+    result = np.zeros(len(records), dtype=np.int64)
+    if valid.any():
+        index = build_section_index(annotations)
+        result[valid.to_numpy()] = lookup_masks(
+            index,
+            records.loc[valid, "chart_id"].to_numpy(dtype=np.int64),
+            records.loc[valid, "miss_section"].to_numpy(dtype=np.int64),
+        )
+    return result
+
+def detect_tags(records, annotations):
+    """
+    :return: 与 records 对齐的 detected_tags 字符串 Series（无命中为「常规段落」）
+    """
+    return pd.Series(masks_to_strings(record_masks(records, annotations)), index=records.index)
+
+def tag_miss_totals(masks, miss_counts):
+    """
+    按标签汇总失误数（每个标签一次向量化求和）
+    :return: DataFrame(tag, miss_count)，只保留失误数 > 0 的标签
+    """
+    masks = np.asarray(masks, dtype=np.int64)
+    miss_counts = np.asarray(miss_counts, dtype=np.int64)
+    totals = [int(miss_counts[((masks >> bit) & 1) == 1].sum()) for bit in range(len(TECH_TAGS))]
+    df = pd.DataFrame({"tag": TECH_TAGS, "miss_count": totals})
+    return df[df["miss_count"] > 0].reset_index(drop=True)
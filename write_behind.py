@@ -0,0 +1,389 @@
+import atexit
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+import pandas as pd
+import streamlit as st
+from sqlalchemy import text
+import db_manager as db
+
+try:
+    import fcntl
+except ImportError:      # Windows 本地开发：不做跨进程互斥
+    fcntl = None
+
+# =========================================================
+# 低优先级写入的后写队列（反馈、打歌记录）
+# 开启后提交只做一件事：追加一行到本机日志文件（fsync 后即返回），
+# 后台线程攒够 batch_size 条或每隔 flush_seconds 秒按类型批量写库（每类一个事务），
+# 写成功后在日志里追加确认行。进程崩溃 / 重启后，日志里没确认的条目会被重新入队。
+#
+# 日志格式（JSON Lines）：
+#   {"seq": 12, "kind": "play_record", "data": {...}, "ts": 1700000000.0}   待写条目
+#   {"ack": [10, 11, 12]}                                                   已写入数据库
+# 同一个日志只允许一个进程使用（flock）；拿不到锁的进程退回同步写入。
+#
+# 投递语义是「至少一次」：确认行在数据库提交之后才写，提交后、确认前崩溃的条目
+# 重启后会被重放。每个条目提交时生成一个 client_key，随数据一起写进表里；
+# 重放出来的条目写库前先按 client_key 查重，已经在库里的直接确认，不会重复插入。
+# =========================================================
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 默认参数，可在 secrets.toml 的 [write_behind] 中覆盖：
+#   enabled（默认关闭，同步写入）、journal（日志路径）、batch_size（攒够多少条立即刷写）、
+#   flush_seconds（最长等待秒数）、fsync（每次提交是否落盘，关掉更快但断电可能丢最后几条）
+WRITE_BEHIND_DEFAULTS = {
+    "enabled": False,
+    "journal": os.path.join(APP_DIR, ".cache", "write_behind.jsonl"),
+    "batch_size": 200,
+    "flush_seconds": 2.0,
+    "fsync": True,
+}
+# 设置为 1 / 0 时覆盖 enabled
+ENABLED_ENV = "RHYTHMCOACH_WRITE_BEHIND"
+
+MAX_BACKOFF = 60             # 数据库不可用时重试间隔的上限（秒）
+MAX_ATTEMPTS = 5             # 数据库可用、某条却反复写入失败时，最多重试的次数
+COMPACT_BYTES = 1024 * 1024  # 日志超过该大小时压缩（去掉已确认的条目）
+
+def settings():
+    conf = dict(WRITE_BEHIND_DEFAULTS)
+    try:
+        conf.update(st.secrets.get("write_behind", {}))
+    except FileNotFoundError:
+        pass
+    if os.environ.get(ENABLED_ENV) in ("0", "1"):
+        conf["enabled"] = os.environ[ENABLED_ENV] == "1"
+    return conf
+
+# ============================ 1. 写入器 ============================
+def _write_play_records(rows):
+    return db.add_play_records_bulk(rows, chunk_size=len(rows))
+
+def _write_feedback(rows):
+    return db.add_feedbacks_bulk(rows, chunk_size=len(rows))
+
+# kind -> 批量写入函数（一次调用一个事务）
+WRITERS = {
+    "play_record": _write_play_records,
+    "feedback": _write_feedback,
+}
+
+# kind -> 存放 client_key 的表（重放查重用）
+CLIENT_KEY_TABLES = {
+    "play_record": "play_records",
+    "feedback": "user_feedback",
+}
+
+def _already_written(kind, entries):
+    """
+    重放条目里已经在数据库中的那些，按 client_key 一次 IN 查询
+    （查询失败时抛异常，由调用方按数据库不可用处理；升级前写下、没有 client_key 的条目无法查重）
+    """
+    table = CLIENT_KEY_TABLES.get(kind)
+    keys = [e["data"]["client_key"] for e in entries if e["data"].get("client_key")]
+    if table is None or not keys:
+        return []
+    params = {f"k{i}": key for i, key in enumerate(keys)}
+    with db.get_connection().engine.connect() as c:
+        found = set(c.execute(
+            text(f"SELECT client_key FROM {table} WHERE client_key IN ({', '.join(':' + k for k in params)})"),
+            params
+        ).scalars())
+    return [e for e in entries if e["data"].get("client_key") in found]
+
+def _probe_database():
+    """
+    数据库是否可用（整批写入失败时用来区分「库挂了」和「条目本身有问题」）
+    """
+    try:
+        with db.get_connection().engine.connect() as c:
+            c.execute(text("SELECT 1"))
+        return True
+    except Exception:
+        return False
+
+def _json_default(value):
+    # 只有 json 不认识的类型才会进来：pd.NA / NaT（如没有等级的谱面）记成 null
+    if pd.api.types.is_scalar(value) and pd.isna(value):
+        return None
+    if isinstance(value, pd.Timestamp) or type(value).__name__ == "datetime64":
+        value = pd.Timestamp(value).to_pydatetime()
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    # numpy / pandas 标量（如从 DataFrame 行里取出的 chart_id）
+    if hasattr(value, "item"):
+        return value.item()
+    raise TypeError(f"无法写入日志的类型: {type(value).__name__}")
+
+# ============================ 2. 日志 + 后台线程 ============================
+class WriteBehindQueue:
+    def __init__(self, journal, batch_size=200, flush_seconds=2.0, fsync=True, writers=None, probe=None,
+                 dedupe=None):
+        self.journal = journal
+        self.batch_size = int(batch_size)
+        self.flush_seconds = float(flush_seconds)
+        self.fsync = fsync
+        self.writers = writers or WRITERS
+        self.probe = probe or _probe_database
+        self.dedupe = dedupe or _already_written
+        self._cond = threading.Condition()
+        self._queue = []          # [{"seq", "kind", "data", "ts"}]，按提交顺序
+        self._attempts = {}       # seq -> 单独重试失败次数
+        self._replayed = set()    # 从日志重放出来、可能已经写入过的 seq
+        self._seq = 0
+        self._stopping = False
+        self._thread = None
+        self.stats = {"submitted": 0, "flushed": 0, "replayed": 0, "dead": 0,
+                      "failures": 0, "last_error": None, "last_flush": None}
+
+        os.makedirs(os.path.dirname(journal) or ".", exist_ok=True)
+        self._lock_file = open(journal + ".lock", "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self._lock_file.close()
+                raise
+        self._replay()
+        self._file = open(journal, "a", encoding="utf-8")
+        if self._file.tell() and not self._ends_with_newline():
+            # 崩溃时写了一半的行单独收尾，避免和后面追加的确认行粘在一起
+            self._file.write("\n")
+            self._file.flush()
+
+    def _ends_with_newline(self):
+        with open(self.journal, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def _replay(self):
+        """
+        读出日志里还没确认的条目（最后一行可能是崩溃时写了一半的，跳过）
+        """
+        if not os.path.exists(self.journal):
+            return
+        pending, acked = {}, set()
+        with open(self.journal, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if "ack" in entry:
+                    acked.update(entry["ack"])
+                elif "seq" in entry:
+                    pending[entry["seq"]] = entry
+                    self._seq = max(self._seq, entry["seq"])
+        self._queue = [pending[s] for s in sorted(pending) if s not in acked]
+        self._replayed = {e["seq"] for e in self._queue}
+        self.stats["replayed"] = len(self._queue)
+
+    def _append(self, entry):
+        self._file.write(json.dumps(entry, ensure_ascii=False, default=_json_default) + "\n")
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def submit(self, kind, data):
+        if kind not in self.writers:
+            raise ValueError(f"未知的写入类型: {kind}")
+        with self._cond:
+            self._seq += 1
+            # client_key 随数据写进表里，重放时据此判断是否已经写入过
+            data = {**data, "client_key": uuid.uuid4().hex}
+            entry = {"seq": self._seq, "kind": kind, "data": data, "ts": time.time()}
+            self._append(entry)
+            # 日志里的数据已经过 JSON 往返，入队的也用同一份，保证重放与正常刷写一致
+            self._queue.append(json.loads(json.dumps(entry, default=_json_default)))
+            self.stats["submitted"] += 1
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify()
+        return entry["seq"]
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        backoff = 0
+        while True:
+            with self._cond:
+                if backoff and not self._stopping:
+                    self._cond.wait(timeout=backoff)
+                elif not self._stopping and len(self._queue) < self.batch_size:
+                    self._cond.wait(timeout=self.flush_seconds)
+                if self._stopping and not self._queue:
+                    return
+                batch = list(self._queue[:self.batch_size * 5])
+            if not batch:
+                continue
+            if self.flush(batch):
+                backoff = 0
+            else:
+                backoff = min(MAX_BACKOFF, max(1, backoff * 2))
+                if self._stopping:
+                    return
+
+    def flush(self, batch):
+        """
+        按类型批量写入；整批失败时先探测一次数据库：不可用就整批留到退避之后，
+        可用才逐条重试，找出个别写不进去的条目
+        :return: 是否有进展（没有时由调用方退避）
+        """
+        done, progressed = [], False
+        by_kind = {}
+        for entry in batch:
+            by_kind.setdefault(entry["kind"], []).append(entry)
+        for kind, entries in by_kind.items():
+            writer = self.writers[kind]
+            try:
+                replayed = [e for e in entries if e["seq"] in self._replayed]
+                if replayed:
+                    # 提交后、确认前崩溃留下的条目：已经在库里的只补确认
+                    written = {e["seq"] for e in self.dedupe(kind, replayed)}
+                    done += [e for e in entries if e["seq"] in written]
+                    entries = [e for e in entries if e["seq"] not in written]
+                    self._replayed -= {e["seq"] for e in replayed}
+                    progressed = progressed or bool(written)
+                if not entries:
+                    continue
+                writer([e["data"] for e in entries])
+                done += entries
+                progressed = True
+                continue
+            except Exception as e:
+                self.stats["failures"] += 1
+                self.stats["last_error"] = f"{kind}: {type(e).__name__}: {e}"
+            if not self.probe():
+                # 数据库不可用：不逐条重试（每条都会等一次连接超时），其余类型也留到下次
+                break
+            failed = []
+            for entry in entries:
+                try:
+                    writer([entry["data"]])
+                    done.append(entry)
+                    progressed = True
+                except Exception:
+                    failed.append(entry)
+            # 数据库可用、条目却写不进去：是条目本身的问题，计次，超过上限移入死信
+            for entry in failed:
+                tries = self._attempts[entry["seq"]] = self._attempts.get(entry["seq"], 0) + 1
+                if tries >= MAX_ATTEMPTS:
+                    self._dead_letter(entry)
+                    done.append(entry)
+                    progressed = True
+        if done:
+            self._ack(done)
+        return progressed
+
+    def _dead_letter(self, entry):
+        with open(self.journal + ".dead", "a", encoding="utf-8") as f:
+            f.write(json.dumps({**entry, "error": self.stats["last_error"]}, ensure_ascii=False) + "\n")
+        self.stats["dead"] += 1
+
+    def _ack(self, entries):
+        seqs = {e["seq"] for e in entries}
+        with self._cond:
+            self._append({"ack": sorted(seqs)})
+            self._queue = [e for e in self._queue if e["seq"] not in seqs]
+            for seq in seqs:
+                self._attempts.pop(seq, None)
+            self.stats["flushed"] += len(seqs)
+            self.stats["last_flush"] = time.time()
+            self._compact()
+
+    def _compact(self):
+        """
+        日志变大时只保留还没确认的条目，原子替换（调用方持有 self._cond）
+        """
+        if self._file.tell() < COMPACT_BYTES:
+            return
+        tmp = self.journal + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for entry in self._queue:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        os.replace(tmp, self.journal)
+        self._file = open(self.journal, "a", encoding="utf-8")
+
+    def pending(self):
+        with self._cond:
+            return len(self._queue)
+
+    def close(self, timeout=5.0):
+        """
+        停止后台线程（剩余条目尽量刷写一次，写不进去的留在日志里下次重放）
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._file.close()
+        self._lock_file.close()
+
+# ============================ 3. 进程内单例 ============================
+_instance_lock = threading.Lock()
+_instance = None     # None：尚未初始化；False：未开启 / 日志被其他进程占用
+
+def get_queue():
+    """
+    开启时返回进程内唯一的队列（首次调用会重放日志并启动后台线程），否则返回 None
+    """
+    global _instance
+    if _instance is None:
+        with _instance_lock:
+            if _instance is None:
+                conf = settings()
+                if not conf["enabled"]:
+                    _instance = False
+                else:
+                    try:
+                        _instance = WriteBehindQueue(
+                            conf["journal"], conf["batch_size"], conf["flush_seconds"], conf["fsync"]
+                        ).start()
+                        atexit.register(_instance.close)
+                    except OSError:
+                        _instance = False
+    return _instance or None
+
+def submit_play_record(data):
+    """
+    替代 db.add_play_record：开启后写日志即返回（play_time 取提交时刻，与数据库默认值同一时区），未开启时同步写库
+    :return: True 表示已进入后写队列，False 表示已同步写入
+    """
+    queue = get_queue()
+    if queue is None:
+        db.add_play_record(data)
+        return False
+    queue.submit("play_record", {**data, "play_time": db.db_now().strftime("%Y-%m-%d %H:%M:%S")})
+    return True
+
+def submit_feedback(username, feedback_type, content):
+    queue = get_queue()
+    if queue is None:
+        db.add_feedback(username, feedback_type, content)
+        return False
+    queue.submit("feedback", {
+        "username": username, "feedback_type": feedback_type, "content": content,
+        "created_at": db.db_now().strftime("%Y-%m-%d %H:%M:%S"),
+    })
+    return True
+
+def queue_stats():
+    """
+    给管理页面展示；未开启时返回 None
+    """
+    queue = get_queue()
+    if queue is None:
+        return None
+    journal_bytes = os.path.getsize(queue.journal) if os.path.exists(queue.journal) else 0
+    return {**queue.stats, "pending": queue.pending(), "journal_bytes": journal_bytes}